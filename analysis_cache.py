@@ -0,0 +1,135 @@
+import sqlite3
+
+import chess
+import chess.polyglot
+
+from forced_chess import forced_legal_moves
+
+# Search results that outlive the process: (depth, score, best move) per position, in an
+# SQLite file keyed by Zobrist hash, shared by every engine (and game) pointed at it.
+#
+# After each move the engine records the root and the first couple of PV positions, and it
+# reads them back two ways: every entry of the opening goes into the TT at the start of a
+# game, and before each search the root is looked up in case it's deeper than what the TT
+# has. A TT entry at least as deep as the iteration is an instant answer, so a repeated
+# opening gets its old depth for free and the search carries on from there.
+#
+# Scores are White's like the search's, mates counted from the stored position. The file
+# can be shared between processes (WAL journal), writers wait for each other.
+
+CACHE_VERSION = 1
+
+MIN_DEPTH = 4 # shallower results aren't worth a disk write, the TT gets them back quickly
+NEAR_ROOT_PLIES = 2 # PV positions after the root that get recorded too
+WARM_MAX_PLY = 24 # game plies the TT is warmed with at the start of a game
+WARM_LIMIT = 50000 # most entries loaded into the TT at once
+BUSY_TIMEOUT = 5.0 # seconds to wait for another process' write
+
+MATE_BOUND = 29000 # scores above this are mates
+
+
+def signed_key(key):
+    # SQLite integers are signed 64 bit, Zobrist keys aren't
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+def unsigned_key(key):
+    return key + (1 << 64) if key < 0 else key
+
+def mate_from(score, plies):
+    # the same mate seen from a position plies further along the line is that much shorter
+    if score > MATE_BOUND:
+        return score + plies
+    if score < -MATE_BOUND:
+        return score - plies
+    return score
+
+
+class AnalysisCache:
+    def __init__(self, path, min_depth=MIN_DEPTH):
+        self.path = path
+        self.min_depth = min_depth
+        # check_same_thread: the xboard analysis and UCI search threads use it too, one at a time
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS positions ("
+                                "key INTEGER PRIMARY KEY, depth INTEGER NOT NULL, score INTEGER NOT NULL, "
+                                "move TEXT, ply INTEGER NOT NULL)")
+                self.db.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        elif version != CACHE_VERSION:
+            self.db.close()
+            raise ValueError(f"{path}: analysis cache version {version}, expected {CACHE_VERSION}")
+
+        self.hits = 0
+        self.writes = 0
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+
+    def lookup(self, board: chess.Board, key=None):
+        """(depth, score, move) stored for the position, or None."""
+        if key is None:
+            key = chess.polyglot.zobrist_hash(board)
+        row = self.db.execute("SELECT depth, score, move FROM positions WHERE key = ?",
+                              (signed_key(key),)).fetchone()
+        if row is None:
+            return None
+        depth, score, move = row
+        return depth, score, chess.Move.from_uci(move) if move else None
+
+    def seed(self, tt, board: chess.Board):
+        """Puts the stored result for the root into the TT, if it's legal here. Returns it or None."""
+        key = chess.polyglot.zobrist_hash(board)
+        found = self.lookup(board, key)
+        if found is None:
+            return None
+        depth, score, move = found
+        if move is not None and move not in forced_legal_moves(board):
+            return None
+        self.hits += 1
+        tt.store(board, depth, score, "EXACT", best_move=move, key=key)
+        return found
+
+    def warm(self, tt, max_ply=WARM_MAX_PLY, limit=WARM_LIMIT):
+        """Loads the deepest opening entries into the TT for a new game, returns how many."""
+        rows = self.db.execute("SELECT key, depth, score, move FROM positions WHERE ply <= ? "
+                               "ORDER BY depth DESC LIMIT ?", (max_ply, limit)).fetchall()
+        # shallowest first, so a colliding deeper entry replaces it in the TT
+        for key, depth, score, move in reversed(rows):
+            tt.store(None, depth, score, "EXACT", best_move=chess.Move.from_uci(move) if move else None,
+                     key=unsigned_key(key))
+        return len(rows)
+
+    def record(self, board: chess.Board, result):
+        """Stores a finished search of board (a bbsearch.SearchResult): the root and the start of its PV."""
+        # seed() hands scores to the TT as exact, a bound mustn't pass for one
+        if not result.exact:
+            return 0
+        rows = []
+        line = board.copy()
+        depth, score = result.depth, result.score
+        moves = result.pv if result.pv[:1] == [result.best_move] else [result.best_move]
+        for plies, move in enumerate(moves[:NEAR_ROOT_PLIES + 1]):
+            if move is None or depth - plies < self.min_depth or move not in forced_legal_moves(line):
+                break
+            rows.append((signed_key(chess.polyglot.zobrist_hash(line)), depth - plies,
+                         int(mate_from(score, plies)), move.uci(), line.ply()))
+            line.push(move)
+        if not rows:
+            return 0
+
+        # keep whichever result is deeper
+        with self.db:
+            self.db.executemany("INSERT INTO positions (key, depth, score, move, ply) VALUES (?, ?, ?, ?, ?) "
+                                "ON CONFLICT(key) DO UPDATE SET depth = excluded.depth, score = excluded.score, "
+                                "move = excluded.move, ply = excluded.ply WHERE excluded.depth > positions.depth",
+                                rows)
+        self.writes += len(rows)
+        return len(rows)
+
+    def close(self):
+        self.db.close()
@@ -1,12 +1,72 @@
 import chess
-from dataclasses import dataclass
+import chess.polyglot
+import sys
+import threading
+from dataclasses import dataclass, field, asdict
 from typing import List, Optional
 from transposition import Transposition_Table
 import time
-from forced_chess import forced_legal_moves
-from evaluate import evaluate, MAX_PHASE, PHASE_WEIGHTS, compute_phase
+from forced_chess import forced_legal_moves, forced_moves_and_status, CHECKMATE
+from evaluate import evaluate, evaluate_fast, MAX_PHASE, PHASE_WEIGHTS, compute_phase
 #from test_evaluate import evaluate
 
+@dataclass
+class IterationStats:
+    depth: int
+    score: int
+    nodes: int # minimax + quiescence nodes spent on this iteration
+    qnodes: int
+    time: float # seconds spent on this iteration
+    elapsed: float # seconds since the search started
+    ebf: float # effective branching factor, nodes of this iteration / nodes of the previous one
+
+@dataclass
+class SearchStats:
+    nodes: int = 0
+    qnodes: int = 0
+    tt_probes: int = 0
+    tt_hits: int = 0
+    beta_cutoffs: int = 0
+    first_move_cutoffs: int = 0
+    tb_hits: int = 0
+    hashfull: int = 0 # permill of the TT in use after the last iteration
+    fast_eval: bool = False # searched with evaluate_fast
+    time_taken: float = 0.0
+    iterations: List[IterationStats] = field(default_factory=list)
+
+    def reset(self):
+        self.nodes = self.qnodes = 0
+        self.tt_probes = self.tt_hits = 0
+        self.beta_cutoffs = self.first_move_cutoffs = 0
+        self.tb_hits = 0
+        self.hashfull = 0
+        self.fast_eval = False
+        self.time_taken = 0.0
+        self.iterations = []
+
+    @property
+    def total_nodes(self):
+        return self.nodes + self.qnodes
+
+    @property
+    def nps(self):
+        return int(self.total_nodes / self.time_taken) if self.time_taken > 0 else 0
+
+    @property
+    def tt_hit_rate(self):
+        return self.tt_hits / self.tt_probes if self.tt_probes else 0.0
+
+    @property
+    def first_move_cutoff_rate(self):
+        # how often the first move we tried was the one that cut, i.e. how good the move ordering is
+        return self.first_move_cutoffs / self.beta_cutoffs if self.beta_cutoffs else 0.0
+
+    def to_dict(self):
+        d = asdict(self)
+        d.update(total_nodes=self.total_nodes, nps=self.nps, tt_hit_rate=self.tt_hit_rate,
+                 first_move_cutoff_rate=self.first_move_cutoff_rate)
+        return d
+
 @dataclass
 class SearchResult:
     best_move: Optional[chess.Move]
@@ -14,339 +74,692 @@ class SearchResult:
     depth: int
     time_taken: float
     pv: List[chess.Move]
-
-TT = Transposition_Table(size=2000000)
-
-# Killer move heuristics
+    stats: Optional[SearchStats] = None
+    # score is the true value at depth: False for a fail-high bound played after a timeout
+    # and for PNS's placeholder mate score
+    exact: bool = True
+
+# Raised inside the search when it has to stop mid-iteration
+class SearchAborted(Exception):
+	pass
+
+# progress goes to stderr, stdout belongs to the protocol
+def log(msg):
+	sys.stderr.write(msg + '\n')
+
+# Zobrist keys of the game history and the current search path, for repetition detection
+class RepetitionStack:
+	def __init__(self):
+		self.keys = []
+		self.root = 0 # index of the root position, everything before it is game history
+
+	def reset(self, board: chess.Board):
+		# only positions since the last irreversible move can ever repeat
+		keys = []
+		b = board.copy()
+		for _ in range(min(board.halfmove_clock, len(board.move_stack))):
+			b.pop()
+			keys.append(chess.polyglot.zobrist_hash(b))
+		keys.reverse()
+		self.keys = keys
+		self.root = len(keys)
+
+	def push(self, key):
+		self.keys.append(key)
+
+	def pop(self):
+		self.keys.pop()
+
+	def is_repetition(self, key, halfmove_clock) -> bool:
+		# a twofold repetition inside the search path is a draw (we can just repeat again),
+		# against the game history it takes a threefold
+		keys = self.keys
+		n = len(keys)
+		stop = max(0, n - halfmove_clock)
+		count = 0
+		# same side to move every second ply, and a position can't repeat within 4 plies
+		for i in range(n - 4, stop - 1, -2):
+			if keys[i] == key:
+				if i >= self.root:
+					return True
+				count += 1
+				if count >= 2:
+					return True
+		return False
+
+# order_moves' default: no TT probe made for it yet
+NOT_PROBED = object()
+
+# Deepest iteration, killer and PV tables are sized for it
 MAX_SEARCH_DEPTH = 50
-killer_moves = [[None, None] for _ in range(MAX_SEARCH_DEPTH)]
-
-# Max Player = True means the player is playing White pieces
-# Max Player = False means the player is playing Black pieces
-def minimax(board: chess.Board, depth, alpha, beta, max_player, depth_from_root, pv=None, panic=False) -> tuple[int, Optional[chess.Move]]:
-	# Transposition Table Logic
-	entry = TT.lookup(board)
-	if entry and entry.depth >= depth:
-		if entry.flag == "EXACT":
-			return entry.score, entry.best_move
-		elif entry.flag == "UPPERBOUND":
-			beta = min(beta, entry.score)
-		elif entry.flag == "LOWERBOUND":
-			alpha = max(alpha, entry.score)
-
-		if alpha >= beta:
-			return entry.score, entry.best_move
-		
-	# include quiescence search to the rood note (y u gotta be so rude~)
-	if depth == 0 or board.is_game_over():
-		# Make the board not do quiescence search at the beginning (like we're doing 20 second first moves are we fr rn)
-		if board.fullmove_number <= 2:
-			return evaluate(board, depth_from_root), None
+
+# Aspiration windows: first window around the last score, how much the step grows on every
+# re-search, and the bound that means no bound at all
+ASPIRATION_WINDOW = 75
+ASPIRATION_GROWTH = 1.5
+ASPIRATION_BOUND = 999999
+
+# Score (for the side to move) that makes us try to prove a mate with PNS
+PNS_TRIGGER_SCORE = 1000
+# PNS doesn't know how long the mate is, just that it's there (still counts as a mate score)
+PNS_MATE_SCORE = 29500
+
+# The cheap eval (evaluate_fast) takes over when the move's time can't buy a useful full-eval
+# search: under FAST_EVAL_TIME seconds, or fewer than FAST_EVAL_NODES nodes at the NPS the
+# last full-eval search ran at. Panic always uses it
+FAST_EVAL_TIME = 0.3
+FAST_EVAL_NODES = 500
+# panic caps the depth, the cheap eval buys a couple more plies in the same time
+PANIC_MAX_DEPTH = 4
+FAST_EVAL_EXTRA_DEPTH = 2
+
+# tablebase (wdl, dtm) of the side to move -> search score, mates counted from the root
+def tb_score(result, turn, depth_from_root):
+	import tablebase
+	wdl, dtm = result
+	if wdl == tablebase.DRAW:
+		return 0
+	score = 30000 - depth_from_root - dtm
+	if wdl == tablebase.LOSS:
+		score = -score
+	return score if turn == chess.WHITE else -score
+
+
+# Everything one search needs: its TT, repetition history, killers, PV table, stats and
+# limits. Searchers don't share anything, so several can run in one process (pondering next
+# to analysis, many games in a match server, test workers). The module-level functions below
+# all go through the engine's own one, bbsearch.searcher.
+class Searcher:
+	def __init__(self, tt=None, tt_size=2000000, tb=None, max_depth=MAX_SEARCH_DEPTH):
+		self.tt = tt if tt is not None else Transposition_Table(size=tt_size)
+		# endgame tables (tablebase.Tablebase) to probe, None = search endgames like everything else
+		self.tb = tb
+		self.max_depth = max_depth
+		self.stats = SearchStats()
+		self.history = RepetitionStack()
+		self.killer_moves = [[None, None] for _ in range(max_depth)]
+		# Triangular PV table: pv_table[ply] is the best line found from the node at that ply,
+		# rebuilt from the child's line whenever a move becomes the best one
+		self.pv_table = [[] for _ in range(max_depth + 2)]
+
+		# time.time() the running search gets aborted at (None = no hard limit)
+		self.deadline = None
+		# total nodes (minimax + quiescence) the running search gets aborted at (None = no limit)
+		self.node_limit = None
+		# set from another thread (xboard exit/stop) to abort the running search right away
+		self.stop_signal = threading.Event()
+		# on_info callback of the running search and when it started, for root best move updates
+		self.info_callback = None
+		self.search_start_time = 0.0
+		# evaluate or evaluate_fast, picked per search
+		self.evaluate = evaluate
+		# NPS of the last full-eval search, to tell whether the next one can afford it
+		self.full_eval_nps = 0
+
+	def clear(self):
+		# new game: forget everything learned from the last one
+		self.tt.clear()
+		for killers in self.killer_moves:
+			killers[0] = killers[1] = None
+
+	def wants_fast_eval(self, budget):
+		# budget: seconds planned for the move, None = no clock
+		if budget is None:
+			return False
+		return budget < FAST_EVAL_TIME or 0 < self.full_eval_nps * budget < FAST_EVAL_NODES
+
+	def check_limits(self):
+		if self.stop_signal.is_set() or (self.deadline is not None and time.time() >= self.deadline):
+			raise SearchAborted()
+		if self.node_limit is not None and self.stats.nodes + self.stats.qnodes >= self.node_limit:
+			raise SearchAborted()
+
+	# Max Player = True means the player is playing White pieces
+	# Max Player = False means the player is playing Black pieces
+	def minimax(self, board: chess.Board, depth, alpha, beta, max_player, depth_from_root, pv=None, panic=False) -> tuple[int, Optional[chess.Move]]:
+		self.stats.nodes += 1
+		self.check_limits()
+		# nodes that return before searching a move leave an empty line behind
+		self.pv_table[depth_from_root] = []
+		key = chess.polyglot.zobrist_hash(board)
+		if depth_from_root == 0:
+			self.history.reset(board)
 		else:
-			phase = compute_phase(board)
-			if panic:
-				depth_left = 1
+			# draws by repetition or the fifty-move rule, no move generation needed
+			# (a mate on the 100th half move still counts, so leave positions in check to the move generator)
+			if board.halfmove_clock >= 100 and not board.is_check():
+				return 0, None
+			if self.history.is_repetition(key, board.halfmove_clock):
+				return 0, None
+			# inside the tablebases: the exact result, nothing left to search
+			if self.tb is not None and self.tb.covers(board):
+				result = self.tb.probe(board)
+				if result is not None:
+					self.stats.tb_hits += 1
+					return tb_score(result, board.turn, depth_from_root), None
+
+		# Transposition Table Logic
+		entry = self.tt.lookup(board, key)
+		if entry and entry.depth >= depth:
+			if entry.flag == "EXACT":
+				if entry.best_move is not None:
+					self.pv_table[depth_from_root] = [entry.best_move]
+				return entry.score, entry.best_move
+			elif entry.flag == "UPPERBOUND":
+				beta = min(beta, entry.score)
+			elif entry.flag == "LOWERBOUND":
+				alpha = max(alpha, entry.score)
+
+			if alpha >= beta:
+				return entry.score, entry.best_move
+
+		# generate the moves once, the same list tells us if the game is over and feeds ordering/eval
+		moves, status = forced_moves_and_status(board)
+
+		if status == CHECKMATE:
+			return (-30000 + depth_from_root if board.turn == chess.WHITE else 30000 - depth_from_root), None
+		if status is not None:
+			return 0, None
+
+		# include quiescence search to the rood note (y u gotta be so rude~)
+		if depth == 0:
+			# Make the board not do quiescence search at the beginning (like we're doing 20 second first moves are we fr rn)
+			if board.fullmove_number <= 2:
+				return self.evaluate(board, depth_from_root, moves), None
 			else:
-				depth_left = 3 if phase < 8 else 6
-			score = quiescence_search(board, alpha, beta, maximizing_player=max_player, depth_left=depth_left, depth_from_root=depth_from_root)
-			return score, None
-
-	# keeping track of best move for best TT and for engine
-	best_move = None
-	# keep original window for TT flag determination
-	orig_alpha, orig_beta = alpha, beta
-
-	# Move Ordering
-	pv_move = None
-	if pv is not None and depth_from_root < len(pv):
-		pv_move = pv[depth_from_root]
-
-	moves = order_moves(board, forced_legal_moves(board), pv_move=pv_move, depth_from_root=depth_from_root)
-
-	if max_player:
-		m_eval = -float("inf")
-		for move in moves:
-			board.push(move)
-			evaluation, _ = minimax(board, depth - 1, alpha, beta, False, depth_from_root+1)
-			board.pop()
+				phase = compute_phase(board)
+				if panic:
+					depth_left = 1
+				else:
+					depth_left = 3 if phase < 8 else 6
+				score = self.quiescence_search(board, alpha, beta, maximizing_player=max_player, depth_left=depth_left, depth_from_root=depth_from_root, moves=moves)
+				return score, None
+
+		# keeping track of best move for best TT and for engine
+		best_move = None
+		# keep original window for TT flag determination
+		orig_alpha, orig_beta = alpha, beta
+
+		# Move Ordering
+		pv_move = None
+		if pv is not None and depth_from_root < len(pv):
+			pv_move = pv[depth_from_root]
+
+		moves = self.order_moves(board, moves, pv_move=pv_move, depth_from_root=depth_from_root, key=key, tt_entry=entry)
+
+		# children check themselves against this position
+		self.history.push(key)
+
+		if max_player:
+			m_eval = -float("inf")
+			for i, move in enumerate(moves):
+				board.push(move)
+				# only the PV move's subtree follows the previous iteration's line
+				evaluation, _ = self.minimax(board, depth - 1, alpha, beta, False, depth_from_root+1,
+										pv=pv if move == pv_move else None)
+				board.pop()
+
+				# Early Checkmate Check
+				if evaluation >= 29000:
+					mate_score = 30000 - depth_from_root
+					self.pv_table[depth_from_root] = [move] + self.pv_table[depth_from_root + 1]
+					self.history.pop()
+					self.tt.store(board, depth, evaluation, "EXACT", best_move=move, key=key)
+					return evaluation, move
+
+				if evaluation > m_eval:
+					m_eval = evaluation
+					best_move = move
+					self.pv_table[depth_from_root] = [move] + self.pv_table[depth_from_root + 1]
+					if depth_from_root == 0 and i > 0 and evaluation > orig_alpha:
+						self.report_root_move(depth, evaluation, move)
+
+				m_eval = max(m_eval, evaluation)
+				alpha = max(alpha, evaluation)
+
+				# killer move stuff
+				if evaluation >= beta and not board.is_capture(move):
+					if move not in self.killer_moves[depth_from_root]:
+						self.killer_moves[depth_from_root][1] = self.killer_moves[depth_from_root][0]  # push old killer down
+						self.killer_moves[depth_from_root][0] = move
+				if beta <= alpha:
+					self.stats.beta_cutoffs += 1
+					if i == 0:
+						self.stats.first_move_cutoffs += 1
+					break
 
-			# Early Checkmate Check
-			if evaluation >= 29000:
-				mate_score = 30000 - depth_from_root
-				TT.store(board, depth, evaluation, "EXACT", best_move=move)
-				return evaluation, move
-
-			if evaluation > m_eval:
-				m_eval = evaluation
-				best_move = move
-
-			m_eval = max(m_eval, evaluation)
-			alpha = max(alpha, evaluation)
-
-			# killer move stuff
-			if evaluation >= beta and not board.is_capture(move):
-				if move not in killer_moves[depth_from_root]:
-					killer_moves[depth_from_root][1] = killer_moves[depth_from_root][0]  # push old killer down
-					killer_moves[depth_from_root][0] = move
-			if beta <= alpha:
+		else:
+			m_eval = float("inf")
+			for i, move in enumerate(moves):
+				board.push(move)
+				# only the PV move's subtree follows the previous iteration's line
+				evaluation, _ = self.minimax(board, depth - 1, alpha, beta, True, depth_from_root+1,
+										pv=pv if move == pv_move else None)
+				board.pop()
+
+				# Early Checkmate Check
+				if evaluation <= -29000:
+					mate_score = -30000 + depth_from_root
+					self.pv_table[depth_from_root] = [move] + self.pv_table[depth_from_root + 1]
+					self.history.pop()
+					self.tt.store(board, depth, mate_score, "EXACT", best_move=move, key=key)
+					return evaluation, move
+
+				if evaluation < m_eval:
+					m_eval = evaluation
+					best_move = move
+					self.pv_table[depth_from_root] = [move] + self.pv_table[depth_from_root + 1]
+					if depth_from_root == 0 and i > 0 and evaluation < orig_beta:
+						self.report_root_move(depth, evaluation, move)
+
+				m_eval = min(m_eval, evaluation)
+				beta = min(beta, evaluation)
+
+				# killer move stuff
+				if evaluation <= alpha and not board.is_capture(move):
+					if move not in self.killer_moves[depth_from_root]:
+						self.killer_moves[depth_from_root][1] = self.killer_moves[depth_from_root][0]  # push old killer down
+						self.killer_moves[depth_from_root][0] = move
+				if beta <= alpha:
+					self.stats.beta_cutoffs += 1
+					if i == 0:
+						self.stats.first_move_cutoffs += 1
+					break
+
+		self.history.pop()
+
+		# determine TT flag relative to the original window
+		if m_eval <= orig_alpha:
+			flag = "UPPERBOUND"
+		elif m_eval >= orig_beta:
+			flag = "LOWERBOUND"
+		else:
+			flag = "EXACT"    
+		# store remaining depth (depth is depth_remaining)
+		self.tt.store(board, depth, m_eval, flag, best_move=best_move, key=key)
+
+		return m_eval, best_move
+
+	# the tablebase-optimal line from a covered position, None if the root isn't covered
+	def tb_line(self, board: chess.Board, max_length: int):
+		root = self.tb.best_move(board)
+		if root is None:
+			return None
+		move, result = root
+		pv = [move]
+		board = board.copy(stack=False)
+		board.push(move)
+		while len(pv) < max_length:
+			next_move = self.tb.best_move(board)
+			if next_move is None:
 				break
-
-	else:
-		m_eval = float("inf")
-		for move in moves:
-			board.push(move)
-			evaluation, _ = minimax(board, depth - 1, alpha, beta, True, depth_from_root+1)
-			board.pop()
-
-			# Early Checkmate Check
-			if evaluation <= -29000:
-				mate_score = -30000 + depth_from_root
-				TT.store(board, depth, mate_score, "EXACT", best_move=move)
-				return evaluation, move
-
-			if evaluation < m_eval:
-				m_eval = evaluation
-				best_move = move
-
-			m_eval = min(m_eval, evaluation)
-			beta = min(beta, evaluation)
-
-			# killer move stuff
-			if evaluation <= alpha and not board.is_capture(move):
-				if move not in killer_moves[depth_from_root]:
-					killer_moves[depth_from_root][1] = killer_moves[depth_from_root][0]  # push old killer down
-					killer_moves[depth_from_root][0] = move
-			if beta <= alpha:
+			pv.append(next_move[0])
+			board.push(next_move[0])
+		return result, pv
+
+	# a new best move at the root in the middle of an iteration
+	def report_root_move(self, depth, score, move):
+		if self.info_callback is not None:
+			self.info_callback(depth, score, time.time() - self.search_start_time, self.stats.total_nodes, [move])
+
+	# Iterative Deepening
+	# pns_nodes > 0 lets a winning search try to prove the mate directly with that many PNS expansions
+	# stats_file appends one JSON line of SearchStats per finished iteration
+	# time_limit is a hard limit in seconds, a time_manager (timeman.TimeManager, already started) replaces it
+	# max_nodes caps the total nodes searched (checked from the second iteration on, like the time limit)
+	# on_info(depth, score, elapsed, nodes, pv) is called after every iteration and on new best root moves
+	# fast_eval searches with evaluate_fast, None = when panicking or short of time (see wants_fast_eval)
+	def iterative_deepening(self, board: chess.Board, max_depth: int = 50,
+							time_limit:float = None, panic: bool = False, pns_nodes: int = 0,
+							stats_file: Optional[str] = None, time_manager=None, on_info=None,
+							max_nodes: Optional[int] = None, fast_eval: Optional[bool] = None):
+		max_depth = min(max_depth, self.max_depth)
+		if fast_eval is None:
+			budget = time_manager.soft_limit if time_manager is not None else time_limit
+			fast_eval = panic or self.wants_fast_eval(budget)
+		self.evaluate = evaluate_fast if fast_eval else evaluate
+		if panic:
+			max_depth = min(max_depth, PANIC_MAX_DEPTH + (FAST_EVAL_EXTRA_DEPTH if fast_eval else 0))
+
+		start_time = time.time()
+		self.deadline = None
+		self.node_limit = None
+		self.info_callback = on_info
+		self.search_start_time = start_time
+
+		# an aborted iteration leaves its moves on the board, so search on a copy
+		search_board = board.copy()
+		completed_depth = 0
+		exact = True
+		self.stats.reset()
+		self.stats.fast_eval = fast_eval
+		if fast_eval:
+			log("[Fast eval] short of time, searching with evaluate_fast")
+		tt_probes, tt_hits = self.tt.probes, self.tt.hits
+		last_nodes = last_qnodes = 0
+
+		best_move = None
+		best_score = -float("inf") 
+		pv = []
+
+		window = ASPIRATION_WINDOW if not panic else ASPIRATION_BOUND
+		pns_tried = False
+
+		# the time manager's limits can change under us (ponderhit), so always ask it
+		def hard_deadline():
+			if time_manager is not None:
+				return time_manager.deadline()
+			if time_limit is not None:
+				return start_time + time_limit
+			return None
+
+		def time_up():
+			limit = hard_deadline()
+			if limit is None:
+				return False
+			return time.time() >= limit
+
+		# inside the tablebases there's nothing to search, play the fastest win (or slowest loss)
+		if self.tb is not None and self.tb.covers(board):
+			line = self.tb_line(board, max_depth)
+			if line is not None:
+				result, pv = line
+				best_score = tb_score(result, board.turn, 0)
+				self.stats.tb_hits += 1
+				self.stats.time_taken = time.time() - start_time
+				log(f"[Tablebase] score={best_score} best_move={pv[0]}")
+				if on_info is not None:
+					on_info(1, best_score, self.stats.time_taken, self.stats.total_nodes, pv)
+				self.info_callback = None
+				return SearchResult(best_move=pv[0], score=best_score, depth=1,
+									time_taken=self.stats.time_taken, pv=pv, stats=self.stats)
+
+		# reduce max depth at endgame situation
+		num_pieces = len(board.piece_map())
+		if num_pieces <= 6: 
+			max_depth = min(max_depth, 10)
+
+		for depth in range(1, max_depth + 1):
+			if time_up():
 				break
 
-	# determine TT flag relative to the original window
-	if m_eval <= orig_alpha:
-		flag = "UPPERBOUND"
-	elif m_eval >= orig_beta:
-		flag = "LOWERBOUND"
-	else:
-		flag = "EXACT"    
-	# store remaining depth (depth is depth_remaining)
-	TT.store(board, depth, m_eval, flag, best_move=best_move)
-
-	return m_eval, best_move
-     
-# Iterative Deepening
-def iterative_deepening(board: chess.Board, max_depth: int = 50,
-						time_limit:float = None, panic: bool = False):
-	if panic:
-		max_depth = min(max_depth, 4)
-
-	start_time = time.time()
-	# stats.reset()
-
-	best_move = None
-	best_score = -float("inf") 
-	pv = []
-	
-	window = 75 if not panic else 99999999
-	
-	def time_up():
-		if time_limit is None:
-			return False
-		return (time.time() - start_time) >= time_limit
-	
-	# reduce max depth at endgame situation
-	num_pieces = len(board.piece_map())
-	if num_pieces <= 6: 
-		max_depth = min(max_depth, 10)
-		
-	for depth in range(1, max_depth + 1):
-		if time_up():
-			break
-
-		if depth == 1 or best_move is None:
-			alpha = -999999   
-			beta = 999999
-		else:
-			alpha = best_score - window
-			beta = best_score + window
-			
-		score, move = minimax(board, depth, alpha, beta, max_player=board.turn, depth_from_root=0, pv=pv, panic=panic)  
-		if score <= alpha and not time_up():
-			alpha = -float("inf")
-			beta = float("inf")
-			score, move = minimax(board, depth, alpha, beta, max_player=board.turn, depth_from_root=0, pv=pv,panic=panic)
-		elif score >= beta and not time_up():
-			alpha = -float("inf")
-			beta = float("inf")
-			score, move = minimax(board, depth, alpha, beta, max_player=board.turn, depth_from_root=0, pv=pv,panic=panic)
-			
-		# I changed how minimax works so it returns the best move itself, so ima comment this out
-		# moves = list(forced_legal_moves(board))
-		# if moves:
-		# 	best_move = max(
-		# 		moves, 
-		# 		key = lambda mv: TT.lookup(board, mv).score if TT.lookup(board, mv) else -999999
-		# 		)
-		# else:
-		# 	best_move = None
-
-		best_move = move
-		best_score = score
-
-		# PV stuff: build a PV for this depth (validate moves and avoid cycles)
-		local_pv = []
-		board_copy = board.copy()
-		next_move = best_move
-		visited = set()
-		MAX_PV = max(1, depth)
-
-		while next_move and len(local_pv) < MAX_PV:
-			# ensure the candidate is legal in the current position
-			if next_move not in board_copy.legal_moves:
+			# aspiration window around the last score, the first iteration searches everything
+			delta = window
+			if depth == 1 or best_move is None:
+				alpha = -ASPIRATION_BOUND
+				beta = ASPIRATION_BOUND
+			else:
+				alpha = max(best_score - delta, -ASPIRATION_BOUND)
+				beta = min(best_score + delta, ASPIRATION_BOUND)
+
+			# the hard limits hold from the first iteration on, never flag for a deeper move
+			self.deadline = hard_deadline()
+			self.node_limit = max_nodes
+
+			# a move that failed high for the side to move is better than the last best move,
+			# even if the re-search to get its exact score runs out of time
+			fail_high = None
+			try:
+				while True:
+					score, move = self.minimax(search_board, depth, alpha, beta, max_player=board.turn, depth_from_root=0, pv=pv, panic=panic)
+					if score <= alpha and alpha > -ASPIRATION_BOUND:
+						# fail low: only the lower bound moves, by a growing step (mates go straight to the end)
+						fail_high = (move, score, list(self.pv_table[0])) if board.turn == chess.BLACK and move else None
+						alpha = max(score - delta, -ASPIRATION_BOUND) if abs(score) < 29000 else -ASPIRATION_BOUND
+					elif score >= beta and beta < ASPIRATION_BOUND:
+						fail_high = (move, score, list(self.pv_table[0])) if board.turn == chess.WHITE and move else None
+						beta = min(score + delta, ASPIRATION_BOUND) if abs(score) < 29000 else ASPIRATION_BOUND
+					else:
+						break
+					delta = int(delta * ASPIRATION_GROWTH)
+					log(f"[Depth {depth}] aspiration re-search [{alpha}, {beta}]")
+			except SearchAborted:
+				log(f"[Depth {depth}] aborted")
+				if fail_high is not None:
+					best_move, best_score, pv = fail_high
+					exact = False
+					if not pv or pv[0] != best_move:
+						pv = [best_move]
+					log(f"[Depth {depth}] playing fail-high move {best_move}")
 				break
 
-			local_pv.append(next_move)
-			board_copy.push(next_move)
+			# I changed how minimax works so it returns the best move itself, so ima comment this out
+			# moves = list(forced_legal_moves(board))
+			# if moves:
+			# 	best_move = max(
+			# 		moves, 
+			# 		key = lambda mv: self.tt.lookup(board, mv).score if self.tt.lookup(board, mv) else -999999
+			# 		)
+			# else:
+			# 	best_move = None
+
+			best_move = move
+			best_score = score
+			completed_depth = depth
+
+			# the root's line from the triangular PV table, the next iteration searches it first
+			pv = list(self.pv_table[0])
+			if not pv or pv[0] != best_move:
+				pv = [best_move] if best_move else []
+
+			elapsed = time.time() - start_time
+
+			# this iteration's share of the counters
+			prev = self.stats.iterations[-1] if self.stats.iterations else None
+			iteration = IterationStats(
+				depth=depth, score=score,
+				nodes=self.stats.total_nodes - last_nodes, qnodes=self.stats.qnodes - last_qnodes,
+				time=elapsed - (prev.elapsed if prev else 0.0), elapsed=elapsed, ebf=0.0)
+			if prev and prev.nodes:
+				iteration.ebf = iteration.nodes / prev.nodes
+			self.stats.iterations.append(iteration)
+			last_nodes, last_qnodes = self.stats.total_nodes, self.stats.qnodes
+			self.stats.time_taken = elapsed
+			self.stats.tt_probes, self.stats.tt_hits = self.tt.probes - tt_probes, self.tt.hits - tt_hits
+			self.stats.hashfull = self.tt.hashfull()
+
+			if stats_file is not None:
+				import json
+				with open(stats_file, "a") as f:
+					f.write(json.dumps(dict(asdict(iteration), total_nodes=self.stats.total_nodes, nps=self.stats.nps,
+											tt_hit_rate=self.stats.tt_hit_rate, beta_cutoffs=self.stats.beta_cutoffs,
+											first_move_cutoff_rate=self.stats.first_move_cutoff_rate, hashfull=self.stats.hashfull,
+											best_move=best_move.uci() if best_move else None)) + "\n")
+
+			log(f"[Depth {depth}] score={score} best_move={best_move} "
+					f"time={elapsed:.2f}s nodes={self.stats.total_nodes} nps={self.stats.nps} hashfull={self.stats.hashfull}")
+			if on_info is not None:
+				on_info(depth, score, elapsed, self.stats.total_nodes, pv)
+
+			if abs(score) > 29000:
+				log(f"Mate confirmed at depth {depth}")
+				break
 
-			# simple cycle protection via zobrist
-			zob = chess.polyglot.zobrist_hash(board_copy)
-			if zob in visited:
+			# score says we're crushing, see if there's a forced mate instead of deepening forever
+			mover_score = score if board.turn == chess.WHITE else -score
+			if pns_nodes and not pns_tried and mover_score >= PNS_TRIGGER_SCORE and not time_up():
+				pns_tried = True
+				limit = hard_deadline()
+				remaining = None if limit is None else limit - time.time()
+				import pns
+				proof = pns.solve(board, max_nodes=pns_nodes, time_limit=remaining, order_moves=self.order_moves)
+				if proof.status == pns.PROVEN:
+					best_move = proof.best_move
+					best_score = PNS_MATE_SCORE if board.turn == chess.WHITE else -PNS_MATE_SCORE
+					exact = False
+					pv = proof.pv
+					log(f"Mate proven by PNS ({proof.nodes} nodes)")
+					if on_info is not None:
+						on_info(depth, best_score, time.time() - start_time, self.stats.total_nodes, pv)
+					break
+
+			if time_manager is not None:
+				time_manager.iteration_done(best_move)
+				if time_manager.should_stop(iteration.time, iteration.ebf):
+					break
+			elif time_up():
 				break
-			visited.add(zob)
-
-			entry = TT.lookup(board_copy)
-			next_move = entry.best_move if entry and entry.best_move else None
-
-		# assign PV for this depth (don't accumulate across depths)
-		pv = local_pv
-	
-		
-		elapsed = time.time() - start_time
-		
-		print(f"[Depth {depth}] score={score} best_move={best_move} "
-				f"time={elapsed:.2f}s")
-
-		if abs(score) > 29000:
-			print(f"Mate confirmed at depth {depth}")
-			break
-		
-		if time_up():
-			break
-			
-	return SearchResult(best_move = best_move, score = best_score, depth = depth,
-						#nodes_searched = stats.nodes, 
-						time_taken = time.time() - start_time, pv=pv)
-					
-# Quiescence Search					
-def quiescence_search(board: chess.Board, alpha: int, beta: int, maximizing_player,
-						depth_left: int = None, depth_from_root: int = 0) -> int:
-
-	stand_pat = evaluate(board, depth_from_root)
-
-	# If a depth limit is provided and exhausted, stop
-	if depth_left is not None and depth_left <= 0:
-		return stand_pat
-
-	if maximizing_player:
-		if stand_pat >= beta:
-			return beta
-		if stand_pat > alpha:
-			alpha = stand_pat
-	else:
-		if stand_pat <= alpha:
-			return alpha
-		if stand_pat < beta:
-			beta = stand_pat
-		
-	moves = forced_legal_moves(board)
-	tactical_moves = []
-	
-	for move in moves:
-		if board.is_capture(move):
-			tactical_moves.append(move)
-		else:
-			board.push(move)
-			# direct check after the move
-			gives_check = board.is_check()
-			# robust discovered-check detection: check whether the mover now attacks the opponent king
-			mover_color = not board.turn
-			opp_king_sq = board.king(board.turn)
-			if opp_king_sq is not None and board.is_attacked_by(mover_color, opp_king_sq):
-				gives_check = True
-			board.pop()
-			if gives_check:
-				tactical_moves.append(move)
-	
-	if not tactical_moves:
-		return stand_pat
 
-	for move in tactical_moves:
-		board.push(move)
-		next_depth = depth_left - 1 if depth_left is not None else None
-		score = quiescence_search(board, alpha, beta, not maximizing_player, next_depth)
-		board.pop()
+		self.deadline = None
+		self.node_limit = None
+		self.info_callback = None
+
+		if best_move is None:
+			# out of time before the first iteration finished: the first ordered move beats losing on time
+			moves = forced_legal_moves(board)
+			if moves:
+				best_move = self.order_moves(board, moves, depth_from_root=0)[0]
+				best_score = self.evaluate(board, 0, moves)
+				pv = [best_move]
+				exact = False
+				log(f"[Depth 1] aborted, playing {best_move}")
+
+		self.stats.time_taken = time.time() - start_time
+		self.stats.tt_probes, self.stats.tt_hits = self.tt.probes - tt_probes, self.tt.hits - tt_hits
+		if not fast_eval and completed_depth > 1:
+			self.full_eval_nps = self.stats.nps
+
+		return SearchResult(best_move = best_move, score = best_score, depth = completed_depth,
+							time_taken = self.stats.time_taken, pv=pv, stats=self.stats, exact=exact)
+
+	# Quiescence Search					
+	def quiescence_search(self, board: chess.Board, alpha: int, beta: int, maximizing_player,
+							depth_left: int = None, depth_from_root: int = 0, moves=None) -> int:
+		self.stats.qnodes += 1
+		self.check_limits()
+
+		if moves is None:
+			moves = forced_legal_moves(board)
+		stand_pat = self.evaluate(board, depth_from_root, moves)
+
+		# If a depth limit is provided and exhausted, stop
+		if depth_left is not None and depth_left <= 0:
+			return stand_pat
 
 		if maximizing_player:
-			if score >= beta:
+			if stand_pat >= beta:
 				return beta
-			if score > alpha:
-				alpha = score
+			if stand_pat > alpha:
+				alpha = stand_pat
 		else:
-			if score <= alpha:
+			if stand_pat <= alpha:
 				return alpha
-			if score < beta:
-				beta = score
-	
-	return alpha if maximizing_player else beta
-
-# Move Ordering	
-def order_moves(board: chess.Board, moves: List[chess.Move], 
-				pv_move: Optional[chess.Move] = None, depth_from_root: int = 0) -> List[chess.Move]:
-	PIECE_VALUES = {chess.PAWN: 100, 
-					chess.KNIGHT: 320,
-					chess.BISHOP: 330,
-					chess.ROOK: 500,
-					chess.QUEEN: 900,
-					chess.KING: 20000,}
-	
-	# transpo table lookup
-	tt_entry = TT.lookup(board)
-	tt_move = tt_entry.best_move if tt_entry else None
-
-	# Extract killer moves for this depth
-
-	if len(board.piece_map()) > 6:
-		km1, km2 = killer_moves[depth_from_root]
-	else:
-		km1, km2 = None, None
-	
-	def score(move: chess.Move) -> int:
-		s = 0
-		if pv_move is not None and move == pv_move:
-			return 2_000_000
-			
-		if tt_move is not None and move == tt_move:
-			return 1_500_000
-		if km1 is not None and move == km1:
-			return 1_000_000
-		if km2 is not None and move == km2:
-			return 900_000
-			
-		if board.is_capture(move):
-			victim_piece = board.piece_at(move.to_square)
-			attacker_piece = board.piece_at(move.from_square)
-			
-			victim_value = PIECE_VALUES[victim_piece.piece_type] if victim_piece else PIECE_VALUES[chess.PAWN]	
-			attacker_value = PIECE_VALUES[attacker_piece.piece_type] if attacker_piece else 0
-
-			s += 50_000 + 10 * victim_value - attacker_value
-			
+			if stand_pat < beta:
+				beta = stand_pat
+
+		tactical_moves = []
+
+		for move in moves:
+			if board.is_capture(move):
+				tactical_moves.append(move)
+			else:
+				board.push(move)
+				# direct check after the move
+				gives_check = board.is_check()
+				# robust discovered-check detection: check whether the mover now attacks the opponent king
+				mover_color = not board.turn
+				opp_king_sq = board.king(board.turn)
+				if opp_king_sq is not None and board.is_attacked_by(mover_color, opp_king_sq):
+					gives_check = True
+				board.pop()
+				if gives_check:
+					tactical_moves.append(move)
+
+		if not tactical_moves:
+			return stand_pat
+
+		for move in tactical_moves:
 			board.push(move)
-			if board.is_check():
-				s += 20_000
+			next_depth = depth_left - 1 if depth_left is not None else None
+			score = self.quiescence_search(board, alpha, beta, not maximizing_player, next_depth)
 			board.pop()
-			
-			if move.promotion:
-				s += 40_000 + PIECE_VALUES.get(move.promotion, 0)
-				
+
+			if maximizing_player:
+				if score >= beta:
+					return beta
+				if score > alpha:
+					alpha = score
+			else:
+				if score <= alpha:
+					return alpha
+				if score < beta:
+					beta = score
+
+		return alpha if maximizing_player else beta
+
+	# Move Ordering	
+	# tt_entry: what minimax's own probe of this position found (None = a miss), so it isn't probed twice
+	def order_moves(self, board: chess.Board, moves: List[chess.Move], 
+					pv_move: Optional[chess.Move] = None, depth_from_root: int = 0, key=None,
+					tt_entry=NOT_PROBED) -> List[chess.Move]:
+		PIECE_VALUES = {chess.PAWN: 100, 
+						chess.KNIGHT: 320,
+						chess.BISHOP: 330,
+						chess.ROOK: 500,
+						chess.QUEEN: 900,
+						chess.KING: 20000,}
+
+		# transpo table lookup
+		if tt_entry is NOT_PROBED:
+			tt_entry = self.tt.lookup(board, key)
+		tt_move = tt_entry.best_move if tt_entry else None
+
+		# Extract killer moves for this depth
+
+		if len(board.piece_map()) > 6:
+			km1, km2 = self.killer_moves[depth_from_root]
+		else:
+			km1, km2 = None, None
+
+		def score(move: chess.Move) -> int:
+			s = 0
+			if pv_move is not None and move == pv_move:
+				return 2_000_000
+
+			if tt_move is not None and move == tt_move:
+				return 1_500_000
+			if km1 is not None and move == km1:
+				return 1_000_000
+			if km2 is not None and move == km2:
+				return 900_000
+
+			if board.is_capture(move):
+				victim_piece = board.piece_at(move.to_square)
+				attacker_piece = board.piece_at(move.from_square)
+
+				victim_value = PIECE_VALUES[victim_piece.piece_type] if victim_piece else PIECE_VALUES[chess.PAWN]	
+				attacker_value = PIECE_VALUES[attacker_piece.piece_type] if attacker_piece else 0
+
+				s += 50_000 + 10 * victim_value - attacker_value
+
+				board.push(move)
+				if board.is_check():
+					s += 20_000
+				board.pop()
+
+				if move.promotion:
+					s += 40_000 + PIECE_VALUES.get(move.promotion, 0)
+
+				return s
 			return s
-		return s
-		
-	return sorted(moves, key = score, reverse = True) 
+
+		return sorted(moves, key = score, reverse = True)
+
+
+# The engine's searcher, and the module-level names the protocols and tests have always used
+TT = Transposition_Table(size=2000000)
+searcher = Searcher(tt=TT)
+stats = searcher.stats
+stop_signal = searcher.stop_signal
+
+def minimax(*args, **kwargs):
+	return searcher.minimax(*args, **kwargs)
+
+def iterative_deepening(*args, **kwargs):
+	return searcher.iterative_deepening(*args, **kwargs)
+
+def quiescence_search(*args, **kwargs):
+	return searcher.quiescence_search(*args, **kwargs)
+
+def order_moves(*args, **kwargs):
+	return searcher.order_moves(*args, **kwargs)
@@ -0,0 +1,101 @@
+import sys
+import time
+import chess
+
+import bbsearch
+from bbsearch import iterative_deepening, TT
+
+# python engine.py bench [depth] [hash] [threads]
+#
+# Searches a fixed set of positions to a fixed depth with a cold TT each time and no clock,
+# so the total node count is a signature of the search: a change that should be a pure
+# speedup has to leave it alone, anything that changes what gets searched changes it.
+# NPS is the speed figure to compare between builds.
+
+BENCH_DEPTH = 3
+BENCH_HASH_MB = 16
+# per-position cap so a blow-up in one position can't make the bench run forever,
+# it's a node count so the signature stays deterministic
+BENCH_MAX_NODES = 20000
+
+BENCH_FENS = [
+    # forced-capture positions from forced chess games, each in the middle of a capture chain
+    # (the side to move has only captures, and the capture leads to more forced captures)
+    # openings and early exchanges
+    "r1bqkbnr/p1pppppp/8/1p6/8/B3P3/P1QP1PPP/RN2KBNR w KQkq - 0 5",
+    "rn1qkbnr/p3ppp1/1pp5/7p/1Pp5/N4P1b/P2PP1P1/R1BQKBNR w KQkq - 0 7",
+    "1nbqkb1r/rBpp1ppp/4p3/p4P2/8/N5PP/PPPPQP2/R1B1K1NR b KQk - 0 8",
+    "1nbqkb1r/rppp1ppp/4p3/p4P2/8/N5PP/PPPPQPB1/R1B1K1NR w KQk - 0 8",
+    "rn2kbnr/3pppQp/8/p7/8/4P3/PPPP1Pbq/R1B1KBNR w KQkq - 0 7",
+    "rnb1kbnr/pp1pp1p1/2p4B/8/1P6/3q2P1/P1P2P1P/RN1QKBNR w KQkq - 0 7",
+    "r1bk3r/ppppbp1p/6p1/8/n7/2P2P2/RPQPP1BP/1NB1K2R w K - 0 11",
+    "rn2kbn1/p3pp1r/1pp5/6pp/1PN5/5P1R/P2QP1P1/R1B1KBN1 w Qq - 1 10",
+    # middlegames
+    "2b1k2r/5pp1/4pn1p/qp1p4/1P5P/6P1/1B1PPP2/1N1QKBNR w Kk - 1 12",
+    "r1bqkbnr/pp1pp1Qp/8/8/8/2P4N/3PnPPP/RN2KB1R w KQkq - 0 8",
+    "r2q1b1r/p1pkB1pp/1p6/8/1P6/8/P1P1PPbP/RN2KB1R w KQ - 0 10",
+    "2b1k2r/5pp1/4pB1p/qp1p4/1P5P/6P1/3PPP2/1N1QKBNR b Kk - 0 12",
+    "1rb1k2r/p2p1p1p/7p/1p1p4/P7/1P1BP3/2P3P1/RN2K1N1 w Qk - 0 13",
+    "BR5r/p1pkpp1p/7p/3p4/2P5/3P4/P2NNP1P/4K2R w K - 1 13",
+    "r3k1n1/4p3/pp4p1/5p2/P2p1P1r/1P2P2N/3B4/R2Q1K1R b - - 0 18",
+    "2bqk3/rp1ppp2/n7/8/1Pp5/8/P1PBPPP1/R2QKB2 b Q b3 0 11",
+    "4kr2/r1pqp2p/1p5b/p7/P5P1/8/1PP2P2/1N3KNR b - - 0 16",
+    "r7/p4p2/3bk1pr/Q6p/P3N3/7P/R2PPP1R/4K1N1 w - - 1 20",
+    "2bqk3/4pp2/rp6/3p4/P3P3/6P1/1b1P1P2/RNB1K3 w Q - 0 15",
+    "2bqk3/4pp2/rp6/3P4/P7/6P1/1b1P1P2/RNB1K3 b Q - 0 15",
+    # endgames
+    "1n3bn1/3pk1p1/b7/8/1p3P2/P2P4/8/1RB1KB2 w - - 0 19",
+    "r3qb1r/4k3/Bp6/6p1/P2N4/1b4P1/R4P2/2K5 b - - 0 24",
+    "4k3/3p1p2/2p1pnp1/8/2P2KPN/P7/3N4/2B2B1r b - - 1 24",
+    "1n3k2/2p1p1p1/3p3n/8/8/B3P3/2PP1P2/1qN1K3 b - - 1 19",
+    "3q2k1/2pn4/8/r3p3/5P2/8/1B1P4/1N2K1N1 w - - 0 19",
+    "8/1k6/p5nr/1Pp4p/P7/1KR2P2/8/8 w - - 0 40",
+    "1Qb3n1/3pkpp1/8/4P3/8/5NP1/3rP3/5K2 w - - 0 19",
+    "4kb2/8/1n6/p1pn4/1P6/P7/8/R3K3 b Q - 0 24",
+    "4r3/2k1pR2/3p4/5p2/8/4n2P/5P2/4K3 w - - 1 26",
+    "6nr/5pkp/1p6/2p3N1/8/8/8/5K1R w - - 1 24",
+]
+
+
+def reset_search_state():
+    # every position starts from the same state, whatever ran before it
+    bbsearch.searcher.clear()
+
+
+def bench(depth=BENCH_DEPTH, hash_mb=BENCH_HASH_MB, threads=1, fens=BENCH_FENS, out=sys.stdout):
+    """Runs the bench, returns (total nodes, seconds)."""
+    if threads != 1:
+        print(f"bench: the search is single threaded, ignoring threads {threads}", file=out)
+    TT.resize_mb(hash_mb)
+
+    total_nodes = 0
+    total_time = 0.0
+    for i, fen in enumerate(fens, 1):
+        board = chess.Board(fen)
+        reset_search_state()
+        start = time.perf_counter()
+        res = iterative_deepening(board, max_depth=depth, max_nodes=BENCH_MAX_NODES)
+        elapsed = time.perf_counter() - start
+
+        nodes = res.stats.total_nodes
+        total_nodes += nodes
+        total_time += elapsed
+        print(f"Position {i:2}/{len(fens)}: nodes {nodes:8} time {elapsed * 1000:8.0f} ms "
+              f"nps {int(nodes / elapsed) if elapsed > 0 else 0:7} best {res.best_move}  {fen}", file=out)
+
+    print("=" * 40, file=out)
+    print(f"Total time (ms) : {total_time * 1000:.0f}", file=out)
+    print(f"Nodes searched  : {total_nodes}", file=out)
+    print(f"Nodes/second    : {int(total_nodes / total_time) if total_time > 0 else 0}", file=out)
+    return total_nodes, total_time
+
+
+def main(args):
+    # bench [depth] [hash] [threads], positional like other engines' bench commands
+    depth = int(args[0]) if len(args) > 0 else BENCH_DEPTH
+    hash_mb = int(args[1]) if len(args) > 1 else BENCH_HASH_MB
+    threads = int(args[2]) if len(args) > 2 else 1
+    bench(depth, hash_mb, threads)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+
+# run from anywhere: python benchmarks/microbench.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chess
+import chess.polyglot
+import evaluate
+from bbsearch import order_moves, quiescence_search
+from forced_chess import forced_legal_moves
+from transposition import Transposition_Table
+
+# Microbenchmarks of the search's hot paths, one subsystem at a time, so when the bench's
+# NPS moves we can see which one moved it.
+#
+# Every benchmark is one pass over a set of positions (opening, middlegame, endgame). The
+# pass is repeated in a loop calibrated to take about --min-time, a few warmup loops go
+# first, and the median and interquartile range of --repeats loops are reported per pass.
+#
+#   python benchmarks/microbench.py --save baseline.json
+#   python benchmarks/microbench.py --baseline baseline.json --threshold 0.1
+#
+# exits with 1 when anything got slower than the baseline by more than the threshold.
+
+POSITIONS = {
+    "opening": [
+        chess.STARTING_FEN,
+        "r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4",
+        "rnbqkb1r/pp2pppp/3p1n2/8/3NP3/8/PPP2PPP/RNBQKB1R w KQkq - 1 5",
+        "r1bqk2r/pppp1ppp/2n2n2/2b1p3/2B1P3/2P2N2/PP1P1PPP/RNBQK2R w KQkq - 1 5",
+    ],
+    "middlegame": [
+        "4rrk1/pp1n3p/3q2pQ/2p1pb2/2PP4/2P3N1/P2B2PP/4RRK1 b - - 7 19",
+        "rq3rk1/ppp2ppp/1bnpb3/3N2B1/3NP3/7P/PPPQ1PP1/2KR3R w - - 7 14",
+        "r3r1k1/2p2ppp/p1p1bn2/8/1q2P3/2NPQN2/PPP3PP/R4RK1 b - - 2 15",
+        "4r1k1/r1q2ppp/ppp2n2/4P3/5Rb1/1N1BQ3/PPP3PP/R5K1 w - - 1 17",
+    ],
+    "endgame": [
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 11",
+        "3b4/5kp1/1p1p1p1p/pP1PpP1P/P1P1P3/3KN3/8/8 w - - 0 1",
+        "8/pp2r1k1/2p1p3/3pP2p/1P1P1P1P/P5KR/8/8 w - - 0 1",
+        "6k1/6p1/P6p/r1N5/5p2/7P/1b3PP1/4R1K1 w - - 0 1",
+    ],
+}
+
+MIN_TIME = 0.05 # seconds one timed loop should take
+REPEATS = 9
+WARMUP = 2
+QSEARCH_DEPTH = 2
+
+
+def calibrate(fn, min_time=MIN_TIME):
+    """Passes per loop so that a loop takes at least min_time (like timeit's autorange)."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= min_time:
+            return number
+        number *= 2
+
+def measure(fn, min_time=MIN_TIME, repeats=REPEATS, warmup=WARMUP):
+    """Seconds per pass: dict of median, iqr, passes per loop and loops timed."""
+    number = calibrate(fn, min_time)
+    for _ in range(warmup):
+        for _ in range(number):
+            fn()
+
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+
+    q1, _, q3 = statistics.quantiles(samples, n=4)
+    return {"median": statistics.median(samples), "iqr": q3 - q1, "number": number, "repeats": repeats}
+
+
+# Benchmarks: name -> setup(boards) returning the function that does one pass
+def bench_movegen(boards):
+    def run():
+        for board in boards:
+            forced_legal_moves(board)
+    return run
+
+def bench_zobrist(boards):
+    def run():
+        for board in boards:
+            chess.polyglot.zobrist_hash(board)
+    return run
+
+def bench_evaluate(boards):
+    moves = [forced_legal_moves(board) for board in boards]
+    def run():
+        for board, board_moves in zip(boards, moves):
+            evaluate.evaluate(board, 0, board_moves)
+    return run
+
+def bench_evaluate_fast(boards):
+    moves = [forced_legal_moves(board) for board in boards]
+    def run():
+        for board, board_moves in zip(boards, moves):
+            evaluate.evaluate_fast(board, 0, board_moves)
+    return run
+
+def eval_term(term):
+    # one evaluate term on its own, with what evaluate() would hand it
+    def setup(boards):
+        args = []
+        for board in boards:
+            phase = evaluate.compute_phase(board)
+            if term in (evaluate.material_and_piece_square_value, evaluate.king_safety_value):
+                args.append((board, phase))
+            elif term is evaluate.mobility_value:
+                args.append((board, forced_legal_moves(board)))
+            else:
+                args.append((board,))
+        def run():
+            for a in args:
+                term(*a)
+        return run
+    return setup
+
+def bench_pawn_value_uncached(boards):
+    # pawn_value minus the pawn hash, what a miss costs
+    def run():
+        for board in boards:
+            evaluate.pawn_promotion_bonus_value(board) + 0.5 * evaluate.pawn_structure_value(board)
+    return run
+
+def bench_order_moves(boards):
+    args = [(board, forced_legal_moves(board), chess.polyglot.zobrist_hash(board)) for board in boards]
+    def run():
+        for board, moves, key in args:
+            order_moves(board, moves, depth_from_root=1, key=key)
+    return run
+
+def bench_qsearch(boards):
+    boards = [board.copy() for board in boards]
+    def run():
+        for board in boards:
+            quiescence_search(board, -999999, 999999, maximizing_player=board.turn,
+                              depth_left=QSEARCH_DEPTH, depth_from_root=1)
+    return run
+
+def bench_tt(boards):
+    # store then look up every position of the set, in a table of its own
+    tt = Transposition_Table(size=1 << 16)
+    keys = [chess.polyglot.zobrist_hash(board) for board in boards]
+    moves = [forced_legal_moves(board)[0] for board in boards]
+    def run():
+        for board, key, move in zip(boards, keys, moves):
+            tt.store(board, 4, 0, "EXACT", best_move=move, key=key)
+        for board, key in zip(boards, keys):
+            tt.lookup(board, key)
+    return run
+
+BENCHMARKS = {
+    "movegen": bench_movegen,
+    "zobrist": bench_zobrist,
+    "evaluate": bench_evaluate,
+    "evaluate_fast": bench_evaluate_fast,
+    "eval.material_pst": eval_term(evaluate.material_and_piece_square_value),
+    "eval.king_safety": eval_term(evaluate.king_safety_value),
+    "eval.mobility": eval_term(evaluate.mobility_value),
+    "eval.capture_chain": eval_term(evaluate.capture_chain_value),
+    "eval.pawn": eval_term(evaluate.pawn_value),
+    "eval.pawn_uncached": bench_pawn_value_uncached,
+    "eval.aggressive_play": eval_term(evaluate.aggressive_play_value),
+    "eval.trap_play": eval_term(evaluate.trap_play_value),
+    "eval.phase": eval_term(evaluate.compute_phase),
+    "order_moves": bench_order_moves,
+    "qsearch": bench_qsearch,
+    "tt": bench_tt,
+}
+
+
+def run_benchmarks(names=None, min_time=MIN_TIME, repeats=REPEATS, warmup=WARMUP, log=None):
+    """{"<benchmark>/<position set>": measure() result} for the benchmarks in names (default all)."""
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if names and not any(n in name for n in names):
+            continue
+        for phase, fens in POSITIONS.items():
+            boards = [chess.Board(fen) for fen in fens]
+            result = measure(setup(boards), min_time, repeats, warmup)
+            results[f"{name}/{phase}"] = result
+            if log is not None:
+                log(f"{name + '/' + phase:32} {result['median'] * 1e6:12.1f} us  +/- {result['iqr'] * 1e6:9.1f} (IQR)")
+    return results
+
+def compare(results, baseline, threshold):
+    """[(name, ratio)] of the benchmarks more than threshold slower than the baseline, and all ratios."""
+    ratios = {}
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old and old["median"] > 0:
+            ratios[name] = result["median"] / old["median"]
+    regressions = [(name, ratio) for name, ratio in ratios.items() if ratio > 1 + threshold]
+    return regressions, ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the search's hot paths")
+    parser.add_argument("filter", nargs="*", help="only benchmarks whose name contains one of these")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.filter, args.min_time, args.repeats, log=print)
+    output = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions, ratios = compare(results, baseline, args.threshold)
+        print()
+        for name, ratio in sorted(ratios.items(), key=lambda item: -item[1]):
+            flag = "  REGRESSION" if ratio > 1 + args.threshold else ""
+            print(f"{name:32} {ratio:6.2f}x{flag}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+
+# Engine startup latency: how long a freshly spawned engine takes to answer the handshake.
+# GUIs and the match runner time out engines that are slow to send feature done=1 (or uciok),
+# and a match spawns thousands of them, so this is worth keeping an eye on.
+#
+# Every run starts a new `python engine.py`, sends the handshake and times the reply. The
+# median and interquartile range of --runs runs are reported, plus the slowest imports of
+# `import engine` (python -X importtime) to see where the time goes.
+#
+#   python benchmarks/startup.py --save startup.json
+#   python benchmarks/startup.py --baseline startup.json --threshold 0.1
+#
+# exits with 1 when anything got slower than the baseline by more than the threshold.
+# Byte code caching matters a lot here (PYTHONDONTWRITEBYTECODE compiles every module on
+# every start), compare runs made with the same setting.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENGINE = os.path.join(ROOT, "engine.py")
+
+# run from anywhere: python benchmarks/startup.py
+sys.path.insert(0, ROOT)
+
+from benchmarks.microbench import compare
+
+RUNS = 15
+
+# name -> (engine arguments, handshake, reply that ends it)
+HANDSHAKES = {
+    "xboard": ([], ["xboard", "protover 2"], "feature done=1"),
+    "uci": (["--uci"], ["uci"], "uciok"),
+    # the first search too: the TT gets allocated and the search modules warm up
+    "first_move": ([], ["xboard", "protover 2", "new", "force",
+                        "setboard 6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1", "st 1", "go"], "move "),
+}
+
+
+def time_to_reply(args, commands, reply, engine=ENGINE):
+    """Seconds from spawning the engine until it prints a line starting with reply."""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, engine] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True, bufsize=1)
+    try:
+        proc.stdin.write("".join(cmd + "\n" for cmd in commands))
+        proc.stdin.flush()
+        for line in proc.stdout:
+            if line.startswith(reply):
+                return time.perf_counter() - start
+        raise RuntimeError(f"engine exited without replying {reply!r}")
+    finally:
+        proc.kill()
+        proc.wait()
+
+def measure(args, commands, reply, runs=RUNS):
+    """Seconds to reply: dict of median, iqr and runs."""
+    time_to_reply(args, commands, reply) # warm the OS caches (and the byte code, if it's written)
+    samples = [time_to_reply(args, commands, reply) for _ in range(runs)]
+    q1, _, q3 = statistics.quantiles(samples, n=4)
+    return {"median": statistics.median(samples), "iqr": q3 - q1, "runs": runs}
+
+def import_times(module="engine", top=12):
+    """[(cumulative seconds, module)] of the slowest imports of `import module`."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                         stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True).stderr
+    times = []
+    for line in out.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            times.append((int(parts[1]) / 1e6, parts[2].rstrip()))
+    times.sort(reverse=True)
+    return times[:top]
+
+
+def run_benchmarks(names=None, runs=RUNS, log=None):
+    """{handshake name: measure() result} for the handshakes in names (default all)."""
+    results = {}
+    for name, (args, commands, reply) in HANDSHAKES.items():
+        if names and name not in names:
+            continue
+        result = measure(args, commands, reply, runs)
+        results[name] = result
+        if log is not None:
+            log(f"{name:16} {result['median'] * 1000:8.1f} ms  +/- {result['iqr'] * 1000:6.1f} (IQR)")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Engine startup latency")
+    parser.add_argument("handshakes", nargs="*", help=f"only these of {', '.join(HANDSHAKES)}")
+    parser.add_argument("--runs", type=int, default=RUNS)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.handshakes, args.runs, log=print)
+    print()
+    print("slowest imports of `import engine` (cumulative):")
+    for seconds, module in import_times():
+        print(f"{seconds * 1000:8.1f} ms {module}")
+
+    output = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "bytecode_cache": not sys.dont_write_bytecode,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions, ratios = compare(results, baseline, args.threshold)
+        print()
+        for name, ratio in sorted(ratios.items(), key=lambda item: -item[1]):
+            flag = "  REGRESSION" if ratio > 1 + args.threshold else ""
+            print(f"{name:16} {ratio:6.2f}x{flag}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
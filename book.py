@@ -0,0 +1,48 @@
+import random
+import chess
+import chess.polyglot
+
+from forced_chess import forced_legal_moves
+
+# Polyglot opening book probed at the root before searching.
+# Books are built for (or filtered to) forced-capture rules, but we still only play
+# entries that are legal here, in case a book from normal chess sneaks in.
+
+class OpeningBook:
+    def __init__(self, path, selection="weighted", max_ply=20, rng=None):
+        self.path = path
+        self.selection = selection # "weighted" = random by weight, "best" = highest weight
+        self.max_ply = max_ply # stop using the book after this many half moves
+        self.rng = rng or random.Random()
+        self.reader = None
+
+    def open(self):
+        # mmap'd, so opening is cheap and the pages are shared between engine processes
+        if self.reader is None:
+            self.reader = chess.polyglot.open_reader(self.path)
+        return self.reader
+
+    def probe(self, board: chess.Board):
+        """Returns a book move for the position, or None when out of book."""
+        if board.ply() >= self.max_ply:
+            return None
+
+        forced = set(forced_legal_moves(board))
+        entries = [e for e in self.open().find_all(board) if e.move in forced]
+        if not entries:
+            return None
+
+        if self.selection == "best":
+            return max(entries, key=lambda e: e.weight).move
+
+        total = sum(e.weight for e in entries)
+        choice = self.rng.randint(0, total - 1)
+        for entry in entries:
+            choice -= entry.weight
+            if choice < 0:
+                return entry.move
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
@@ -0,0 +1,181 @@
+import os
+import io
+import argparse
+import multiprocessing
+from collections import defaultdict
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+from forced_chess import forced_legal_moves
+
+# Builds a polyglot .bin book for forced-capture chess out of PGN collections
+# (self-play games are saved as PGN too, see match.py).
+#
+# Map: every worker reads a slice of a PGN file and counts wins/draws/losses per
+# (zobrist key, move) from the side to move's point of view. Games are only followed
+# while their moves are legal under the forced-capture rules, so normal-chess
+# databases can be fed in and just contribute their forced-capture-legal openings.
+# Reduce: the counts are merged, turned into weights and written sorted by key, which
+# is what chess.polyglot.MemoryMappedReader binary searches on.
+
+MAX_BOOK_PLY = 30 # don't record positions deeper than this
+MIN_GAMES = 2 # a move needs to have been played this often to make it into the book
+CHUNK_BYTES = 16 * 1024 * 1024 # how much PGN one map task reads
+
+RESULT_INDEX = {"1-0": 0, "1/2-1/2": 1, "0-1": 2}
+
+
+def split_file(path, chunk_bytes=CHUNK_BYTES):
+    """Splits a PGN file into (path, start, end) byte ranges, each starting on a game."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        pos = chunk_bytes
+        while pos < size:
+            # move forward to the start of the next game's headers
+            f.seek(pos)
+            f.readline()
+            while True:
+                line_start = f.tell()
+                line = f.readline()
+                if not line:
+                    line_start = size
+                    break
+                if line.startswith(b"[Event "):
+                    break
+            if line_start >= size:
+                break
+            if line_start > bounds[-1]:
+                bounds.append(line_start)
+            pos = line_start + chunk_bytes
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def count_games(task, max_ply=MAX_BOOK_PLY):
+    """Map step: returns ({(key, raw_move): [wins, draws, losses]}, games read)."""
+    path, start, end = task
+    counts = defaultdict(lambda: [0, 0, 0])
+    games = 0
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    pgn = io.StringIO(data.decode("utf-8", errors="replace"))
+
+    while True:
+        game = chess.pgn.read_game(pgn)
+        if game is None:
+            break
+        result = RESULT_INDEX.get(game.headers.get("Result"))
+        if result is None:
+            continue # unfinished games don't tell us anything
+        games += 1
+
+        board = game.board()
+        for move in game.mainline_moves():
+            if board.ply() >= max_ply or move not in forced_legal_moves(board):
+                break
+            # results are from White's side, flip wins/losses when Black is to move
+            outcome = result if board.turn == chess.WHITE else 2 - result
+            counts[(chess.polyglot.zobrist_hash(board), encode_move(board, move))][outcome] += 1
+            board.push(move)
+
+    return dict(counts), games
+
+
+def encode_move(board: chess.Board, move: chess.Move) -> int:
+    # polyglot stores castling as king takes rook
+    move = board._to_chess960(move)
+    promotion = move.promotion - 1 if move.promotion else 0
+    return move.to_square | move.from_square << 6 | promotion << 12
+
+
+def merge_counts(total, counts):
+    """Reduce step: adds one worker's counts into the running total."""
+    for entry, (wins, draws, losses) in counts.items():
+        stats = total.get(entry)
+        if stats is None:
+            total[entry] = [wins, draws, losses]
+        else:
+            stats[0] += wins
+            stats[1] += draws
+            stats[2] += losses
+    return total
+
+
+def book_entries(total, min_games=MIN_GAMES):
+    """Turns the merged counts into sorted (key, raw_move, weight, learn) records."""
+    entries = []
+    for (key, raw_move), (wins, draws, losses) in total.items():
+        if wins + draws + losses < min_games:
+            continue
+        # usual polyglot weighting: 2 points a win, 1 a draw
+        weight = 2 * wins + draws
+        if weight == 0:
+            continue
+        entries.append((key, raw_move, weight, 0))
+
+    # weights have to fit 16 bits, scale per position so the ratios stay right
+    by_key = defaultdict(list)
+    for entry in entries:
+        by_key[entry[0]].append(entry)
+
+    records = []
+    for key in sorted(by_key):
+        group = by_key[key]
+        scale = max(1, max(e[2] for e in group) / 0xffff)
+        group = [(k, m, max(1, int(w / scale)), l) for k, m, w, l in group]
+        records.extend(sorted(group, key=lambda e: -e[2]))
+    return records
+
+
+def write_book(path, records):
+    with open(path, "wb") as f:
+        for record in records:
+            f.write(chess.polyglot.ENTRY_STRUCT.pack(*record))
+
+
+def build_book(inputs, output, workers=None, max_ply=MAX_BOOK_PLY, min_games=MIN_GAMES,
+               chunk_bytes=CHUNK_BYTES):
+    """Builds output from the PGN files in inputs, returns (games, entries written)."""
+    tasks = [task for path in inputs for task in split_file(path, chunk_bytes)]
+    workers = workers or os.cpu_count() or 1
+
+    total = {}
+    games = 0
+    if workers == 1 or len(tasks) == 1:
+        results = (count_games(task, max_ply) for task in tasks)
+        for counts, n in results:
+            merge_counts(total, counts)
+            games += n
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            args = [(task, max_ply) for task in tasks]
+            for counts, n in pool.starmap(count_games, args, chunksize=1):
+                merge_counts(total, counts)
+                games += n
+
+    records = book_entries(total, min_games)
+    write_book(output, records)
+    return games, len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a forced-capture polyglot book from PGN files")
+    parser.add_argument("inputs", nargs="+", help="PGN files (database or self-play games)")
+    parser.add_argument("-o", "--output", default="book.bin")
+    parser.add_argument("--workers", type=int, default=None, help="processes to use (default: all cores)")
+    parser.add_argument("--max-ply", type=int, default=MAX_BOOK_PLY, help="deepest position to record")
+    parser.add_argument("--min-games", type=int, default=MIN_GAMES, help="games a move needs to be kept")
+    parser.add_argument("--chunk-mb", type=int, default=CHUNK_BYTES // (1024 * 1024), help="PGN per map task")
+    args = parser.parse_args()
+
+    games, entries = build_book(args.inputs, args.output, workers=args.workers, max_ply=args.max_ply,
+                                min_games=args.min_games, chunk_bytes=args.chunk_mb * 1024 * 1024)
+    print(f"{games} games, {entries} entries written to {args.output}")
+
+if __name__ == "__main__":
+    main()
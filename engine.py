@@ -1,16 +1,26 @@
 import time
 import sys
+import argparse
+import threading
 import chess
 
 # from evaluate import evaluate
 from forced_chess import forced_legal_moves
-from bbsearch import iterative_deepening, TT
+import bbsearch
+from bbsearch import iterative_deepening
+from timeman import TimeManager
+from transposition import MAX_HASH_MB
 
 MAX_DEPTH = 50
+PNS_NODES = 500 # budget for proving mates once the search thinks we're winning big
 
 class WinBoardEngine:
-    def __init__(self):
+    FEATURES = "ping=1 setboard=1 colors=0 usermove=1 analyze=1 memory=1"
+
+    def __init__(self, book=None, cache=None):
         self.board = chess.Board()
+        self.book = book # book.OpeningBook or None
+        self.cache = cache # analysis_cache.AnalysisCache or None
         self.force_mode = False
         self.my_color = chess.BLACK 
         self.depth = MAX_DEPTH
@@ -20,14 +30,23 @@ class WinBoardEngine:
         self.increment = 0
         self.moves_to_go = 40
         self.sudden_death = False
+        self.time_manager = TimeManager()
 
         # the amount of games the engine got flagged is horrendous
         self.panic = False
 
+        # thinking output (post/nopost) and analyze mode
+        self.post = False
+        self.analyzing = False
+        self.analysis_thread = None
+        self.output_lock = threading.Lock()
+
     # Helper Functions
     def send(self, msg):
-        sys.stdout.write(msg + '\n')
-        sys.stdout.flush()
+        # the analysis thread writes too, keep whole lines together
+        with self.output_lock:
+            sys.stdout.write(msg + '\n')
+            sys.stdout.flush()
 
     def debug(self, msg):
         sys.stderr.write(msg + '\n')
@@ -46,6 +65,51 @@ class WinBoardEngine:
             (time_left_sec / max(1, self.moves_to_go)) < 0.25
         )
 
+    def send_thinking(self, board, depth, score, elapsed, nodes, pv, hashfull=None):
+        # xboard thinking line: ply score time(centiseconds) nodes pv, score for the side to move
+        if board.turn == chess.BLACK:
+            score = -score
+        pv_str = " ".join(move.uci() for move in pv)
+        self.send(f"{depth} {int(score)} {int(elapsed * 100)} {nodes} {pv_str}")
+        # the thinking line has no field for it, GUIs show # lines in their debug output
+        if hashfull is not None:
+            self.send(f"# hashfull {hashfull}")
+
+    # Analyze Mode
+    def start_analysis(self):
+        board = self.board.copy()
+        if board.is_game_over():
+            return
+
+        def on_info(depth, score, elapsed, nodes, pv):
+            self.send_thinking(board, depth, score, elapsed, nodes, pv, bbsearch.stats.hashfull)
+
+        # search until exit or a position edit stops it, the TT stays warm in between
+        self.analysis_thread = threading.Thread(
+            target=iterative_deepening, args=(board,),
+            kwargs=dict(max_depth=bbsearch.MAX_SEARCH_DEPTH, on_info=on_info), daemon=True)
+        self.analysis_thread.start()
+
+    def stop_analysis(self):
+        if self.analysis_thread is not None:
+            bbsearch.stop_signal.set()
+            self.analysis_thread.join()
+            bbsearch.stop_signal.clear()
+            self.analysis_thread = None
+
+    def clear_hash(self):
+        bbsearch.searcher.tt.new_game()
+        # new game: start from what earlier games learned about the opening
+        if self.cache is not None:
+            self.cache.warm(bbsearch.searcher.tt)
+
+    def hash_size_mb(self):
+        return bbsearch.searcher.tt.size_mb()
+
+    def set_hash_size(self, mb):
+        # entries that still fit are kept, no restart needed
+        bbsearch.searcher.tt.resize_mb(max(1, min(MAX_HASH_MB, mb)))
+
     # Move Handling
     def parse_move(self, move_str):
         try:
@@ -54,45 +118,64 @@ class WinBoardEngine:
             return None
         
     def make_engine_move(self):
-        if self.board.is_game_over():
+        search = self.start_engine_move()
+        if search is None:
             return
+
+        board = self.board
+        on_info = None
+        if self.post:
+            def on_info(depth, score, elapsed, nodes, pv):
+                self.send_thinking(board, depth, score, elapsed, nodes, pv, bbsearch.stats.hashfull)
+
+        if self.cache is not None:
+            self.cache.seed(bbsearch.searcher.tt, self.board)
+        res = iterative_deepening(self.board, on_info=on_info, **search)
+        if self.cache is not None:
+            self.cache.record(self.board, res)
+        self.finish_engine_move(res)
+
+    def start_engine_move(self):
+        # plays the move right away when there's nothing to search for (book, only move),
+        # otherwise starts our clock and returns the iterative_deepening arguments
+        if self.board.is_game_over():
+            return None
         
+        # Book moves cost nothing on the clock
+        if self.book is not None:
+            move = self.book.probe(self.board)
+            if move is not None:
+                self.debug(f"book move {move.uci()}")
+                self.board.push(move)
+                self.send(f"move {move.uci()}")
+                return None
+
         # If there's only one move, just do that
         moves = forced_legal_moves(self.board)
         if len(moves) == 1:
             move = moves[0]
             self.board.push(move)
             self.send(f"move {move.uci()}")
-            return
-
-        # Use iterative deepening search to pick a move
-        BASE_TIME = 0.6 # seconds
-        MAX_TIME  = 1.2 # never exceed this
-        if self.sudden_death or self.moves_to_go is None:
-            moves_to_go = 20
-        else:
-            moves_to_go = max(1, self.moves_to_go)
-            
-        self.moves_to_go = max(1, self.moves_to_go)
-
-        time_per_move = min(
-            MAX_TIME,
-            max(BASE_TIME, (self.my_time / 100) / moves_to_go)
-        )
+            return None
 
+        # Use iterative deepening search to pick a move, the time manager decides how long
         panic = self.in_panic_mode()
+        tm = self.time_manager
+        tm.start(self.my_time / 100, None if self.sudden_death else self.moves_to_go, self.opp_time / 100)
 
-        if panic:
-            time_per_move = min(time_per_move, 0.2)
+        self.search_start_time = time.time()
+        return dict(max_depth=self.depth, panic=panic, time_manager=tm,
+                    pns_nodes=0 if panic else PNS_NODES)
 
-        start_time = time.time()
-        res = iterative_deepening(self.board, max_depth=self.depth, time_limit=time_per_move, panic=panic)
-        elapsed_time = time.time() - start_time
+    def finish_engine_move(self, res):
+        tm = self.time_manager
+        elapsed_time = time.time() - self.search_start_time
 
-        # decrement remaining time
+        # charge our clock (the GUI sends the real one with "time" before our next move)
         self.my_time -= int(elapsed_time * 100)
         if self.my_time < 0:
             self.my_time = 0
+        self.my_time += self.increment
 
         score = res.score
         move = res.best_move
@@ -100,7 +183,7 @@ class WinBoardEngine:
         # offer a draw if we're losing lmao, see what happens
         TIME_THRESHOLD = 0.2
         DRAW_THRESHOLD = 2000
-        elapsed_time = (1 - self.my_time / (self.moves_to_go * time_per_move * 100)) * 100
+        elapsed_time = (1 - self.my_time / (max(1, self.moves_to_go) * tm.soft_limit * 100)) * 100
 
         send_draw = False
         if self.my_color == chess.WHITE and score <= -DRAW_THRESHOLD:
@@ -121,21 +204,63 @@ class WinBoardEngine:
         if self.moves_to_go > 1:
             self.moves_to_go -= 1
         else:
-            self.moves_to_go = 40  # or sudden-death reset
+            self.moves_to_go = tm.moves_per_session or 40  # next session (or sudden-death reset)
             
 
     # Winboard Protocol Handling
     def handle_command(self, cmd):
         self.debug(f"CMD: {cmd}")
 
+        # while analyzing, anything that edits the position restarts the analysis on the new one
+        # (and so does resizing the TT, the analysis is using it)
+        if self.analyzing and cmd.split(" ", 1)[0] in ("usermove", "setboard", "undo", "remove", "new",
+                                                        "memory", "option"):
+            self.stop_analysis()
+            self.handle_position_command(cmd)
+            if self.analyzing:
+                self.start_analysis()
+            return
+
         if cmd == "xboard":
             return
         
         if cmd.startswith("protover"):
-            self.send("feature ping=1 setboard=1 colors=0 usermove=1")
+            self.send(f"feature {self.FEATURES}")
+            self.send(f'feature option="Hash -spin {self.hash_size_mb()} 1 {MAX_HASH_MB}"')
             self.send("feature done=1")
             return
-        
+
+        if cmd == "post":
+            self.post = True
+            return
+
+        if cmd == "nopost":
+            self.post = False
+            return
+
+        if cmd == "analyze":
+            self.analyzing = True
+            self.post = True
+            self.stop_analysis()
+            self.start_analysis()
+            return
+
+        if cmd == "exit":
+            self.stop_analysis()
+            self.analyzing = False
+            return
+
+        if cmd == ".":
+            # analysis status request, the thinking lines already tell xboard everything
+            return
+
+        if cmd == "quit":
+            self.stop_analysis()
+            sys.exit(0)
+
+        self.handle_position_command(cmd)
+
+    def handle_position_command(self, cmd):
         if cmd == "new":
             self.board.reset()
             self.force_mode = False
@@ -146,11 +271,9 @@ class WinBoardEngine:
             self.moves_to_go = 40
             self.panic = False
             self.sudden_death = False
-            TT.clear()
+            self.time_manager = TimeManager()
+            self.clear_hash()
             return
-        
-        if cmd == "quit":
-            sys.exit(0)
 
         if cmd == "force":
             self.force_mode = True
@@ -182,11 +305,22 @@ class WinBoardEngine:
             if move and move in self.board.legal_moves:
                 self.board.push(move)
 
-                if not self.force_mode and self.board.turn == self.my_color:
+                if not self.force_mode and not self.analyzing and self.board.turn == self.my_color:
                     if not self.board.is_game_over():
                         self.make_engine_move()
 
             return
+
+        if cmd == "undo":
+            if self.board.move_stack:
+                self.board.pop()
+            return
+
+        if cmd == "remove":
+            for _ in range(2):
+                if self.board.move_stack:
+                    self.board.pop()
+            return
         
         if cmd.startswith("ping"):
             self.send(f"pong {cmd.split()[1]}")
@@ -198,25 +332,48 @@ class WinBoardEngine:
         
         # Time Management
         if cmd.startswith("level"):
-            _, moves, minutes, inc = cmd.split()
-            self.moves_to_go = max(1, int(moves))
-            self.increment = int(inc) * 100
-            self.my_time = int(minutes) * 60 * 100
+            # level MPS BASE INC, BASE is minutes or min:sec, INC seconds (0 MPS = sudden death)
+            _, moves, base, inc = cmd.split()
+            if ":" in base:
+                minutes, seconds = base.split(":")
+                base_seconds = int(minutes) * 60 + int(seconds)
+            else:
+                base_seconds = float(base) * 60
+            moves = int(moves)
+
+            self.moves_to_go = max(1, moves)
+            self.increment = int(float(inc) * 100)
+            self.my_time = int(base_seconds * 100)
             self.opp_time = self.my_time
-            self.sudden_death = False
+            self.sudden_death = moves == 0
+            self.time_manager.set_level(moves, base_seconds, float(inc))
             return
 
-        if cmd.startswith("st"):
-            seconds = int(cmd.split()[1])
-            self.my_time = seconds * 100
+        if cmd.startswith("st "):
+            # fixed time per move
+            seconds = float(cmd.split()[1])
+            self.my_time = int(seconds * 100)
             self.opp_time = self.my_time
             self.sudden_death = True
+            self.time_manager.set_fixed_time(seconds)
             return
 
         if cmd.startswith("time"):
             self.my_time = int(cmd.split()[1])
             return
 
+        # Hash Size
+        if cmd.startswith("memory"):
+            # MB for all our tables, the TT is the only one that matters
+            self.set_hash_size(int(cmd.split()[1]))
+            return
+
+        if cmd.startswith("option"):
+            name, _, value = cmd[len("option "):].partition("=")
+            if name == "Hash" and value:
+                self.set_hash_size(int(value))
+            return
+
         if cmd.startswith("otim"):
             self.opp_time = int(cmd.split()[1])
             return
@@ -235,7 +392,67 @@ class WinBoardEngine:
                 continue
 
 def main():
-    engine = WinBoardEngine()
+    # python engine.py bench [depth] [hash] [threads]
+    if sys.argv[1:2] == ["bench"]:
+        import bench
+        bench.main(sys.argv[2:])
+        return
+
+    # python engine.py host --tcp HOST:PORT, many games in one process (see host.py)
+    if sys.argv[1:2] == ["host"]:
+        import host
+        host.main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description="Chester, a forced-capture chess engine")
+    parser.add_argument("--uci", action="store_true", help="speak UCI instead of xboard")
+    parser.add_argument("--book", help="polyglot opening book to play from")
+    parser.add_argument("--book-depth", type=int, default=20, help="plies to use the book for")
+    parser.add_argument("--book-selection", choices=["weighted", "best"], default="weighted")
+    parser.add_argument("--tb", help="directory with forced-capture endgame tables (see tbgen.py)")
+    parser.add_argument("--cache", help="SQLite file of search results kept across games and processes")
+    parser.add_argument("--tt-file", help="keep the TT in this memory-mapped file, it's there for the next start")
+    parser.add_argument("--tt-readonly", action="store_true",
+                        help="map --tt-file copy-on-write, to read what another engine is writing to it")
+    parser.add_argument("--tt-save", help="write a snapshot of the TT to this file on quit")
+    parser.add_argument("--params", help="evaluation weights to use, a module written by tuner.py")
+    args = parser.parse_args()
+    if (args.tt_readonly or args.tt_save) and not args.tt_file:
+        parser.error("--tt-readonly and --tt-save need --tt-file")
+
+    if args.params:
+        import evaluate
+        evaluate.load_params(args.params)
+
+    if args.tt_file:
+        import atexit
+        from transposition import Mapped_Transposition_Table
+        bbsearch.TT = bbsearch.searcher.tt = Mapped_Transposition_Table(args.tt_file, size=bbsearch.TT.size,
+                                                                           readonly=args.tt_readonly)
+        # atexit runs these last registered first: snapshot, then flush and unmap
+        atexit.register(bbsearch.TT.close)
+        if args.tt_save:
+            atexit.register(lambda: bbsearch.searcher.tt.save(args.tt_save))
+
+    if args.tb:
+        from tablebase import Tablebase
+        bbsearch.searcher.tb = Tablebase()
+        bbsearch.searcher.tb.add_directory(args.tb)
+
+    cache = None
+    if args.cache:
+        from analysis_cache import AnalysisCache
+        cache = AnalysisCache(args.cache)
+
+    if args.uci:
+        from uci import UciEngine
+        engine = UciEngine(cache=cache)
+    else:
+        book = None
+        if args.book:
+            from book import OpeningBook
+            book = OpeningBook(args.book, selection=args.book_selection, max_ply=args.book_depth)
+        engine = WinBoardEngine(book=book, cache=cache)
     engine.loop()
 
 if __name__ == "__main__":
@@ -1,16 +1,24 @@
 import chess
 
+from transposition import pawn_zobrist_hash
+
 from evaluate import (
     compute_phase,
     material_and_piece_square_value,
+    material_and_piece_square_fast,
     mobility_value,
     capture_chain_value,
     pawn_structure_value,
+    pawn_promotion_bonus_value,
+    pawn_value,
+    PAWN_TT,
     PAWN_TABLE,
     CHESS_ENDGAME_VALUES,
     CHESS_BASE_VALUES,
     MAX_PHASE,
-    evaluate
+    evaluate,
+    evaluate_fast,
+    terminal_score
 )
 
 
@@ -150,6 +158,51 @@ def test_mobility_value_with_and_without_captures():
     assert isinstance(m, int)
 
 
+def test_pawn_hash_key_ignores_pieces():
+    b = chess.Board()
+    b2 = b.copy()
+    b2.remove_piece_at(chess.G1)
+    assert pawn_zobrist_hash(b) == pawn_zobrist_hash(b2)
+
+    b3 = b.copy()
+    b3.push_san("e4")
+    assert pawn_zobrist_hash(b) != pawn_zobrist_hash(b3)
+
+
+def test_pawn_value_matches_terms_and_is_cached():
+    b = chess.Board("8/8/3p4/8/P7/P7/2P5/8 w - - 0 1")
+    PAWN_TT.clear()
+    expected = pawn_promotion_bonus_value(b) + 0.5 * pawn_structure_value(b)
+    assert pawn_value(b) == expected
+    assert PAWN_TT.lookup(pawn_zobrist_hash(b)) == expected
+    assert pawn_value(b) == expected
+
+
+
+def test_evaluate_fast_matches_material_and_handles_game_end():
+    import random
+    from forced_chess import forced_legal_moves
+    rng = random.Random(7)
+    for fen in [chess.STARTING_FEN, "r1bq1r1k/1pp1n1pp/1p1p4/4p2Q/4Pp2/1BNP4/PPP2PPP/3R1RK1 w - - 2 14",
+                "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 11"]:
+        b = chess.Board(fen)
+        for _ in range(40):
+            moves = forced_legal_moves(b)
+            if not moves or b.is_insufficient_material():
+                break
+            assert material_and_piece_square_fast(b) == material_and_piece_square_value(b, compute_phase(b))
+            assert evaluate_fast(b, 0, moves) == material_and_piece_square_fast(b) + mobility_value(b, moves)
+            b.push(rng.choice(moves))
+
+    mated = chess.Board("r1bqkb1r/pppp1Qpp/2n2n2/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 0 4")
+    assert evaluate_fast(mated, 3) == evaluate(mated, 3) == 30000 - 3
+    assert evaluate_fast(chess.Board("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1"), 0) == 0
+    # both tiers take the game-over scores from terminal_score
+    assert terminal_score(mated, 3, []) == 30000 - 3
+    bare_kings = chess.Board("8/8/8/8/8/8/8/K1k5 w - - 0 1")
+    assert terminal_score(bare_kings, 0, forced_legal_moves(bare_kings)) == 0 == evaluate(bare_kings, 0)
+    assert terminal_score(chess.Board(), 0, forced_legal_moves(chess.Board())) is None
+
 # Test 1: Starting position
 board = chess.Board()
 score = evaluate(board, 0)
@@ -1,7 +1,25 @@
 import chess
 
+# Terminal status reported by forced_moves_and_status
+CHECKMATE = "CHECKMATE"
+STALEMATE = "STALEMATE"
+DRAW = "DRAW"
+
 def forced_legal_moves(board):
     # Return forced capture legal moves
     legal_moves = list(board.legal_moves)
     captures = [m for m in legal_moves if board.is_capture(m)]
     return captures if captures else legal_moves
+
+def forced_moves_and_status(board):
+    # Generate the forced moves once and read the game status off that list,
+    # instead of is_game_over/is_checkmate/is_stalemate each generating moves again
+    moves = forced_legal_moves(board)
+    if not moves:
+        return moves, CHECKMATE if board.is_check() else STALEMATE
+
+    # repetitions are left to the search's hash history, replaying the move stack is too slow
+    if board.is_insufficient_material() or board.halfmove_clock >= 150:
+        return moves, DRAW
+
+    return moves, None
@@ -0,0 +1,398 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from engine import WinBoardEngine
+from uci import UciEngine
+from transposition import ENTRY_SIZE, MAX_HASH_MB
+
+# python engine.py host [--tcp HOST:PORT] [--unix PATH] [--workers N] [--hash MB] [--book FILE] [--tb DIR]
+#
+# Many games in one process: every connection (TCP or Unix socket) is a game speaking xboard,
+# or UCI when its first command is "uci". The protocol side of all games runs on one asyncio
+# loop, the searches go to a shared pool of worker processes instead of one interpreter and
+# one 2M-slot TT per game.
+#
+# Each game has its own search context (Searcher, with a --hash MB TT) in the worker that
+# searched its last move. A search goes back to that worker while it's idle, otherwise to the
+# least busy one. The opening book is probed here, once for all games, the tablebases are
+# mapped by every worker (mmap, so the pages are shared). Every worker opens the --cache too.
+#
+# Searches can't call back into this process while they run, so thinking output (post, UCI
+# info) arrives in one go just before the move, and xboard analyze isn't supported.
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_HASH_MB = 8 # per game
+GAMES_PER_WORKER = 64 # search contexts a worker keeps before dropping the least recently used
+
+
+# Worker side, one per pool process
+
+class JobStop:
+    # stop_signal for the worker's Searchers: the host stops a search by writing its job id
+    # into the worker's shared flag, so a late stop can never hit the next game's search
+    def __init__(self, flag):
+        self.flag = flag
+        self.job = 0
+
+    def is_set(self):
+        return self.flag.value == self.job
+
+class Worker:
+    def __init__(self, stop_flag, tb_dirs, max_games, cache_path=None):
+        self.stop = JobStop(stop_flag)
+        self.max_games = max_games
+        self.searchers = OrderedDict() # game id -> Searcher, least recently used first
+        self.tb = None
+        if tb_dirs:
+            from tablebase import Tablebase
+            self.tb = Tablebase()
+            for directory in tb_dirs:
+                self.tb.add_directory(directory)
+        self.cache = None
+        if cache_path:
+            from analysis_cache import AnalysisCache
+            self.cache = AnalysisCache(cache_path)
+
+    def searcher(self, game_id, hash_mb, new_game):
+        from bbsearch import Searcher
+        tt_size = max(1, hash_mb * 1024 * 1024 // ENTRY_SIZE)
+        searcher = self.searchers.pop(game_id, None)
+        if searcher is None or searcher.tt.size != tt_size:
+            searcher = Searcher(tt_size=tt_size, tb=self.tb)
+            searcher.stop_signal = self.stop
+            new_game = True
+        elif new_game:
+            searcher.clear()
+        if new_game and self.cache is not None:
+            self.cache.warm(searcher.tt)
+        self.searchers[game_id] = searcher
+        while len(self.searchers) > self.max_games:
+            self.searchers.popitem(last=False)
+        return searcher
+
+    def search(self, game_id, job, board, hash_mb, new_game, search):
+        searcher = self.searcher(game_id, hash_mb, new_game)
+        infos = []
+        def on_info(depth, score, elapsed, nodes, pv):
+            infos.append((depth, score, elapsed, nodes, pv, searcher.stats.hashfull))
+
+        self.stop.job = job
+        if self.cache is not None:
+            self.cache.seed(searcher.tt, board)
+        res = searcher.iterative_deepening(board, on_info=on_info, **search)
+        if self.cache is not None:
+            self.cache.record(board, res)
+        return res, infos
+
+worker = None
+
+def init_worker(stop_flag, tb_dirs, max_games, cache_path, params_path=None):
+    global worker
+    if params_path:
+        import evaluate
+        evaluate.load_params(params_path)
+    worker = Worker(stop_flag, tb_dirs, max_games, cache_path)
+
+def run_search(*args):
+    return worker.search(*args)
+
+def end_game(game_id):
+    worker.searchers.pop(game_id, None)
+
+
+# Host side
+
+@dataclass
+class Game:
+    id: int
+    hash_mb: int
+    worker: Optional[int] = None # where its search context lives
+    job: Optional[int] = None # id of the running search
+    new_game: bool = True # the next search starts from a clear TT
+
+class XboardSession(WinBoardEngine):
+    FEATURES = "ping=1 setboard=1 colors=0 usermove=1 analyze=0 memory=1"
+
+    def __init__(self, host, game, writer, book=None):
+        super().__init__(book=book)
+        self.host = host
+        self.game = game
+        self.writer = writer
+        self.pending = None # iterative_deepening arguments of the move we owe
+
+    def send(self, msg):
+        self.writer.write((msg + '\n').encode())
+
+    def debug(self, msg):
+        self.host.debug(f"[game {self.game.id}] {msg}")
+
+    def clear_hash(self):
+        self.game.new_game = True
+
+    def hash_size_mb(self):
+        return self.game.hash_mb
+
+    def set_hash_size(self, mb):
+        self.game.hash_mb = max(1, min(MAX_HASH_MB, mb))
+        self.game.new_game = True
+
+    def handle_command(self, cmd):
+        # no analysis here, and the base class would already be in analyze mode
+        # (and ignoring usermove) by the time start_analysis could refuse it
+        if cmd == "analyze":
+            self.send("Error (not supported by the engine host): analyze")
+            return
+        super().handle_command(cmd)
+
+    def make_engine_move(self):
+        # the host runs the search once the command is done
+        self.pending = self.start_engine_move()
+
+    async def run(self, lines):
+        async for line in lines:
+            cmd = line.strip()
+            if cmd == "quit":
+                return
+            self.handle_command(cmd)
+            if self.pending is not None:
+                search, self.pending = self.pending, None
+                board = self.board.copy()
+                res, infos = await self.host.search(self.game, board, search)
+                if self.post:
+                    for info in infos:
+                        self.send_thinking(board, *info)
+                self.finish_engine_move(res)
+            await self.writer.drain()
+
+class UciSession(UciEngine):
+    # only these get answered while a search runs, anything else waits for its bestmove
+    DURING_SEARCH = ("stop", "ponderhit", "isready")
+
+    def __init__(self, host, game, writer):
+        super().__init__()
+        self.host = host
+        self.game = game
+        self.writer = writer
+        self.release = asyncio.Event()
+        self.search_task = None
+        self.ponder_stop = None
+
+    def send(self, msg):
+        self.writer.write((msg + '\n').encode())
+
+    def debug(self, msg):
+        self.host.debug(f"[game {self.game.id}] {msg}")
+
+    def set_hash_size(self, mb):
+        self.game.hash_mb = mb
+        self.game.new_game = True
+
+    def clear_hash(self):
+        self.game.new_game = True
+
+    def set_tablebase_path(self, value):
+        self.debug("TablebasePath: the host's --tb tables are used")
+
+    def searching(self):
+        return self.search_task is not None and not self.search_task.done()
+
+    def start_search(self, board, max_depth, max_nodes, tm):
+        search = dict(max_depth=max_depth, time_manager=tm, max_nodes=max_nodes)
+        self.search_task = asyncio.ensure_future(self.search_and_reply(board, search))
+
+    async def search_and_reply(self, board, search):
+        res, infos = await self.host.search(self.game, board, search)
+        for info in infos:
+            self.send_info(board, *info)
+        # in infinite/ponder mode the GUI decides when we're done
+        await self.release.wait()
+        self.send_bestmove(board, res)
+        await self.writer.drain()
+
+    def stop(self):
+        if self.ponder_stop is not None:
+            self.ponder_stop.cancel()
+            self.ponder_stop = None
+        if self.searching():
+            self.host.stop(self.game)
+            self.release.set()
+
+    def ponderhit(self):
+        # the worker's search got an unlimited clock, so enforce the hard limit from here
+        tm = self.time_manager
+        if self.ponder_clock is not None and self.searching():
+            tm.start(*self.ponder_clock)
+            deadline = tm.deadline()
+            if deadline is not None:
+                loop = asyncio.get_running_loop()
+                self.ponder_stop = loop.call_later(max(0.0, deadline - time.time()), self.host.stop, self.game)
+        self.ponder_clock = None
+        self.release.set()
+
+    async def run(self, lines):
+        try:
+            async for line in lines:
+                cmd = line.strip()
+                name = cmd.partition(" ")[0]
+                if self.searching() and name not in self.DURING_SEARCH:
+                    if name == "quit":
+                        self.stop()
+                    await self.search_task
+                if name == "quit":
+                    return
+                self.handle_command(cmd)
+                await self.writer.drain()
+        finally:
+            self.stop()
+
+class EngineHost:
+    def __init__(self, workers=DEFAULT_WORKERS, hash_mb=DEFAULT_HASH_MB, book=None, tb_dirs=(),
+                 games_per_worker=GAMES_PER_WORKER, cache_path=None, params_path=None, verbose=False):
+        self.hash_mb = hash_mb
+        self.book = book # book.OpeningBook or None, shared by all xboard games
+        self.verbose = verbose
+        self.stop_flags = [multiprocessing.Value("q", 0, lock=False) for _ in range(workers)]
+        self.pools = [ProcessPoolExecutor(max_workers=1, initializer=init_worker,
+                                          initargs=(flag, list(tb_dirs), games_per_worker, cache_path, params_path))
+                      for flag in self.stop_flags]
+        self.queued = [0] * workers # searches sent to each worker and not back yet
+        self.games = 0
+        self.jobs = 0
+        self.servers = []
+        self.closed = False
+
+    def debug(self, msg):
+        if self.verbose:
+            sys.stderr.write(msg + '\n')
+
+    def pick_worker(self, game):
+        # stay where the game's TT is unless that means waiting behind another search
+        if game.worker is not None and self.queued[game.worker] == 0:
+            return game.worker
+        return min(range(len(self.pools)), key=lambda w: (self.queued[w], w != game.worker))
+
+    async def search(self, game, board, search):
+        """Runs iterative_deepening(board, **search) for the game, returns (result, info lines)."""
+        w = self.pick_worker(game)
+        if w != game.worker:
+            if game.worker is not None:
+                # the old context is stale now, the new worker starts one from scratch
+                self.pools[game.worker].submit(end_game, game.id)
+            game.worker = w
+        new_game, game.new_game = game.new_game, False
+
+        self.jobs += 1
+        game.job = self.jobs
+        self.queued[w] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pools[w], run_search, game.id, game.job, board,
+                                              game.hash_mb, new_game, search)
+        finally:
+            self.queued[w] -= 1
+            game.job = None
+
+    def stop(self, game):
+        if game.job is not None:
+            self.stop_flags[game.worker].value = game.job
+
+    async def handle_connection(self, reader, writer):
+        self.games += 1
+        game = Game(id=self.games, hash_mb=self.hash_mb)
+        self.debug(f"[game {game.id}] connected")
+
+        lines = aiter(reader)
+        try:
+            first = await anext(lines, b"")
+            if not first:
+                return
+            # the protocol is whatever the first command speaks
+            if first.strip() == b"uci":
+                session = UciSession(self, game, writer)
+            else:
+                session = XboardSession(self, game, writer, book=self.book)
+
+            async def decoded():
+                yield first.decode(errors="replace")
+                async for line in lines:
+                    yield line.decode(errors="replace")
+            await session.run(decoded())
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if game.worker is not None and not self.closed:
+                self.pools[game.worker].submit(end_game, game.id)
+            writer.close()
+            self.debug(f"[game {game.id}] disconnected")
+
+    async def start_tcp(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        self.servers.append(server)
+        return server
+
+    async def start_unix(self, path):
+        server = await asyncio.start_unix_server(self.handle_connection, path)
+        self.servers.append(server)
+        return server
+
+    async def close(self):
+        self.closed = True
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        for pool in self.pools:
+            pool.shutdown(cancel_futures=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Serve many xboard/UCI games from one process")
+    parser.add_argument("--tcp", help="HOST:PORT to listen on")
+    parser.add_argument("--unix", help="Unix socket path to listen on")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="search processes")
+    parser.add_argument("--hash", type=int, default=DEFAULT_HASH_MB, help="TT size per game in MB")
+    parser.add_argument("--book", help="polyglot opening book for the xboard games")
+    parser.add_argument("--book-depth", type=int, default=20, help="plies to use the book for")
+    parser.add_argument("--tb", action="append", default=[], help="endgame table directory (repeatable)")
+    parser.add_argument("--cache", help="SQLite file of search results shared by all games (see analysis_cache.py)")
+    parser.add_argument("--params", help="evaluation weights for the searches (a tuner.py module)")
+    parser.add_argument("--verbose", action="store_true", help="log connections and commands to stderr")
+    args = parser.parse_args(args)
+    if not args.tcp and not args.unix:
+        parser.error("give --tcp HOST:PORT and/or --unix PATH")
+
+    book = None
+    if args.book:
+        from book import OpeningBook
+        book = OpeningBook(args.book, max_ply=args.book_depth)
+
+    async def serve():
+        host = EngineHost(workers=args.workers, hash_mb=max(1, min(MAX_HASH_MB, args.hash)),
+                          book=book, tb_dirs=args.tb, cache_path=args.cache, params_path=args.params,
+                          verbose=args.verbose)
+        try:
+            if args.tcp:
+                address, _, port = args.tcp.rpartition(":")
+                server = await host.start_tcp(address or "127.0.0.1", int(port))
+                sys.stderr.write(f"listening on {server.sockets[0].getsockname()}\n")
+            if args.unix:
+                await host.start_unix(args.unix)
+                sys.stderr.write(f"listening on {args.unix}\n")
+            await asyncio.gather(*(server.serve_forever() for server in host.servers))
+        finally:
+            await host.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
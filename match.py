@@ -0,0 +1,395 @@
+import os
+import math
+import time
+import shlex
+import asyncio
+import argparse
+import subprocess
+from dataclasses import dataclass
+from typing import List
+
+import chess
+import chess.engine
+import chess.pgn
+
+from forced_chess import forced_moves_and_status, CHECKMATE, STALEMATE
+
+# Plays two engine builds against each other over xboard to see whether a change gains Elo
+# (python match.py "python engine.py" "python ../baseline/engine.py" --games 400 --tc 40/10+0.1).
+#
+# Every worker is an asyncio task owning one process per engine, and workers play games from
+# a shared queue concurrently, so throughput scales with --concurrency (default: all cores,
+# only one engine of a pair thinks at a time). Every opening is played twice with colors
+# swapped. The runner keeps the clocks, checks moves against the forced-capture rules and
+# adjudicates the game end itself, engines only ever get "go". Games are written to a PGN
+# file with cutechess-style {score/depth time} comments, and an SPRT can stop the match
+# as soon as the result is clear.
+
+MATE_SCORE = 29000 # engine scores past this are mates (see bbsearch)
+TIME_MARGIN = 0.1 # seconds an engine may overstep its clock (process/pipe latency)
+START_TIMEOUT = 30.0 # seconds an engine gets to start up and answer protover
+
+
+@dataclass
+class TimeControl:
+    moves: int # moves per session, 0 = sudden death
+    base: float # seconds per session
+    increment: float # seconds added after every move
+
+    @classmethod
+    def parse(cls, text):
+        """'40/60+0.5' (40 moves in 60s, 0.5s increment), '10+0.1' or '30' (sudden death)."""
+        moves = 0
+        if "/" in text:
+            moves, text = text.split("/", 1)
+        base, _, increment = text.partition("+")
+        return cls(int(moves), float(base), float(increment or 0))
+
+    def pgn(self):
+        # PGN TimeControl tag
+        tc = f"{self.moves}/{self.base:g}" if self.moves else f"{self.base:g}"
+        return f"{tc}+{self.increment:g}" if self.increment else tc
+
+
+@dataclass
+class EngineSpec:
+    name: str
+    command: List[str]
+
+
+# Elo and SPRT, all with the logistic model on the score (wins + draws / 2)
+def expected_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+def score_to_elo(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+def score_variance(wins, draws, losses):
+    # per game variance of the score
+    n = wins + draws + losses
+    score = (wins + draws / 2) / n
+    return (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / n
+
+def elo_estimate(wins, draws, losses):
+    """(Elo, 95% error margin) of the first engine, (0, inf) before there's anything to go on."""
+    n = wins + draws + losses
+    if n == 0:
+        return 0.0, math.inf
+    score = (wins + draws / 2) / n
+    margin = 1.96 * math.sqrt(score_variance(wins, draws, losses) / n)
+    elo = score_to_elo(score)
+    return elo, (score_to_elo(score + margin) - score_to_elo(score - margin)) / 2
+
+def sprt_bounds(alpha, beta):
+    """(lower, upper) LLR bounds: accept H0 (elo0) below, H1 (elo1) above."""
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    """Log likelihood ratio of elo1 against elo0 (normal approximation of the trinomial)."""
+    n = wins + draws + losses
+    if n == 0 or wins + losses == 0:
+        return 0.0
+    variance = score_variance(wins, draws, losses)
+    if variance == 0:
+        return 0.0
+    score = (wins + draws / 2) / n
+    s0, s1 = expected_score(elo0), expected_score(elo1)
+    return (s1 - s0) * (2 * score - s0 - s1) * n / (2 * variance)
+
+
+class Tally:
+    # wins/draws/losses of the first engine, and the SPRT state on top of them
+    def __init__(self, sprt=None):
+        self.wins = self.draws = self.losses = 0
+        self.sprt = sprt # (elo0, elo1, alpha, beta) or None
+        self.decision = None # "H0" / "H1" once the SPRT is done
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    def add(self, result, first_is_white):
+        if result == "1/2-1/2":
+            self.draws += 1
+        elif (result == "1-0") == first_is_white:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+        if self.sprt is not None and self.decision is None:
+            lower, upper = sprt_bounds(*self.sprt[2:])
+            llr = self.llr()
+            if llr <= lower:
+                self.decision = "H0"
+            elif llr >= upper:
+                self.decision = "H1"
+
+    def llr(self):
+        return sprt_llr(self.wins, self.draws, self.losses, *self.sprt[:2])
+
+    def summary(self):
+        elo, margin = elo_estimate(self.wins, self.draws, self.losses)
+        text = f"+{self.wins}-{self.losses}={self.draws} Elo {elo:.1f} +/- {margin:.1f}"
+        if self.sprt is not None:
+            lower, upper = sprt_bounds(*self.sprt[2:])
+            text += f" LLR {self.llr():.2f} [{lower:.2f}, {upper:.2f}]"
+            if self.decision:
+                text += f" {self.decision} accepted"
+        return text
+
+
+# Openings
+def load_openings(path):
+    """FENs to start games from: the final positions of a PGN file's games, or one FEN/EPD per line."""
+    fens = []
+    if path.endswith(".pgn"):
+        with open(path) as f:
+            while True:
+                game = chess.pgn.read_game(f)
+                if game is None:
+                    break
+                fens.append(game.end().board().fen())
+        return fens
+
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                board = chess.Board(line)
+            except ValueError:
+                board = chess.Board()
+                board.set_epd(line)
+            fens.append(board.fen())
+    return fens
+
+
+# Games
+def move_comment(info, elapsed):
+    # {+0.35/12 1.23s}, mates as +M5 (moves), scores from the mover's side
+    parts = []
+    score = info.get("score")
+    if score is not None:
+        score = score.relative
+        if score.is_mate():
+            mate = score.mate()
+            text = f"{'+' if mate > 0 else '-'}M{abs(mate)}"
+        else:
+            cp = score.score()
+            if abs(cp) >= MATE_SCORE:
+                # our engines send mate scores as centipawns, 30000 - plies
+                moves = (30000 - abs(cp) + 1) // 2
+                text = f"{'+' if cp > 0 else '-'}M{moves}"
+            else:
+                text = f"{cp / 100:+.2f}"
+        if "depth" in info:
+            text += f"/{info['depth']}"
+        parts.append(text)
+    parts.append(f"{elapsed:.2f}s")
+    return " ".join(parts)
+
+def game_over(board: chess.Board):
+    """(result, termination) once the game has ended under forced-capture rules, else None."""
+    _, status = forced_moves_and_status(board)
+    if status == CHECKMATE:
+        return ("0-1" if board.turn == chess.WHITE else "1-0"), "checkmate"
+    if status == STALEMATE:
+        return "1/2-1/2", "stalemate"
+    if board.is_insufficient_material():
+        return "1/2-1/2", "insufficient material"
+    if board.halfmove_clock >= 100:
+        return "1/2-1/2", "fifty-move rule"
+    if board.is_repetition(3):
+        return "1/2-1/2", "threefold repetition"
+    return None
+
+def loss_for(color):
+    return "0-1" if color == chess.WHITE else "1-0"
+
+async def play_game(engines, names, fen, tc: TimeControl, round_number, event="Forced-capture match"):
+    """
+    Plays one game between the engine protocols engines[WHITE] and engines[BLACK].
+    Returns (PGN game, colors whose engine has to be restarted).
+    """
+    board = chess.Board(fen)
+    game = chess.pgn.Game()
+    game.headers["Event"] = event
+    game.headers["Round"] = str(round_number)
+    game.headers["White"] = names[chess.WHITE]
+    game.headers["Black"] = names[chess.BLACK]
+    game.headers["TimeControl"] = tc.pgn()
+    if fen != chess.STARTING_FEN:
+        game.setup(board)
+    node = game
+
+    # one id per game: python-chess sends "new" and the time control when it changes
+    game_id = object()
+    clocks = {chess.WHITE: tc.base, chess.BLACK: tc.base}
+    moves_made = {chess.WHITE: 0, chess.BLACK: 0}
+    broken = set()
+
+    while True:
+        over = game_over(board)
+        if over is not None:
+            result, termination = over
+            break
+
+        color = board.turn
+        remaining = tc.moves - moves_made[color] % tc.moves if tc.moves else None
+        limit = chess.engine.Limit(white_clock=clocks[chess.WHITE], black_clock=clocks[chess.BLACK],
+                                   white_inc=tc.increment, black_inc=tc.increment,
+                                   remaining_moves=remaining, clock_id=game_id)
+
+        start = time.monotonic()
+        try:
+            play = await asyncio.wait_for(
+                engines[color].play(board, limit, game=game_id, info=chess.engine.INFO_SCORE),
+                timeout=clocks[color] + TIME_MARGIN)
+        except asyncio.TimeoutError:
+            # it's still thinking, start it over for the next game
+            broken.add(color)
+            result, termination = loss_for(color), "time forfeit"
+            break
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as err:
+            broken.add(color)
+            result, termination = loss_for(color), f"engine error: {err}"
+            break
+        elapsed = time.monotonic() - start
+
+        clocks[color] -= elapsed
+        if clocks[color] < -TIME_MARGIN:
+            result, termination = loss_for(color), "time forfeit"
+            break
+
+        if play.resigned or play.move is None:
+            result, termination = loss_for(color), "resignation"
+            break
+        if play.move not in forced_moves_and_status(board)[0]:
+            broken.add(color) # its board may not match ours anymore
+            result, termination = loss_for(color), f"illegal move {play.move.uci()}"
+            break
+
+        node = node.add_variation(play.move, comment=move_comment(play.info, elapsed))
+        board.push(play.move)
+
+        clocks[color] += tc.increment
+        moves_made[color] += 1
+        if tc.moves and moves_made[color] % tc.moves == 0:
+            clocks[color] += tc.base
+
+    game.headers["Result"] = result
+    game.headers["Termination"] = termination
+    return game, broken
+
+
+class Match:
+    def __init__(self, specs, tc: TimeControl, openings, games, concurrency, pgn_path=None,
+                 sprt=None, log=print):
+        self.specs = specs # [first engine, second engine], results are from the first one's side
+        self.tc = tc
+        self.openings = openings or [chess.STARTING_FEN]
+        self.games = games
+        self.concurrency = max(1, concurrency)
+        self.pgn_path = pgn_path
+        self.log = log
+        self.tally = Tally(sprt)
+
+    def jobs(self):
+        # (round, opening, whether the first engine has White), each opening with both colors
+        jobs = []
+        for i in range(self.games):
+            fen = self.openings[(i // 2) % len(self.openings)]
+            jobs.append((i + 1, fen, i % 2 == 0))
+        return jobs
+
+    async def start_engine(self, spec):
+        transport, protocol = await asyncio.wait_for(
+            chess.engine.popen_xboard(spec.command, stderr=subprocess.DEVNULL), START_TIMEOUT)
+        return transport, protocol
+
+    async def stop_engine(self, engine):
+        transport, protocol = engine
+        try:
+            await asyncio.wait_for(protocol.quit(), 5)
+        except (asyncio.TimeoutError, chess.engine.EngineError, chess.engine.EngineTerminatedError):
+            pass
+        transport.close()
+
+    async def worker(self, queue):
+        engines = [None, None]
+        try:
+            while self.tally.decision is None:
+                try:
+                    round_number, fen, first_white = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+                for i, spec in enumerate(self.specs):
+                    if engines[i] is None:
+                        engines[i] = await self.start_engine(spec)
+
+                white, black = (0, 1) if first_white else (1, 0)
+                protocols = {chess.WHITE: engines[white][1], chess.BLACK: engines[black][1]}
+                names = {chess.WHITE: self.specs[white].name, chess.BLACK: self.specs[black].name}
+                game, broken = await play_game(protocols, names, fen, self.tc, round_number)
+
+                for color in broken:
+                    i = white if color == chess.WHITE else black
+                    await self.stop_engine(engines[i])
+                    engines[i] = None
+
+                self.game_done(game, first_white)
+        finally:
+            for engine in engines:
+                if engine is not None:
+                    await self.stop_engine(engine)
+
+    def game_done(self, game, first_white):
+        # runs on the event loop thread, no locking needed
+        result = game.headers["Result"]
+        self.tally.add(result, first_white)
+        if self.pgn_path:
+            with open(self.pgn_path, "a") as f:
+                print(game, file=f, end="\n\n")
+        self.log(f"Game {game.headers['Round']}: {game.headers['White']} - {game.headers['Black']} "
+                 f"{result} ({game.headers['Termination']}) | {self.tally.summary()}")
+
+    async def run(self):
+        queue = asyncio.Queue()
+        for job in self.jobs():
+            queue.put_nowait(job)
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(min(self.concurrency, self.games))]
+        await asyncio.gather(*workers)
+        return self.tally
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a match between two xboard engines")
+    parser.add_argument("first", help="command of the engine under test")
+    parser.add_argument("second", help="command of the baseline engine")
+    parser.add_argument("--names", nargs=2, metavar=("FIRST", "SECOND"), default=["first", "second"])
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--tc", default="40/10+0.1", help="moves/seconds+increment, e.g. 40/60+0.5 or 10+0.1")
+    parser.add_argument("--openings", help="PGN or FEN/EPD file to start games from")
+    parser.add_argument("--concurrency", type=int, default=os.cpu_count() or 1, help="games played at once")
+    parser.add_argument("--pgn", default="match.pgn", help="where to append the games")
+    parser.add_argument("--sprt", action="store_true", help="stop once the SPRT accepts H0 or H1")
+    parser.add_argument("--elo0", type=float, default=0.0)
+    parser.add_argument("--elo1", type=float, default=5.0)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    args = parser.parse_args()
+
+    specs = [EngineSpec(args.names[0], shlex.split(args.first)), EngineSpec(args.names[1], shlex.split(args.second))]
+    openings = load_openings(args.openings) if args.openings else None
+    sprt = (args.elo0, args.elo1, args.alpha, args.beta) if args.sprt else None
+    match = Match(specs, TimeControl.parse(args.tc), openings, args.games, args.concurrency,
+                  pgn_path=args.pgn, sprt=sprt)
+
+    tally = asyncio.run(match.run())
+    print(f"Finished {tally.games} games: {tally.summary()}")
+
+if __name__ == "__main__":
+    main()
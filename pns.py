@@ -0,0 +1,218 @@
+import time
+import argparse
+import chess
+import chess.polyglot
+from dataclasses import dataclass
+from typing import List, Optional
+
+import bbsearch
+from forced_chess import forced_moves_and_status, CHECKMATE
+
+# Proof-number search: proves (or disproves) that the side to move can force mate.
+# Forced captures keep the number of replies small, which is exactly where PNS shines,
+# so long forcing lines get solved without alpha-beta having to reach their depth.
+
+INF = 10 ** 9
+
+PROVEN = "PROVEN"
+DISPROVEN = "DISPROVEN"
+UNKNOWN = "UNKNOWN"
+
+@dataclass
+class PNSResult:
+    status: str
+    best_move: Optional[chess.Move]
+    nodes: int
+    time_taken: float
+    pv: List[chess.Move]
+
+
+class PNSNode:
+    __slots__ = ("move", "parent", "key", "is_or", "pn", "dn", "children")
+
+    def __init__(self, move, parent, key, is_or, pn, dn):
+        self.move = move
+        self.parent = parent
+        self.key = key
+        self.is_or = is_or # OR node = attacker to move, AND node = defender to move
+        self.pn = pn
+        self.dn = dn
+        self.children = None # None until expanded
+
+
+# Proven positions, shared between solves (a win doesn't depend on how we got there), and
+# between Searchers too: what's in it is true whoever proved it
+class ProofTable:
+    def __init__(self, size=200000):
+        self.size = size
+        self.table = {}
+
+    def store(self, key, is_or):
+        if len(self.table) >= self.size:
+            self.table.clear()
+        self.table[(key, is_or)] = True
+
+    def is_proven(self, key, is_or):
+        return (key, is_or) in self.table
+
+    def clear(self):
+        self.table.clear()
+
+PROOF_TT = ProofTable()
+
+
+def solve(board: chess.Board, max_nodes: int = 100000, max_memory: int = 1000000,
+          time_limit: float = None, max_depth: int = 60, order_moves=None) -> PNSResult:
+    """
+    Tries to prove a forced mate for the side to move.
+
+    max_nodes caps the number of expansions, max_memory the number of nodes kept in
+    the tree and max_depth the length of the lines we try. Running out of any of them
+    (or of time) gives UNKNOWN. Draws, including repetitions along the line, count as
+    disproofs since the attacker has to mate. order_moves is the move ordering of the
+    Searcher asking (its TT and killers), bbsearch.order_moves by default.
+    """
+    if order_moves is None:
+        order_moves = bbsearch.order_moves
+    start_time = time.time()
+    board = board.copy()
+
+    root = PNSNode(None, None, chess.polyglot.zobrist_hash(board), True, 1, 1)
+    _, root_status = forced_moves_and_status(board)
+    if root_status is not None:
+        # nothing to prove, the game is already over (and the attacker didn't win it)
+        return PNSResult(status=DISPROVEN, best_move=None, nodes=0,
+                         time_taken=time.time() - start_time, pv=[])
+
+    path_keys = [root.key]
+    nodes = 0
+    tree_size = 1
+
+    while root.pn != 0 and root.dn != 0:
+        if nodes >= max_nodes or tree_size >= max_memory:
+            break
+        if time_limit is not None and time.time() - start_time >= time_limit:
+            break
+
+        # walk down to the most-proving node
+        node = root
+        while node.children is not None:
+            if node.is_or:
+                node = min(node.children, key=lambda c: c.pn)
+            else:
+                node = min(node.children, key=lambda c: c.dn)
+            board.push(node.move)
+            path_keys.append(node.key)
+
+        tree_size += expand(node, board, path_keys, max_depth, order_moves)
+        nodes += 1
+
+        # back up the new numbers to the root, unwinding the board on the way
+        while node is not None:
+            update(node)
+            if node.parent is not None:
+                board.pop()
+                path_keys.pop()
+            node = node.parent
+
+    if root.pn == 0:
+        status = PROVEN
+    elif root.dn == 0:
+        status = DISPROVEN
+    else:
+        status = UNKNOWN
+
+    pv = proof_line(root) if status == PROVEN else []
+    return PNSResult(status=status, best_move=pv[0] if pv else None, nodes=nodes,
+                     time_taken=time.time() - start_time, pv=pv)
+
+
+def expand(node: PNSNode, board: chess.Board, path_keys, max_depth, order_moves) -> int:
+    moves, _ = forced_moves_and_status(board)
+    # order_moves puts the likely refutations/wins first, min() keeps the first on ties
+    moves = order_moves(board, moves, depth_from_root=min(len(path_keys) - 1, bbsearch.MAX_SEARCH_DEPTH - 1),
+                        key=node.key)
+
+    child_is_or = not node.is_or
+    children = []
+    for move in moves:
+        board.push(move)
+        key = chess.polyglot.zobrist_hash(board)
+        child_moves, status = forced_moves_and_status(board)
+
+        if status == CHECKMATE:
+            # whoever is to move got mated
+            pn, dn = (INF, 0) if child_is_or else (0, INF)
+        elif status is not None or key in path_keys or board.halfmove_clock >= 100:
+            pn, dn = INF, 0
+        elif PROOF_TT.is_proven(key, child_is_or):
+            pn, dn = 0, INF
+        elif len(path_keys) >= max_depth:
+            pn, dn = INF, 0
+        elif child_is_or:
+            # the more moves the attacker has, the easier to prove
+            pn, dn = 1, len(child_moves)
+        else:
+            # the more replies the defender has, the harder to prove
+            pn, dn = len(child_moves), 1
+
+        children.append(PNSNode(move, node, key, child_is_or, pn, dn))
+        board.pop()
+
+    node.children = children
+    return len(children)
+
+
+def update(node: PNSNode):
+    if node.children is None:
+        return
+
+    if node.is_or:
+        node.pn = min(c.pn for c in node.children)
+        node.dn = min(INF, sum(c.dn for c in node.children))
+    else:
+        node.pn = min(INF, sum(c.pn for c in node.children))
+        node.dn = min(c.dn for c in node.children)
+
+    if node.pn == 0:
+        PROOF_TT.store(node.key, node.is_or)
+
+
+def proof_line(root: PNSNode) -> List[chess.Move]:
+    # attacker plays a proven move, the defender the reply whose proof took the most expansions
+    line = []
+    node = root
+    while node.children:
+        if node.is_or:
+            node = next(c for c in node.children if c.pn == 0)
+        else:
+            node = max(node.children, key=subtree_size)
+        line.append(node.move)
+    return line
+
+
+def subtree_size(node: PNSNode) -> int:
+    if not node.children:
+        return 1
+    return 1 + sum(subtree_size(c) for c in node.children)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve a forced-capture chess position for a forced mate")
+    parser.add_argument("fen", nargs="?", default=chess.STARTING_FEN)
+    parser.add_argument("--nodes", type=int, default=100000, help="maximum number of expansions")
+    parser.add_argument("--memory", type=int, default=1000000, help="maximum number of nodes kept in the tree")
+    parser.add_argument("--time", type=float, default=None, help="time limit in seconds")
+    parser.add_argument("--depth", type=int, default=60, help="maximum line length in plies")
+    args = parser.parse_args()
+
+    board = chess.Board(args.fen)
+    res = solve(board, max_nodes=args.nodes, max_memory=args.memory, time_limit=args.time, max_depth=args.depth)
+
+    print(f"{res.status} nodes={res.nodes} time={res.time_taken:.2f}s")
+    if res.status == PROVEN:
+        print(f"best move: {res.best_move.uci()}")
+        print(f"line: {board.variation_san(res.pv)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+import os
+import mmap
+import struct
+import threading
+from collections import OrderedDict, deque
+
+import chess
+import chess.polyglot
+
+from forced_chess import forced_legal_moves
+
+# Endgame tablebases for forced-capture chess (orthodox syzygy/gaviota tables are wrong when
+# captures are compulsory). This module has the table layout shared by the generator
+# (tbgen.py) and the search: material signatures, the symmetry-reduced index and the
+# file format, plus Tablebase, the reader the search probes.
+#
+# A table covers one material signature ("KQvK", "KRPvKR", ...) with the stronger side as
+# White. Positions are indexed as kk * 64^m + the squares of the other m pieces, where kk
+# numbers the king placements left after symmetry: the white king in the a1-d1-d4 triangle
+# for pawnless tables (8 symmetries) and on files a-d when there are pawns (left-right
+# mirror only). Every index has a white-to-move and a black-to-move state.
+#
+# Two files per signature:
+#   <sig>.fcw  WDL, 2 bits per state (draw / win / loss / broken)
+#   <sig>.fcm  distance to mate in plies, uint16 per state (0 for draws)
+# Both start with a 32 byte header and hold the white-to-move block then the black-to-move one.
+#
+# Tables don't know about castling, en passant or the 50 move rule.
+
+PIECE_ORDER = "KQRBNP"
+PIECE_VALUES = {"K": 0, "Q": 9, "R": 5, "B": 3.25, "N": 3, "P": 1}
+PIECE_TYPES = {"K": chess.KING, "Q": chess.QUEEN, "R": chess.ROOK, "B": chess.BISHOP, "N": chess.KNIGHT, "P": chess.PAWN}
+
+# WDL values, from the side to move's point of view
+DRAW = 0
+WIN = 1
+LOSS = 2
+BROKEN = 3 # not a legal position (pieces on top of each other, side not to move in check, ...)
+
+WDL_SUFFIX = ".fcw"
+DTM_SUFFIX = ".fcm"
+WDL_KIND = ord("W")
+DTM_KIND = ord("M")
+
+MAGIC = b"FCTB"
+VERSION = 1
+# magic, version, kind, reserved, states per side to move, signature
+HEADER = struct.Struct("<4sBBHQ16s")
+
+MAX_PIECES = 7 # index arithmetic limit, generating anything past 5 is not realistic anyway
+
+
+def square_file(sq):
+    return sq & 7
+
+def square_rank(sq):
+    return sq >> 3
+
+def _kings_adjacent(a, b):
+    return max(abs(square_file(a) - square_file(b)), abs(square_rank(a) - square_rank(b))) <= 1
+
+def _kk_pairs(pawns):
+    pairs = []
+    for wk in range(64):
+        f, r = square_file(wk), square_rank(wk)
+        if f > 3:
+            continue
+        if not pawns and (r > 3 or r > f):
+            continue
+        for bk in range(64):
+            if bk == wk or _kings_adjacent(wk, bk):
+                continue
+            # white king on the a1-h8 diagonal: the black king goes on or below it
+            if not pawns and f == r and square_rank(bk) > square_file(bk):
+                continue
+            pairs.append((wk, bk))
+    return pairs
+
+# king placements, and their number by wk * 64 + bk (-1 for ones that aren't used)
+KK_PAIRS = {False: _kk_pairs(False), True: _kk_pairs(True)}
+KK_INDEX = {}
+for _pawns, _pairs in KK_PAIRS.items():
+    KK_INDEX[_pawns] = [-1] * 4096
+    for _i, (_wk, _bk) in enumerate(_pairs):
+        KK_INDEX[_pawns][_wk * 64 + _bk] = _i
+
+
+# Material Signatures
+def normalize_side(side):
+    return "".join(sorted(side, key=PIECE_ORDER.index))
+
+def side_strength(side):
+    return (sum(PIECE_VALUES[c] for c in side), len(side), [-PIECE_ORDER.index(c) for c in side])
+
+def normalize_signature(sig):
+    """Returns (canonical signature, whether colors have to be swapped to get there)."""
+    white, black = (normalize_side(s) for s in sig.split("v"))
+    if side_strength(white) < side_strength(black):
+        return f"{black}v{white}", True
+    return f"{white}v{black}", False
+
+def board_signature(board: chess.Board):
+    sides = []
+    for color in (chess.WHITE, chess.BLACK):
+        sides.append("".join(c * len(board.pieces(PIECE_TYPES[c], color)) for c in PIECE_ORDER))
+    return "v".join(sides)
+
+def has_pawns(sig):
+    return "P" in sig
+
+def table_pieces(sig):
+    """(piece type, color) of every piece in index order: both kings, then White's and Black's other pieces."""
+    white, black = sig.split("v")
+    pieces = [(chess.KING, chess.WHITE), (chess.KING, chess.BLACK)]
+    pieces += [(PIECE_TYPES[c], chess.WHITE) for c in white[1:]]
+    pieces += [(PIECE_TYPES[c], chess.BLACK) for c in black[1:]]
+    return pieces
+
+def table_size(sig):
+    """Number of indices (states per side to move)."""
+    return len(KK_PAIRS[has_pawns(sig)]) * 64 ** (len(table_pieces(sig)) - 2)
+
+def dependencies(sig):
+    """Canonical signatures reachable by one capture and/or promotion."""
+    white, black = sig.split("v")
+    deps = set()
+    for side, other, white_side in ((white, black, True), (black, white, False)):
+        for i, c in enumerate(side[1:], 1):
+            # a capture of this piece
+            rest = side[:i] + side[i + 1:]
+            deps.add(normalize_signature(f"{rest}v{other}" if white_side else f"{other}v{rest}")[0])
+            if c != "P":
+                continue
+            # a promotion of it, with or without a capture
+            for promo in "QRBN":
+                promoted = normalize_side(rest + promo)
+                deps.add(normalize_signature(f"{promoted}v{other}" if white_side else f"{other}v{promoted}")[0])
+                for j in range(1, len(other)):
+                    captured = other[:j] + other[j + 1:]
+                    deps.add(normalize_signature(f"{promoted}v{captured}" if white_side else f"{captured}v{promoted}")[0])
+    return deps
+
+def all_signatures(max_pieces):
+    """Every canonical signature with at most max_pieces pieces, kings included."""
+    def sides(n):
+        if n == 0:
+            return [""]
+        result = set()
+        for rest in sides(n - 1):
+            for c in "QRBNP":
+                result.add(normalize_side(rest + c))
+        return sorted(result)
+
+    sigs = set()
+    for n in range(0, max_pieces - 1):
+        for w in range(n + 1):
+            for white in sides(w):
+                for black in sides(n - w):
+                    sigs.add(normalize_signature(f"K{white}vK{black}")[0])
+    return sorted(sigs, key=generation_level)
+
+def generation_level(sig):
+    # a table only depends on tables with fewer pieces, or as many with fewer pawns
+    return (len(sig) - 1, sig.count("P"), sig)
+
+
+# Symmetry and Indexing
+def canonical_transform(squares, pawns):
+    """
+    The flips (horizontal, vertical, diagonal, second diagonal) that bring a position, squares in
+    table_pieces order, into its canonical form: one index per position up to symmetry.
+    """
+    wk, bk = squares[0], squares[1]
+    hflip = square_file(wk) > 3
+    if hflip:
+        wk ^= 7
+        bk ^= 7
+    if pawns:
+        return hflip, False, False, False
+    vflip = square_rank(wk) > 3
+    if vflip:
+        wk ^= 56
+        bk ^= 56
+    dflip = square_rank(wk) > square_file(wk)
+    if dflip:
+        wk, bk = flip_diagonal(wk), flip_diagonal(bk)
+
+    # the white king on the diagonal: the black king goes below it, or when it's on it too,
+    # the first piece that isn't
+    dflip2 = False
+    if square_rank(wk) == square_file(wk):
+        for sq in [bk] + [apply_transform(sq, (hflip, vflip, dflip, False)) for sq in squares[2:]]:
+            if square_rank(sq) != square_file(sq):
+                dflip2 = square_rank(sq) > square_file(sq)
+                break
+    return hflip, vflip, dflip, dflip2
+
+def flip_diagonal(sq):
+    return ((sq & 7) << 3) | (sq >> 3)
+
+def apply_transform(sq, transform):
+    hflip, vflip, dflip, dflip2 = transform
+    if hflip:
+        sq ^= 7
+    if vflip:
+        sq ^= 56
+    if dflip:
+        sq = flip_diagonal(sq)
+    if dflip2:
+        sq = flip_diagonal(sq)
+    return sq
+
+def encode(board: chess.Board):
+    """
+    Returns (signature, index, white_to_move) of the board in its canonical table.
+    The position is color-flipped when its material is stored the other way round.
+    """
+    sig, flipped = normalize_signature(board_signature(board))
+
+    squares = {}
+    for sq, piece in board.piece_map().items():
+        color = piece.color != flipped
+        if flipped:
+            sq ^= 56
+        squares.setdefault((piece.piece_type, color), []).append(sq)
+    white_to_move = board.turn != flipped
+
+    ordered = []
+    for piece in table_pieces(sig):
+        ordered.append(squares[piece].pop())
+
+    pawns = has_pawns(sig)
+    transform = canonical_transform(ordered, pawns)
+    ordered = [apply_transform(sq, transform) for sq in ordered]
+
+    index = KK_INDEX[pawns][ordered[0] * 64 + ordered[1]]
+    for sq in ordered[2:]:
+        index = index * 64 + sq
+    return sig, index, white_to_move
+
+def state_index(sig, index, white_to_move):
+    # white-to-move states first, then black-to-move
+    return index if white_to_move else table_size(sig) + index
+
+
+# Files
+def table_path(directory, sig, suffix):
+    return os.path.join(directory, sig + suffix)
+
+def write_header(f, kind, sig, size):
+    f.write(HEADER.pack(MAGIC, VERSION, kind, 0, size, sig.encode("ascii")))
+
+def read_header(data, sig, kind):
+    """Checks a table file header, returns the number of states per side to move."""
+    magic, version, file_kind, _, size, file_sig = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or file_kind != kind:
+        raise IOError(f"invalid tablebase file for {sig}")
+    if file_sig.rstrip(b"\0").decode("ascii") != sig or size != table_size(sig):
+        raise IOError(f"tablebase file does not match {sig}")
+    return size
+
+
+# Probing
+class Table:
+    # one signature's two files, memory mapped on first use
+    def __init__(self, sig, wdl_path, dtm_path):
+        self.sig = sig
+        self.size = table_size(sig)
+        self.wdl_path = wdl_path
+        self.dtm_path = dtm_path
+        self.wdl_data = None
+        self.dtm_data = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            if self.wdl_data is not None:
+                return
+            wdl_data = self._map(self.wdl_path, WDL_KIND)
+            try:
+                self.dtm_data = self._map(self.dtm_path, DTM_KIND)
+            except Exception:
+                wdl_data.close()
+                raise
+            self.wdl_data = wdl_data
+
+    def _map(self, path, kind):
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            read_header(data, self.sig, kind)
+        except Exception:
+            data.close()
+            raise
+        return data
+
+    def probe(self, state):
+        """(wdl, dtm) of a state, see state_index."""
+        wdl = (self.wdl_data[HEADER.size + (state >> 2)] >> (2 * (state & 3))) & 3
+        dtm, = struct.unpack_from("<H", self.dtm_data, HEADER.size + 2 * state)
+        return wdl, dtm
+
+    def close(self):
+        with self.lock:
+            for data in (self.wdl_data, self.dtm_data):
+                if data is not None:
+                    data.close()
+            self.wdl_data = self.dtm_data = None
+
+
+class Tablebase:
+    """
+    Reads the tables tbgen.py writes, modelled on chess.syzygy.Tablebase: directories are
+    scanned up front, files are memory mapped the first time a position needs them and only
+    max_fds of them stay open (two per table). The last cache_size results are kept in an LRU
+    keyed by zobrist hash, the search tends to probe the same endings over and over.
+    """
+
+    def __init__(self, max_fds=128, cache_size=65536):
+        self.max_fds = max_fds
+        self.lru = deque()
+        self.lru_lock = threading.Lock()
+        self.tables = {}
+        # most pieces (kings included) any loaded table has
+        self.max_pieces = 0
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        self.probes = 0
+        self.cache_hits = 0
+        # board signatures (as board_signature gives them) there's no table for
+        self.missing = set()
+
+    def _bump_lru(self, table):
+        if self.max_fds is None:
+            return
+
+        with self.lru_lock:
+            try:
+                self.lru.remove(table)
+            except ValueError:
+                pass
+            self.lru.appendleft(table)
+
+            # every table holds two files
+            while len(self.lru) * 2 > max(2, self.max_fds):
+                self.lru.pop().close()
+
+    def add_directory(self, directory):
+        """Adds every complete table (both files present) in directory, returns how many."""
+        num = 0
+        for filename in os.listdir(directory):
+            sig, ext = os.path.splitext(filename)
+            if ext != WDL_SUFFIX or "v" not in sig:
+                continue
+            try:
+                canonical = normalize_signature(sig)[0]
+            except ValueError:
+                continue
+            dtm_path = table_path(directory, sig, DTM_SUFFIX)
+            if canonical != sig or not os.path.isfile(dtm_path):
+                continue
+
+            old = self.tables.get(sig)
+            if old is not None:
+                old.close()
+            self.tables[sig] = Table(sig, os.path.join(directory, filename), dtm_path)
+            self.max_pieces = max(self.max_pieces, len(sig) - 1)
+            num += 1
+
+        with self.cache_lock:
+            self.cache.clear()
+        self.missing.clear()
+        return num
+
+    def covers(self, board: chess.Board):
+        # cheap test before hashing anything, the search calls this at every node
+        return (chess.popcount(board.occupied) <= self.max_pieces and not board.castling_rights)
+
+    def probe(self, board: chess.Board):
+        """
+        (wdl, dtm) of the position for the side to move: WIN, DRAW or LOSS and the plies to
+        mate. None when there's no table for it (or it has castling rights).
+        """
+        if not self.tables or not self.covers(board):
+            return None
+        # endings without a table never get an answer, and misses aren't cached: the
+        # signature tells them apart before hashing the position (en passant positions
+        # are answered by the tables of their captures)
+        sig = board_signature(board)
+        if sig in self.missing and board.ep_square is None:
+            return None
+
+        key = chess.polyglot.zobrist_hash(board)
+        with self.cache_lock:
+            self.probes += 1
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                return result
+
+        if board.has_legal_en_passant():
+            result = self._probe_children(board)
+        else:
+            result = self._probe_table(board)
+            if result is None:
+                self.missing.add(sig)
+        if result is None:
+            return None
+
+        with self.cache_lock:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def _probe_table(self, board):
+        sig, index, white_to_move = encode(board)
+        table = self.tables.get(sig)
+        if table is None:
+            return None
+        table.open()
+        self._bump_lru(table)
+        wdl, dtm = table.probe(state_index(sig, index, white_to_move))
+        if wdl == BROKEN:
+            raise KeyError(f"{board.fen()} is not a valid {sig} position")
+        return wdl, dtm
+
+    def _probe_children(self, board):
+        # the tables have no en passant, but when it's possible every move is a capture and
+        # the smaller tables know the answer
+        best = None
+        for move, wdl, dtm in self._probe_moves(board):
+            if wdl is None:
+                return None
+            value = _child_value(wdl, dtm)
+            if best is None or value > best:
+                best = value
+        if best is None:
+            return None
+        return _from_child_value(best)
+
+    def _probe_moves(self, board):
+        for move in forced_legal_moves(board):
+            board.push(move)
+            try:
+                result = self.probe(board)
+            finally:
+                board.pop()
+            if result is None:
+                yield move, None, None
+            else:
+                yield move, result[0], result[1]
+
+    def probe_wdl(self, board: chess.Board):
+        """1 for a win, 0 for a draw, -1 for a loss (side to move), None if not covered."""
+        result = self.probe(board)
+        if result is None:
+            return None
+        return {WIN: 1, DRAW: 0, LOSS: -1}[result[0]]
+
+    def probe_dtm(self, board: chess.Board):
+        """Plies to mate, positive when the side to move wins, 0 for draws, None if not covered."""
+        result = self.probe(board)
+        if result is None:
+            return None
+        wdl, dtm = result
+        return dtm if wdl == WIN else -dtm if wdl == LOSS else 0
+
+    def best_move(self, board: chess.Board):
+        """
+        The tablebase-optimal move and its (wdl, dtm) for the side to move: the fastest win,
+        otherwise a draw, otherwise the slowest loss. None if any move leaves the tables.
+        """
+        if not self.tables or not self.covers(board):
+            return None
+        best = None
+        for move, wdl, dtm in self._probe_moves(board):
+            if wdl is None:
+                return None
+            value = _child_value(wdl, dtm)
+            if best is None or value > best[0]:
+                best = value, move
+        if best is None:
+            return None
+        return best[1], _from_child_value(best[0])
+
+    def close(self):
+        with self.lru_lock:
+            self.lru.clear()
+        for table in self.tables.values():
+            table.close()
+        self.tables.clear()
+        self.max_pieces = 0
+        with self.cache_lock:
+            self.cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# a move's value to the mover from the child's (wdl, dtm), bigger is better:
+# quick wins > slow wins > draws > slow losses > quick losses
+def _child_value(wdl, dtm):
+    if wdl == LOSS:
+        return 100000 - dtm
+    if wdl == WIN:
+        return -100000 + dtm
+    return 0
+
+def _from_child_value(value):
+    if value > 0:
+        return WIN, 100000 - value + 1
+    if value < 0:
+        return LOSS, value + 100000 + 1
+    return DRAW, 0
@@ -0,0 +1,678 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+import chess
+
+import tablebase
+from tablebase import DRAW, WIN, LOSS, BROKEN, HEADER, table_pieces, table_size, has_pawns
+
+# Retrograde generator for the forced-capture tablebases described in tablebase.py.
+#
+# Positions are handled a chunk at a time as numpy arrays of squares (one row per piece),
+# so move generation, legality and indexing are all vectorized. A forward pass counts every
+# position's moves within the table and reads the value of every capture or promotion from
+# the smaller table that was generated before. Then a breadth-first pass from the mates
+# outwards, generating un-moves, resolves wins and losses ply by ply, which gives exact
+# distances to mate. Whatever is left unresolved is a draw. Nothing per move is stored, so
+# memory stays at a few bytes per position.
+#
+# Tables with the same number of pieces and pawns never depend on each other, so each such
+# level is generated in parallel with multiprocessing.
+
+UNRESOLVED = 4
+CHUNK = 1 << 16 # positions per vectorized batch
+NO_SQUARE = 64 # padding in the move tables, attacks nothing and is attacked by nothing
+INF_DTM = 1 << 30
+
+SLIDERS = (chess.BISHOP, chess.ROOK, chess.QUEEN)
+PROMOTIONS = (chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT)
+SYMBOLS = {piece_type: c for c, piece_type in tablebase.PIECE_TYPES.items()}
+
+
+# Move and attack tables, indexed by square (64 = no square)
+def _empty_board_attacks(piece_type, color, sq):
+    if piece_type == chess.PAWN:
+        return chess.BB_PAWN_ATTACKS[color][sq]
+    if piece_type == chess.KNIGHT:
+        return chess.BB_KNIGHT_ATTACKS[sq]
+    if piece_type == chess.KING:
+        return chess.BB_KING_ATTACKS[sq]
+    bb = 0
+    if piece_type in (chess.BISHOP, chess.QUEEN):
+        bb |= chess.BB_DIAG_ATTACKS[sq][0]
+    if piece_type in (chess.ROOK, chess.QUEEN):
+        bb |= chess.BB_FILE_ATTACKS[sq][0] | chess.BB_RANK_ATTACKS[sq][0]
+    return bb
+
+BIT = np.array([1 << sq for sq in range(64)] + [0], dtype=np.uint64)
+
+BETWEEN = np.zeros((65, 65), dtype=np.uint64)
+for _a in range(64):
+    for _b in range(64):
+        BETWEEN[_a, _b] = chess.between(_a, _b)
+
+# ATTACKS[piece_type, color][from, to]: does the piece attack to on an empty board
+ATTACKS = {}
+# TARGETS[piece_type][from]: the squares it can move to on an empty board, padded with 64
+TARGETS = {}
+for _piece_type in chess.PIECE_TYPES:
+    for _color in chess.COLORS:
+        table = np.zeros((65, 65), dtype=bool)
+        targets = []
+        for _sq in range(64):
+            squares = list(chess.scan_forward(_empty_board_attacks(_piece_type, _color, _sq)))
+            table[_sq, squares] = True
+            targets.append(squares)
+        ATTACKS[_piece_type, _color] = table
+        width = max(len(t) for t in targets)
+        padded = np.full((65, width), NO_SQUARE, dtype=np.int64)
+        for _sq, squares in enumerate(targets):
+            padded[_sq, :len(squares)] = squares
+        if _piece_type == chess.PAWN:
+            TARGETS[_piece_type, _color] = padded # pawn captures
+        else:
+            TARGETS[_piece_type] = padded
+
+KK_SQUARES = {pawns: np.array(pairs, dtype=np.int64) for pawns, pairs in tablebase.KK_PAIRS.items()}
+KK_INDEX = {pawns: np.array(index, dtype=np.int64) for pawns, index in tablebase.KK_INDEX.items()}
+
+
+# Indexing
+def decode(sig, index):
+    """Squares of every piece (rows in table_pieces order) for an array of indices."""
+    n = len(table_pieces(sig))
+    sq = np.empty((n, len(index)), dtype=np.int64)
+    rest = index
+    for row in range(n - 1, 1, -1):
+        sq[row] = rest & 63
+        rest = rest >> 6
+    kings = KK_SQUARES[has_pawns(sig)][rest]
+    sq[0] = kings[:, 0]
+    sq[1] = kings[:, 1]
+    return sq
+
+def flip_diagonal(sq):
+    return ((sq & 7) << 3) | (sq >> 3)
+
+def canonical_squares(sq, pawns):
+    # the same flips as tablebase.canonical_transform, one position per column
+    wk = sq[0]
+    sq = np.where((wk & 7) > 3, sq ^ 7, sq)
+    if pawns:
+        return sq
+    wk = sq[0]
+    sq = np.where((wk >> 3) > 3, sq ^ 56, sq)
+    wk = sq[0]
+    sq = np.where((wk >> 3) > (wk & 7), flip_diagonal(sq), sq)
+
+    wk = sq[0]
+    undecided = (wk >> 3) == (wk & 7)
+    flip = np.zeros(sq.shape[1], dtype=bool)
+    for row in sq[1:]:
+        off_diagonal = (row >> 3) != (row & 7)
+        flip |= undecided & off_diagonal & ((row >> 3) > (row & 7))
+        undecided &= ~off_diagonal
+    return np.where(flip, flip_diagonal(sq), sq)
+
+def signature(pieces):
+    sides = []
+    for color in chess.COLORS:
+        sides.append(tablebase.normalize_side("".join(SYMBOLS[t] for t, c in pieces if c == color)))
+    return "v".join(sides)
+
+def canonical_index(pieces, sq, white_to_move):
+    """(signature, indices, white_to_move) of positions with the given material in their canonical table."""
+    sig, flipped = tablebase.normalize_signature(signature(pieces))
+    if flipped:
+        pieces = [(t, not c) for t, c in pieces]
+        sq = sq ^ 56
+        white_to_move = not white_to_move
+
+    # rows in the table's piece order
+    order = []
+    for piece in table_pieces(sig):
+        order.append(next(i for i, p in enumerate(pieces) if p == piece and i not in order))
+    pawns = has_pawns(sig)
+    sq = canonical_squares(sq[order], pawns)
+
+    index = KK_INDEX[pawns][sq[0] * 64 + sq[1]]
+    for row in sq[2:]:
+        index = index * 64 + row
+    return sig, index, white_to_move
+
+
+# Position Helpers
+def occupancy(sq):
+    occ = np.zeros(sq.shape[1], dtype=np.uint64)
+    for row in sq:
+        occ |= BIT[row]
+    return occ
+
+def attacked(target, pieces, sq, by_color, occ):
+    hit = np.zeros(target.shape, dtype=bool)
+    for (piece_type, color), row in zip(pieces, sq):
+        if color != by_color:
+            continue
+        attack = ATTACKS[piece_type, color][row, target]
+        if piece_type in SLIDERS:
+            attack &= (BETWEEN[row, target] & occ) == 0
+        hit |= attack
+    return hit
+
+def valid_positions(pieces, sq):
+    # no two pieces on a square, no pawns on the first or last rank
+    ok = np.ones(sq.shape[1], dtype=bool)
+    for i, j in itertools.combinations(range(len(pieces)), 2):
+        ok &= sq[i] != sq[j]
+    for (piece_type, _), row in zip(pieces, sq):
+        if piece_type == chess.PAWN:
+            ok &= ((row >> 3) != 0) & ((row >> 3) != 7)
+    return ok
+
+def insufficient_material(pieces, sq):
+    # chess.Board.is_insufficient_material, which forced_moves_and_status calls a draw
+    size = sq.shape[1]
+    types = [t for t, _ in pieces]
+    if any(t in (chess.PAWN, chess.ROOK, chess.QUEEN) for t in types):
+        return np.zeros(size, dtype=bool)
+
+    parities = [((row >> 3) + (row & 7)) & 1 for (t, _), row in zip(pieces, sq) if t == chess.BISHOP]
+    same_color = np.ones(size, dtype=bool)
+    for parity in parities[1:]:
+        same_color &= parity == parities[0]
+
+    result = np.ones(size, dtype=bool)
+    for color in chess.COLORS:
+        own = [t for t, c in pieces if c == color]
+        other = [t for t, c in pieces if c != color]
+        if chess.KNIGHT in own:
+            result &= len(own) <= 2 and all(t in (chess.KING, chess.QUEEN) for t in other)
+        elif chess.BISHOP in own:
+            result &= same_color & (chess.KNIGHT not in types)
+    return result
+
+
+# Move Generation
+class MoveGroup(NamedTuple):
+    mask: np.ndarray # positions the move is legal in
+    pieces: Tuple # material after the move, rows of sq
+    sq: np.ndarray # squares after the move
+    capture: bool
+    en_passant: bool
+    ep_square: Optional[np.ndarray] # double pawn pushes: the square it can be taken en passant on
+
+def gen_moves(pieces, sq, stm, ep=None):
+    """
+    Forced-capture legal moves of the side to move, one group per (piece, target slot, capture,
+    promotion). Captures come first, quiet moves are only legal where no capture is.
+    ep is the en passant square per position (64 = none).
+    """
+    pieces = tuple(pieces)
+    occ = occupancy(sq)
+    own_occ = np.zeros(sq.shape[1], dtype=np.uint64)
+    for (_, color), row in zip(pieces, sq):
+        if color == stm:
+            own_occ |= BIT[row]
+    enemies = [j for j, (t, c) in enumerate(pieces) if c != stm and t != chess.KING]
+    king = pieces.index((chess.KING, stm))
+    forward = 8 if stm == chess.WHITE else -8
+    last_rank = 7 if stm == chess.WHITE else 0
+
+    def make(mover, to, captured=None, promotion=None, ep_capture=False, ep_square=None, ok=None):
+        child_pieces = list(pieces)
+        child_sq = sq.copy()
+        child_sq[mover] = to
+        if promotion:
+            child_pieces[mover] = (promotion, stm)
+        if captured is not None:
+            del child_pieces[captured]
+            child_sq = np.delete(child_sq, captured, axis=0)
+        # captured pieces are never kings, so our king keeps its row
+        legal = ok & ~attacked(child_sq[king], child_pieces, child_sq, not stm, occupancy(child_sq))
+        return MoveGroup(legal, tuple(child_pieces), child_sq, captured is not None, ep_capture, ep_square)
+
+    def promotions(to, ok):
+        promotes = (to >> 3) == last_rank
+        if not (ok & promotes).any():
+            return [(None, ok)]
+        return [(None, ok & ~promotes)] + [(p, ok & promotes) for p in PROMOTIONS]
+
+    captures = []
+    quiets = []
+    for i, (piece_type, color) in enumerate(pieces):
+        if color != stm:
+            continue
+        frm = sq[i]
+
+        if piece_type == chess.PAWN:
+            cap_targets = TARGETS[chess.PAWN, stm]
+            for k in range(cap_targets.shape[1]):
+                to = cap_targets[frm, k]
+                for j in enemies:
+                    hit = (to != NO_SQUARE) & (to == sq[j])
+                    for promotion, ok in promotions(to, hit):
+                        captures.append((i, to, j, promotion, False, ok))
+                if ep is not None:
+                    for j in enemies:
+                        if pieces[j][0] == chess.PAWN:
+                            hit = (to != NO_SQUARE) & (to == ep) & (sq[j] == to - forward)
+                            captures.append((i, to, j, None, True, hit))
+
+            to = frm + forward
+            empty = (BIT[to] & occ) == 0
+            for promotion, ok in promotions(to, empty):
+                quiets.append((i, to, promotion, None, ok))
+            start = (frm >> 3) == (1 if stm == chess.WHITE else 6)
+            to2 = np.where(start, frm + 2 * forward, NO_SQUARE)
+            ok = empty & start & ((BIT[to2] & occ) == 0)
+            quiets.append((i, to2, None, np.where(start, to, NO_SQUARE), ok))
+            continue
+
+        targets = TARGETS[piece_type]
+        for k in range(targets.shape[1]):
+            to = targets[frm, k]
+            ok = (to != NO_SQUARE) & ((BIT[to] & own_occ) == 0)
+            if piece_type in SLIDERS:
+                ok &= (BETWEEN[frm, to] & occ) == 0
+            if not ok.any():
+                continue
+            for j in enemies:
+                captures.append((i, to, j, None, False, ok & (to == sq[j])))
+            quiets.append((i, to, None, None, ok & ((BIT[to] & occ) == 0)))
+
+    any_capture = np.zeros(sq.shape[1], dtype=bool)
+    for i, to, j, promotion, ep_capture, ok in captures:
+        if not ok.any():
+            continue
+        group = make(i, to, captured=j, promotion=promotion, ep_capture=ep_capture, ok=ok)
+        any_capture |= group.mask
+        yield group
+
+    for i, to, promotion, ep_square, ok in quiets:
+        ok = ok & ~any_capture
+        if not ok.any():
+            continue
+        yield make(i, to, promotion=promotion, ep_square=ep_square, ok=ok)
+
+def legal_captures(pieces, sq, stm, ep=None):
+    """(any legal capture, any legal en passant capture) per position."""
+    found = np.zeros(sq.shape[1], dtype=bool)
+    en_passant = np.zeros(sq.shape[1], dtype=bool)
+    for group in gen_moves(pieces, sq, stm, ep=ep):
+        if not group.capture:
+            break
+        found |= group.mask
+        if group.en_passant:
+            en_passant |= group.mask
+    return found, en_passant
+
+def unmoves(pieces, sq, stm):
+    """
+    The other way round: positions one quiet move earlier, for positions with stm to move.
+    Yields (columns, squares before the move) per piece and slot, only where that move was
+    legal, which under forced capture means the side that made it had no capture.
+    """
+    them = not stm
+    occ = occupancy(sq)
+    back = -8 if them == chess.WHITE else 8
+    king = pieces.index((chess.KING, stm))
+
+    for i, (piece_type, color) in enumerate(pieces):
+        if color != them:
+            continue
+        to = sq[i]
+
+        slots = []
+        if piece_type == chess.PAWN:
+            frm = to + back
+            first_rank = 0 if them == chess.WHITE else 7
+            slots.append((frm, ((BIT[frm] & occ) == 0) & ((frm >> 3) != first_rank), None))
+            # a double push, unless it let us take en passant (then it's not a move within the table)
+            pushed = (to >> 3) == (3 if them == chess.WHITE else 4)
+            frm2 = np.where(pushed, to + 2 * back, NO_SQUARE)
+            ok = pushed & ((BIT[to + back] & occ) == 0) & ((BIT[frm2] & occ) == 0)
+            slots.append((frm2, ok, np.where(pushed, to + back, NO_SQUARE)))
+        else:
+            targets = TARGETS[piece_type]
+            for k in range(targets.shape[1]):
+                frm = targets[to, k]
+                ok = (frm != NO_SQUARE) & ((BIT[frm] & occ) == 0)
+                if piece_type in SLIDERS:
+                    ok &= (BETWEEN[to, frm] & occ) == 0
+                slots.append((frm, ok, None))
+
+        for frm, ok, ep_square in slots:
+            if not ok.any():
+                continue
+            before = sq.copy()
+            before[i] = frm
+            # the side that didn't move can't have been in check
+            ok = ok & ~attacked(before[king], pieces, before, them, occupancy(before))
+            cols = np.flatnonzero(ok)
+            if not len(cols):
+                continue
+            had_capture, _ = legal_captures(pieces, before[:, cols], them)
+            keep = ~had_capture
+            if ep_square is not None:
+                _, en_passant = legal_captures(pieces, sq[:, cols], stm, ep=ep_square[cols])
+                keep &= ~en_passant
+            yield cols[keep], before[:, cols[keep]]
+
+
+# Values
+def load_table(directory, sig):
+    """(unpacked WDL, DTM) arrays of a generated table, white-to-move states first."""
+    size = table_size(sig)
+    with open(tablebase.table_path(directory, sig, tablebase.WDL_SUFFIX), "rb") as f:
+        tablebase.read_header(f.read(HEADER.size), sig, tablebase.WDL_KIND)
+        packed = np.fromfile(f, dtype=np.uint8)
+    with open(tablebase.table_path(directory, sig, tablebase.DTM_SUFFIX), "rb") as f:
+        tablebase.read_header(f.read(HEADER.size), sig, tablebase.DTM_KIND)
+        dtm = np.fromfile(f, dtype="<u2")
+    wdl = np.empty(len(packed) * 4, dtype=np.uint8)
+    for shift in range(4):
+        wdl[shift::4] = (packed >> (2 * shift)) & 3
+    return wdl[:2 * size], dtm
+
+class SubTables:
+    # the smaller tables captures and promotions lead into, loaded once per generator run
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+
+    def probe(self, pieces, sq, white_to_move):
+        sig, index, white_to_move = canonical_index(pieces, sq, white_to_move)
+        if sig not in self.tables:
+            self.tables[sig] = load_table(self.directory, sig)
+        wdl, dtm = self.tables[sig]
+        state = index if white_to_move else index + table_size(sig)
+        return wdl[state], dtm[state]
+
+    def probe_group(self, group, white_to_move):
+        # values from the side to move after the move, only filled in where it's legal
+        cols = np.flatnonzero(group.mask)
+        wdl = np.full(len(group.mask), DRAW, dtype=np.uint8)
+        dtm = np.zeros(len(group.mask), dtype=np.uint16)
+        wdl[cols], dtm[cols] = self.probe(group.pieces, group.sq[:, cols], white_to_move)
+        return wdl, dtm
+
+def best_value(children, size):
+    """Combines (mask, wdl, dtm) of every move, seen from the opponent, into the mover's values."""
+    win = np.full(size, INF_DTM, dtype=np.int64)
+    all_won = np.ones(size, dtype=bool)
+    any_move = np.zeros(size, dtype=bool)
+    longest = np.zeros(size, dtype=np.int64)
+    for mask, wdl, dtm in children:
+        dtm = dtm.astype(np.int64) + 1
+        any_move |= mask
+        win = np.where(mask & (wdl == LOSS), np.minimum(win, dtm), win)
+        all_won &= ~mask | (wdl == WIN)
+        longest = np.where(mask, np.maximum(longest, dtm), longest)
+
+    wdl = np.full(size, DRAW, dtype=np.uint8)
+    dtm = np.zeros(size, dtype=np.uint16)
+    won = win < INF_DTM
+    lost = ~won & all_won & any_move
+    wdl[won], dtm[won] = WIN, win[won]
+    wdl[lost], dtm[lost] = LOSS, longest[lost]
+    return wdl, dtm
+
+def en_passant_values(tables, pieces, sq, stm, ep):
+    """
+    Positions right after a double pawn push: where the pawn can be taken en passant the table
+    (which has no en passant) is wrong, but every move there is a capture so the smaller tables
+    know the answer. Returns (has_ep, wdl, dtm) with values for the has_ep positions.
+    """
+    has_ep = np.zeros(sq.shape[1], dtype=bool)
+    for group in gen_moves(pieces, sq, stm, ep=ep):
+        if group.en_passant:
+            has_ep |= group.mask
+    if not has_ep.any():
+        return has_ep, None, None
+
+    cols = np.flatnonzero(has_ep)
+    children = [(group.mask, *tables.probe_group(group, not stm))
+                for group in gen_moves(pieces, sq[:, cols], stm, ep=ep[cols])]
+    wdl, dtm = best_value(children, len(cols))
+    return has_ep, wdl, dtm
+
+
+# Generation
+def generate_table(sig, directory):
+    """Generates one table, the ones it depends on have to be in directory already."""
+    start_time = time.time()
+    pieces = table_pieces(sig)
+    size = table_size(sig)
+    tables = SubTables(directory)
+
+    wdl = np.full(2 * size, UNRESOLVED, dtype=np.uint8)
+    dtm = np.zeros(2 * size, dtype=np.uint16)
+    # moves to other states of this table, counted by distinct successor (+1 if some other move draws)
+    remaining = np.zeros(2 * size, dtype=np.uint8)
+    # moves into other tables: the quickest win through one, and the slowest loss
+    ext_win = np.zeros(2 * size, dtype=np.uint16)
+    ext_loss = np.zeros(2 * size, dtype=np.uint16)
+
+    for chunk_start in range(0, size, CHUNK):
+        index = np.arange(chunk_start, min(size, chunk_start + CHUNK), dtype=np.int64)
+        sq = decode(sig, index)
+        # only canonical indices are positions, the rest are symmetric duplicates that are never probed
+        valid = valid_positions(pieces, sq) & (canonical_index(pieces, sq, True)[1] == index)
+        insufficient = insufficient_material(pieces, sq)
+        occ = occupancy(sq)
+
+        for stm in chess.COLORS:
+            states = index if stm == chess.WHITE else index + size
+            # the side that just moved can't be in check
+            legal = valid & ~attacked(sq[pieces.index((chess.KING, not stm))], pieces, sq, stm, occ)
+            wdl[states[~legal]] = BROKEN
+            cols = np.flatnonzero(legal)
+            if not len(cols):
+                continue
+            pos_sq, pos_states = sq[:, cols], states[cols]
+
+            count = np.zeros(len(cols), dtype=np.int64)
+            children = []
+            internal_src, internal_dst = [], []
+            for group in gen_moves(pieces, pos_sq, stm):
+                count += group.mask
+                mask = group.mask
+                if group.pieces != tuple(pieces):
+                    # capture or promotion, the smaller table has the value
+                    children.append((mask, *tables.probe_group(group, not stm)))
+                    continue
+
+                if group.ep_square is not None:
+                    has_ep, ep_wdl, ep_dtm = en_passant_values(tables, group.pieces, group.sq[:, mask],
+                                                               not stm, group.ep_square[mask])
+                    if has_ep.any():
+                        ep_cols = np.flatnonzero(mask)[has_ep]
+                        child_wdl = np.full(len(cols), DRAW, dtype=np.uint8)
+                        child_dtm = np.zeros(len(cols), dtype=np.uint16)
+                        child_wdl[ep_cols], child_dtm[ep_cols] = ep_wdl, ep_dtm
+                        ep_mask = np.zeros(len(cols), dtype=bool)
+                        ep_mask[ep_cols] = True
+                        children.append((ep_mask, child_wdl, child_dtm))
+                        mask = mask & ~ep_mask
+
+                _, child_index, child_white = canonical_index(group.pieces, group.sq[:, mask], not stm)
+                internal_src.append(np.flatnonzero(mask))
+                internal_dst.append(child_index if child_white else child_index + size)
+
+            # symmetric moves can lead to the same state, which the retrograde pass sees once
+            if internal_src:
+                pairs = np.unique(np.concatenate(internal_src) * (2 * size) + np.concatenate(internal_dst))
+                src, n = np.unique(pairs // (2 * size), return_counts=True)
+                remaining[pos_states[src]] = n
+
+            for mask, child_wdl, child_dtm in children:
+                child_dtm = child_dtm.astype(np.int64) + 1
+                won = mask & (child_wdl == LOSS)
+                best = ext_win[pos_states].astype(np.int64)
+                best[best == 0] = INF_DTM
+                ext_win[pos_states] = np.where(won, np.minimum(best, child_dtm), ext_win[pos_states])
+                lost = mask & (child_wdl == WIN)
+                ext_loss[pos_states] = np.where(lost, np.maximum(ext_loss[pos_states], child_dtm), ext_loss[pos_states])
+                # a drawing move means we never lose
+                remaining[pos_states[mask & (child_wdl == DRAW)]] += 1
+
+            in_check = attacked(pos_sq[pieces.index((chess.KING, stm))], pieces, pos_sq, not stm, occupancy(pos_sq))
+            # same order as forced_moves_and_status: mate/stalemate, then insufficient material
+            mated = (count == 0) & in_check
+            drawn = ((count == 0) & ~in_check) | ((count > 0) & insufficient[cols])
+            wdl[pos_states[mated]] = LOSS
+            wdl[pos_states[drawn]] = DRAW
+
+    retrograde(sig, wdl, dtm, remaining, ext_win, ext_loss)
+    write_table(directory, sig, wdl, dtm)
+
+    counts = np.bincount(wdl, minlength=4)
+    return (f"{sig}: {counts[WIN]} won, {counts[DRAW]} drawn, {counts[LOSS]} lost, "
+            f"longest mate {int(dtm.max())} plies, {time.time() - start_time:.1f}s")
+
+def predecessors(sig, states):
+    """(state, predecessor) pairs for every quiet move within the table that leads to states."""
+    pieces = table_pieces(sig)
+    size = table_size(sig)
+    for stm in chess.COLORS:
+        selected = states[(states < size) == stm]
+        for chunk_start in range(0, len(selected), CHUNK):
+            chunk = selected[chunk_start:chunk_start + CHUNK]
+            sq = decode(sig, chunk if stm == chess.WHITE else chunk - size)
+            for cols, before in unmoves(pieces, sq, stm):
+                _, index, white_to_move = canonical_index(pieces, before, not stm)
+                yield chunk[cols], index if white_to_move else index + size
+
+def retrograde(sig, wdl, dtm, remaining, ext_win, ext_loss):
+    """
+    Resolves the UNRESOLVED states in place, one ply of distance to mate per pass: a move to a
+    state lost in n plies wins in n + 1, and a state whose moves all lead to won states is lost
+    once the slowest of them is known.
+    """
+    n_states = len(wdl)
+    unresolved = wdl == UNRESOLVED
+
+    # wins through a capture or promotion, in the order they become the quickest possible
+    ext_won = np.flatnonzero(unresolved & (ext_win > 0))
+    ext_won = ext_won[np.argsort(ext_win[ext_won], kind="stable")]
+    ext_won_plies = ext_win[ext_won]
+
+    # losses that wait for the slowest move into another table
+    pending = {}
+    def schedule(states, plies):
+        for p in np.unique(plies):
+            pending.setdefault(int(p), []).append(states[plies == p])
+
+    lost_outside = np.flatnonzero(unresolved & (remaining == 0) & (ext_win == 0) & (ext_loss > 0))
+    schedule(lost_outside, ext_loss[lost_outside])
+
+    lost = np.flatnonzero(wdl == LOSS) # mated
+    won = np.zeros(0, dtype=np.int64)
+    plies = 1
+    while len(lost) or len(won) or pending or (len(ext_won_plies) and ext_won_plies[-1] >= plies):
+        # a move to a lost position wins
+        lo, hi = np.searchsorted(ext_won_plies, [plies, plies + 1])
+        new_won = [ext_won[lo:hi]] + [p for _, p in predecessors(sig, lost)]
+        new_won = np.unique(np.concatenate(new_won))
+        new_won = new_won[wdl[new_won] == UNRESOLVED]
+        wdl[new_won] = WIN
+        dtm[new_won] = plies
+
+        # one fewer move that doesn't lose, counted once per (state, predecessor)
+        new_lost = pending.pop(plies, [])
+        pairs = [s * n_states + p for s, p in predecessors(sig, won)]
+        if pairs:
+            preds, counts = np.unique(np.unique(np.concatenate(pairs)) % n_states, return_counts=True)
+            remaining[preds] -= counts.astype(np.uint8)
+            done = preds[(remaining[preds] == 0) & (wdl[preds] == UNRESOLVED) & (ext_win[preds] == 0)]
+            later = ext_loss[done] > plies
+            schedule(done[later], ext_loss[done[later]])
+            new_lost.append(done[~later])
+        new_lost = np.concatenate(new_lost) if new_lost else np.zeros(0, dtype=np.int64)
+        new_lost = new_lost[wdl[new_lost] == UNRESOLVED]
+        wdl[new_lost] = LOSS
+        dtm[new_lost] = plies
+
+        lost, won = new_lost, new_won
+        plies += 1
+
+    wdl[wdl == UNRESOLVED] = DRAW
+
+def write_table(directory, sig, wdl, dtm):
+    size = len(wdl) // 2
+    padded = np.concatenate([wdl, np.zeros(-len(wdl) % 4, dtype=np.uint8)])
+    packed = padded[0::4] | (padded[1::4] << 2) | (padded[2::4] << 4) | (padded[3::4] << 6)
+
+    # written under a temporary name so a half-written table is never picked up
+    for suffix, kind, data in ((tablebase.WDL_SUFFIX, tablebase.WDL_KIND, packed),
+                               (tablebase.DTM_SUFFIX, tablebase.DTM_KIND, dtm.astype("<u2"))):
+        path = tablebase.table_path(directory, sig, suffix)
+        with open(path + ".tmp", "wb") as f:
+            tablebase.write_header(f, kind, sig, size)
+            data.tofile(f)
+        os.replace(path + ".tmp", path)
+
+def _generate_one(args):
+    return generate_table(*args)
+
+def generate(signatures, directory, workers=1, force=False, log=print):
+    """Generates the tables (and everything they depend on) that aren't in directory yet."""
+    os.makedirs(directory, exist_ok=True)
+
+    needed = set()
+    stack = [tablebase.normalize_signature(sig)[0] for sig in signatures]
+    while stack:
+        sig = stack.pop()
+        if sig not in needed:
+            needed.add(sig)
+            stack.extend(tablebase.dependencies(sig))
+
+    def exists(sig):
+        return all(os.path.exists(tablebase.table_path(directory, sig, suffix))
+                   for suffix in (tablebase.WDL_SUFFIX, tablebase.DTM_SUFFIX))
+    requested = {tablebase.normalize_signature(sig)[0] for sig in signatures}
+    todo = sorted((sig for sig in needed if not exists(sig) or (force and sig in requested)),
+                  key=tablebase.generation_level)
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for _, level in itertools.groupby(todo, key=lambda sig: tablebase.generation_level(sig)[:2]):
+            tasks = [(sig, directory) for sig in level]
+            results = pool.imap_unordered(_generate_one, tasks) if pool and len(tasks) > 1 else map(_generate_one, tasks)
+            for summary in results:
+                log(summary)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return todo
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate forced-capture chess endgame tablebases")
+    parser.add_argument("signatures", nargs="*", help="material signatures, e.g. KQvK KRPvKR")
+    parser.add_argument("--max-pieces", type=int, default=None, help="generate every table with up to this many pieces")
+    parser.add_argument("-d", "--directory", default="tables")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true", help="regenerate the named tables even if they exist")
+    args = parser.parse_args()
+
+    signatures = list(args.signatures)
+    if args.max_pieces:
+        if args.max_pieces > tablebase.MAX_PIECES:
+            parser.error(f"at most {tablebase.MAX_PIECES} pieces")
+        signatures += tablebase.all_signatures(args.max_pieces)
+    if not signatures:
+        parser.error("no tables given")
+
+    generate(signatures, args.directory, workers=args.workers, force=args.force,
+             log=lambda msg: print(msg, file=sys.stderr, flush=True))
+
+if __name__ == "__main__":
+    main()
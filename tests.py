@@ -1,9 +1,34 @@
 import chess
+import chess.pgn
+import chess.polyglot
+import io
+import json
+import os
+import shutil
+import sys
+import asyncio
+import threading
+import random
+import struct
+import subprocess
 import pytest
 
-from bbsearch import minimax, TT, order_moves, quiescence_search, iterative_deepening
-from forced_chess import forced_legal_moves
-from transposition import Transposition_Table
+import bbsearch
+from bbsearch import minimax, TT, order_moves, quiescence_search, iterative_deepening, RepetitionStack
+from forced_chess import forced_legal_moves, forced_moves_and_status, CHECKMATE, STALEMATE
+from transposition import Transposition_Table, Mapped_Transposition_Table, ENTRY_SIZE, MAX_HASH_MB
+import pns
+from timeman import TimeManager
+from uci import UciEngine, uci_score
+from engine import WinBoardEngine
+from book import OpeningBook
+import book_builder
+from analysis_cache import AnalysisCache, mate_from
+import tablebase
+import match
+import bench
+import host
+from benchmarks import microbench, startup
 
 
 def run_test(fen, depth):
@@ -58,6 +83,20 @@ def test_iterative_deepening_returns_legal_pv_and_len_limit():
     assert len(res.pv) <= 2 or len(res.pv) <= 256
 
 
+def test_pv_comes_from_the_triangular_table():
+    board = chess.Board("8/6pk/1p6/8/PP3p1p/5P2/4KP1q/3Q4 w - - 0 1")
+    TT.clear()
+    res = iterative_deepening(board, max_depth=4)
+    # the whole line down to the horizon, no matter what the TT kept
+    assert len(res.pv) == res.depth
+    assert res.pv[0] == res.best_move
+    assert res.pv == bbsearch.searcher.pv_table[0]
+    b = board.copy()
+    for mv in res.pv:
+        assert mv in forced_legal_moves(b)
+        b.push(mv)
+
+
 def test_minimax_populates_tt():
     board = chess.Board()
     before = TT.count_used()
@@ -212,8 +251,859 @@ def test_search_respects_forced_captures():
     assert board.is_capture(res.best_move)
 
 
+def test_forced_moves_and_status_reports_terminal_positions():
+    mated = chess.Board("r1bqkb1r/pppp1Qpp/2n2n2/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 0 4")
+    assert forced_moves_and_status(mated) == ([], CHECKMATE)
+
+    stalemated = chess.Board("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1")
+    assert forced_moves_and_status(stalemated) == ([], STALEMATE)
+
+    board = chess.Board()
+    moves, status = forced_moves_and_status(board)
+    assert status is None
+    assert moves == forced_legal_moves(board)
+
+    # mate found by minimax from the fused status, without going through quiescence
+    score, mv = minimax(mated, 3, -999999, 999999, mated.turn, 2)
+    assert score == 30000 - 2 and mv is None
+
+
+def test_repetition_stack_twofold_in_search_threefold_in_history():
+    shuffle = ["Nf3", "Nf6", "Ng1", "Ng8"]
+    start_key = chess.polyglot.zobrist_hash(chess.Board())
+
+    # twofold inside the search path is already a draw
+    stack = RepetitionStack()
+    board = chess.Board()
+    stack.reset(board)
+    for san in shuffle:
+        stack.push(chess.polyglot.zobrist_hash(board))
+        board.push_san(san)
+    assert stack.is_repetition(start_key, board.halfmove_clock)
+
+    # against the game history it takes a threefold
+    board = chess.Board()
+    for san in shuffle:
+        board.push_san(san)
+    stack.reset(board)
+    assert not stack.is_repetition(start_key, board.halfmove_clock)
+
+    for san in shuffle:
+        board.push_san(san)
+    stack.reset(board)
+    assert stack.is_repetition(start_key, board.halfmove_clock)
+
+    # nothing before the last irreversible move can repeat
+    assert not stack.is_repetition(start_key, 0)
+
+
+def test_pns_proves_and_disproves_mates():
+    pns.PROOF_TT.clear()
+    board = chess.Board("7k/8/5K2/8/8/8/8/R7 w - - 0 1")
+    res = pns.solve(board, max_nodes=1000)
+    assert res.status == pns.PROVEN
+    b = board.copy()
+    for mv in res.pv:
+        assert mv in forced_legal_moves(b)
+        b.push(mv)
+    assert b.is_checkmate()
+
+    # lone king can't mate anybody
+    res = pns.solve(chess.Board("8/8/8/8/8/2k5/3p4/3K4 w - - 0 1"), max_nodes=1000)
+    assert res.status == pns.DISPROVEN and res.best_move is None
+
+
+def test_iterative_deepening_uses_pns_when_winning_big():
+    board = chess.Board("7k/8/5K2/8/8/8/8/Q7 w - - 0 1")
+    res = iterative_deepening(board, max_depth=1, pns_nodes=1000)
+    assert res.score >= 29000
+    assert res.best_move in forced_legal_moves(board)
+
+
+def test_iterative_deepening_reports_stats(tmp_path):
+    board = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+    stats_file = tmp_path / "stats.jsonl"
+    res = iterative_deepening(board, max_depth=3, stats_file=str(stats_file))
+    stats = res.stats
+
+    assert stats.nodes > 0 and stats.qnodes > 0
+    # one probe per minimax node at most, move ordering reuses it
+    assert stats.tt_hits <= stats.tt_probes <= stats.nodes
+    assert stats.first_move_cutoffs <= stats.beta_cutoffs
+    assert [it.depth for it in stats.iterations] == [1, 2, 3]
+    assert sum(it.nodes for it in stats.iterations) == stats.total_nodes
+
+    lines = stats_file.read_text().splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[-1])["total_nodes"] == stats.total_nodes
+
+
+def test_time_manager_limits_and_stability():
+    tm = TimeManager()
+    tm.set_level(40, 60, 1)
+    tm.start(30.0, moves_to_go=20, opp_time=30.0)
+    assert 0 < tm.soft_limit <= tm.hard_limit <= 30.0 * 0.5
+    # the increment is part of the budget
+    assert tm.soft_limit > 30.0 / 20
+
+    # a next iteration that can't finish before the hard limit isn't started
+    assert tm.should_stop(last_iteration_time=tm.hard_limit, ebf=4.0)
+    assert not tm.should_stop(last_iteration_time=0.0, ebf=4.0)
+
+    # best move flipping around extends the soft limit, a settled one shrinks it
+    tm.iteration_done(chess.Move.from_uci("e2e4"))
+    tm.iteration_done(chess.Move.from_uci("d2d4"))
+    assert tm.scale > 1.0
+    for _ in range(3):
+        tm.iteration_done(chess.Move.from_uci("d2d4"))
+    assert tm.scale < 1.0
+
+    tm.set_fixed_time(2)
+    tm.start(0.0)
+    assert tm.soft_limit == tm.hard_limit and tm.hard_limit < 2
+
+
+def test_iterative_deepening_aborts_at_hard_limit():
+    board = chess.Board("r2q1rk1/ppp2ppp/2np1n2/2b1p1B1/2B1P1b1/2NP1N2/PPP2PPP/R2Q1RK1 w - - 0 8")
+    fen = board.fen()
+    res = iterative_deepening(board, max_depth=50, time_limit=0.5)
+    assert res.best_move in forced_legal_moves(board)
+    assert res.time_taken < 5
+    # the aborted iteration didn't leave moves on the caller's board
+    assert board.fen() == fen
+
+
+def test_iterative_deepening_on_info_and_stop_signal():
+    board = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+    infos = []
+    res = iterative_deepening(board, max_depth=2, on_info=lambda *info: infos.append(info))
+    # one line per finished iteration, the last one carries the final PV
+    assert [info[0] for info in infos][-1] == 2
+    assert infos[-1][4] == res.pv
+
+    bbsearch.stop_signal.set()
+    try:
+        res = iterative_deepening(board, max_depth=10)
+    finally:
+        bbsearch.stop_signal.clear()
+    # stopped before the first iteration finished: still a move to play, the first ordered one
+    assert res.depth == 0 and not res.exact
+    assert res.pv == [res.best_move] and res.best_move == bbsearch.order_moves(board, forced_legal_moves(board))[0]
+
+    # the limits hold from the first iteration on
+    res = iterative_deepening(board, max_depth=10, max_nodes=1)
+    assert res.depth == 0 and res.best_move in forced_legal_moves(board) and res.stats.total_nodes <= 2
+
+
+def test_uci_position_is_incremental_and_scores_are_side_to_move():
+    engine = UciEngine()
+    engine.set_position("startpos moves e2e4 e7e5")
+    board = engine.board
+    engine.set_position("startpos moves e2e4 e7e5 g1f3")
+    # same game plus one move: the board is reused, not rebuilt
+    assert engine.board is board
+    assert engine.board.fen() == "rnbqkbnr/pppp1ppp/8/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2"
+
+    engine.set_position("fen 8/8/8/8/8/2k5/3p4/3K4 w - - 0 1 moves d1e2")
+    assert engine.board is not board
+    assert engine.board.fen() == "8/8/8/8/8/2k5/3pK3/8 b - - 1 1"
+
+    # bad input is reported, not raised: the position stops at the last good move
+    engine.debug = lambda msg: None
+    engine.set_position("startpos moves e2e4 e7e5 e1e8 g1f3")
+    assert engine.moves == ["e2e4", "e7e5"]
+    assert engine.board.fen() == "rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2"
+    engine.set_position("startpos moves e2e4 zz99")
+    assert engine.moves == ["e2e4"]
+    engine.set_position("fen not a fen")
+    assert engine.moves == ["e2e4"]
+
+    # the advertised Hash is the real table's, unknown go arguments are skipped
+    sent = []
+    engine.send = sent.append
+    engine.handle_command("uci")
+    assert f"option name Hash type spin default {TT.size_mb()} min 1 max {MAX_HASH_MB}" in sent
+    engine.handle_command("go searchmoves e7e5 d7d5 depth 1 bogus")
+    engine.search_thread.join()
+    assert sent[-1].startswith("bestmove ")
+
+    black_to_move = chess.Board("8/8/8/8/8/2k5/3p4/3K4 b - - 0 1")
+    assert uci_score(150, black_to_move) == "cp -150"
+    assert uci_score(-(30000 - 3), black_to_move) == "mate 2"
+
+    # a PNS mate has no length in its score, the proof line gives it
+    mate_line = [chess.Move.from_uci(m) for m in ("c3d3", "d1c1", "d2d1q")]
+    assert uci_score(-bbsearch.PNS_MATE_SCORE, black_to_move, mate_line) == "mate 2"
+    assert uci_score(bbsearch.PNS_MATE_SCORE, black_to_move) == "mate -1"
+
+    # fens without the move counters
+    engine.set_position("fen 8/8/8/8/8/2k5/3p4/3K4 b - - moves c3d3")
+    assert engine.board.fen() == "8/8/8/8/8/3k4/3p4/3K4 w - - 1 2"
+    assert engine.moves == ["c3d3"]
+
+
+def test_xboard_memory_resizes_the_tt_and_thinking_reports_hashfull():
+    tt = Transposition_Table(size=4000)
+    assert tt.hashfull() == 0
+    for key in range(0, 1000, 4):
+        tt.store(None, 1, 0, "EXACT", best_move=None, key=key)
+    # a quarter of the sampled slots
+    assert tt.hashfull() == 250
+
+    engine = WinBoardEngine()
+    sent = []
+    engine.send = sent.append
+    size = TT.size
+    try:
+        engine.handle_command("protover 2")
+        assert "memory=1" in sent[0]
+        assert sent[1] == f'feature option="Hash -spin {TT.size_mb()} 1 {MAX_HASH_MB}"'
+        engine.handle_command("memory 3")
+        assert TT.size == 3 * 1024 * 1024 // ENTRY_SIZE
+        engine.handle_command("option Hash=2")
+        assert TT.size_mb() == 2
+
+        sent.clear()
+        for cmd in ["new", "post", "force", "setboard 6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1", "go"]:
+            engine.handle_command(cmd)
+        assert sent[-1] == "move a1a8"
+        hashfull = [int(line.split()[2]) for line in sent if line.startswith("# hashfull ")]
+        assert hashfull and all(0 <= n <= 1000 for n in hashfull)
+    finally:
+        TT.resize(size)
+
+
+def write_book(path, entries):
+    # entries: (board, move, weight), written as sorted polyglot records
+    records = []
+    for board, move, weight in entries:
+        raw = move.from_square << 6 | move.to_square
+        records.append(struct.pack(">QHHI", chess.polyglot.zobrist_hash(board), raw, weight, 0))
+    path.write_bytes(b"".join(sorted(records)))
+
+
+def test_book_probe_filters_to_forced_moves_and_respects_depth(tmp_path):
+    # 1. e4 d5 forces exd5, a normal-chess book line (Nf3) must be ignored
+    board = chess.Board()
+    board.push_uci("e2e4")
+    board.push_uci("d7d5")
+    start = chess.Board()
+    path = tmp_path / "book.bin"
+    write_book(path, [
+        (start, chess.Move.from_uci("e2e4"), 10),
+        (start, chess.Move.from_uci("d2d4"), 30),
+        (board, chess.Move.from_uci("g1f3"), 100),
+        (board, chess.Move.from_uci("e4d5"), 1),
+    ])
+
+    book = OpeningBook(str(path), selection="best", max_ply=4)
+    assert book.probe(start) == chess.Move.from_uci("d2d4")
+    assert book.probe(board) == chess.Move.from_uci("e4d5")
+
+    weighted = OpeningBook(str(path), rng=random.Random(1))
+    assert {weighted.probe(start) for _ in range(50)} == {chess.Move.from_uci("e2e4"), chess.Move.from_uci("d2d4")}
+
+    # out of book: unknown position, or past the book depth
+    assert OpeningBook(str(path), max_ply=2).probe(board) is None
+    board.push_uci("e4d5")
+    assert book.probe(board) is None
+    book.close()
+
+
+def test_book_builder_counts_forced_lines_and_is_readable(tmp_path):
+    pgn = tmp_path / "games.pgn"
+    games = [
+        ("1-0", "1. e4 d5 2. exd5 Qxd5"),
+        ("0-1", "1. e4 d5 2. exd5 Qxd5"),
+        # Nf6 doesn't take back on d5, only the moves before it count
+        ("0-1", "1. e4 d5 2. exd5 Nf6"),
+        # 2. Nf3 isn't legal here (exd5 is forced), the game only counts up to 1...d5
+        ("1/2-1/2", "1. e4 d5 2. Nf3 dxe4"),
+        ("*", "1. d4 e5"),
+    ]
+    pgn.write_text("".join(f'[Event "t{i}"]\n[Result "{result}"]\n\n{moves} {result}\n\n'
+                           for i, (result, moves) in enumerate(games)))
+
+    out = tmp_path / "book.bin"
+    # tiny chunks so the games get spread over several map tasks
+    n_games, n_entries = book_builder.build_book([str(pgn)], str(out), workers=2, min_games=1, chunk_bytes=64)
+    assert n_games == 4
+
+    board = chess.Board()
+    with chess.polyglot.open_reader(str(out)) as reader:
+        # weights are 2 per win + 1 per draw for the side to move
+        assert [(e.move.uci(), e.weight) for e in reader.find_all(board)] == [("e2e4", 3)]
+        board.push_uci("e2e4")
+        assert [(e.move.uci(), e.weight) for e in reader.find_all(board)] == [("d7d5", 5)]
+        board.push_uci("d7d5")
+        assert [(e.move.uci(), e.weight) for e in reader.find_all(board)] == [("e4d5", 2)]
+        board.push_uci("e4d5")
+        assert [(e.move.uci(), e.weight) for e in reader.find_all(board)] == [("d8d5", 2)]
+    assert n_entries == 4
+
+
+@pytest.fixture(scope="module")
+def kpk_tables(tmp_path_factory):
+    # KPvK and everything it promotes into, generated once for the tablebase tests
+    pytest.importorskip("numpy")
+    import tbgen
+    directory = str(tmp_path_factory.mktemp("tables"))
+    tbgen.generate(["KPvK"], directory, log=lambda msg: None)
+    return directory
+
+def random_kpk_board(rng):
+    while True:
+        board = chess.Board(None)
+        for piece, sq in zip("KkP", rng.sample(range(64), 3)):
+            board.set_piece_at(sq, chess.Piece.from_symbol(piece))
+        board.turn = rng.choice(chess.COLORS)
+        if rng.random() < 0.5:
+            board = board.mirror()
+        if board.is_valid():
+            return board
+
+def test_tablebase_generator_is_consistent_with_forced_moves(kpk_tables):
+    np = pytest.importorskip("numpy")
+    import tbgen
+
+    tables = {}
+
+    def probe(board):
+        sig, index, white_to_move = tablebase.encode(board)
+        if sig not in tables:
+            tables[sig] = tbgen.load_table(kpk_tables, sig)
+        wdl, dtm = tables[sig]
+        state = tablebase.state_index(sig, index, white_to_move)
+        return int(wdl[state]), int(dtm[state])
+
+    # mated in the corner, and a hanging queen that has to be taken (KvK, a draw)
+    assert probe(chess.Board("8/8/8/8/8/8/1q6/K1k5 w - - 0 1")) == (tablebase.LOSS, 0)
+    assert probe(chess.Board("7k/8/8/8/8/8/1q6/K7 w - - 0 1")) == (tablebase.DRAW, 0)
+
+    # every stored value is what the best forced move leads to
+    rng = random.Random(7)
+    for _ in range(150):
+        board = random_kpk_board(rng)
+
+        # the vectorized index agrees with the one the search uses
+        sig, index, white_to_move = tablebase.encode(board)
+        pieces = [(p.piece_type, p.color) for p in board.piece_map().values()]
+        sq = np.array([[s] for s in board.piece_map()])
+        vec_sig, vec_index, vec_white = tbgen.canonical_index(pieces, sq, board.turn)
+        assert (vec_sig, int(vec_index[0]), vec_white) == (sig, index, white_to_move)
+
+        moves, status = forced_moves_and_status(board)
+        if status is not None:
+            expected = (tablebase.LOSS, 0) if status == CHECKMATE else (tablebase.DRAW, 0)
+        else:
+            children = []
+            for move in moves:
+                board.push(move)
+                children.append(probe(board))
+                board.pop()
+            wins = [dtm + 1 for wdl, dtm in children if wdl == tablebase.LOSS]
+            if wins:
+                expected = (tablebase.WIN, min(wins))
+            elif all(wdl == tablebase.WIN for wdl, _ in children):
+                expected = (tablebase.LOSS, max(dtm + 1 for _, dtm in children))
+            else:
+                expected = (tablebase.DRAW, 0)
+        assert probe(board) == expected, board.fen()
+
+
+def test_tablebase_remembers_endings_without_a_table(kpk_tables, tmp_path):
+    for filename in os.listdir(kpk_tables):
+        if not filename.startswith("KNvK"):
+            shutil.copy(os.path.join(kpk_tables, filename), tmp_path)
+    tb = tablebase.Tablebase()
+    tb.add_directory(str(tmp_path))
+    assert tb.max_pieces == 3 and "KNvK" not in tb.tables
+
+    # the first probe finds out, the next ones don't even hash the position
+    board = chess.Board("8/8/8/8/8/8/1n6/K1k5 w - - 0 1")
+    assert tb.probe(board) is None
+    probes = tb.probes
+    assert tb.probe(board) is None
+    assert tb.probes == probes and tb.missing == {"KvKN"}
+    assert tb.probe(chess.Board("8/8/8/8/8/8/1q6/K1k5 w - - 0 1")) == (tablebase.LOSS, 0)
+
+    # adding tables forgets what was missing
+    tb.add_directory(kpk_tables)
+    assert tb.probe(board) is not None
+    tb.close()
+
+def test_tablebase_probing_in_search(kpk_tables):
+    tb = tablebase.Tablebase(max_fds=2)
+    assert tb.add_directory(kpk_tables) >= 2
+    assert tb.max_pieces == 3
+
+    assert tb.probe(chess.Board("8/8/8/8/8/8/1q6/K1k5 w - - 0 1")) == (tablebase.LOSS, 0)
+    assert tb.probe_wdl(chess.Board("7k/8/8/8/8/8/1q6/K7 w - - 0 1")) == 0
+    assert tb.probe(chess.Board()) is None
+    # only one table (two files) stays mapped
+    assert sum(table.wdl_data is not None for table in tb.tables.values()) == 1
+
+    # probe results are cached
+    board = chess.Board("7k/8/8/8/8/8/1q6/K7 w - - 0 1")
+    hits = tb.cache_hits
+    tb.probe(board)
+    assert tb.cache_hits == hits + 1
+
+    # a won KPvK position with some play left in it
+    rng = random.Random(3)
+    while True:
+        board = random_kpk_board(rng)
+        result = tb.probe(board)
+        if result[0] == tablebase.WIN and result[1] >= 5:
+            break
+
+    old_tb = bbsearch.searcher.tb
+    bbsearch.searcher.tb = tb
+    try:
+        # below the root every node is answered by the tables, with exact mate distances
+        TT.clear()
+        score, move = minimax(board.copy(), 2, -float("inf"), float("inf"), board.turn, 0)
+        assert score == bbsearch.tb_score(result, board.turn, 0)
+        assert bbsearch.stats.tb_hits > 0
+
+        # the root plays the tablebase move without searching
+        res = iterative_deepening(board, max_depth=10)
+        assert res.best_move == tb.best_move(board)[0]
+        assert res.score == score
+        assert res.stats.nodes == 0
+        child = board.copy()
+        child.push(res.best_move)
+        assert tb.probe(child) == (tablebase.LOSS, result[1] - 1)
+    finally:
+        bbsearch.searcher.tb = old_tb
+        tb.close()
+
+
+def test_match_elo_and_sprt():
+    assert match.TimeControl.parse("40/60+0.5") == match.TimeControl(40, 60.0, 0.5)
+    assert match.TimeControl.parse("10+0.1").pgn() == "10+0.1"
+    assert match.TimeControl.parse("30").pgn() == "30"
+
+    elo, margin = match.elo_estimate(60, 20, 20)
+    assert elo == pytest.approx(match.score_to_elo(0.7)) and 0 < margin < elo
+    assert match.elo_estimate(10, 80, 10)[0] == pytest.approx(0)
+
+    lower, upper = match.sprt_bounds(0.05, 0.05)
+    assert lower == pytest.approx(-2.944, abs=1e-3) and upper == pytest.approx(2.944, abs=1e-3)
+    # a clearly better engine passes, an equal one fails
+    assert match.sprt_llr(600, 300, 100, 0, 5) > upper
+    assert match.sprt_llr(9000, 12000, 9000, 0, 5) < lower
+
+    tally = match.Tally(sprt=(0, 5, 0.05, 0.05))
+    tally.add("1-0", first_is_white=True)
+    tally.add("1-0", first_is_white=False)
+    tally.add("1/2-1/2", first_is_white=True)
+    assert (tally.wins, tally.draws, tally.losses) == (1, 1, 1)
+    assert tally.decision is None
+
+
+def test_match_runner_plays_concurrent_games(tmp_path):
+    engine_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "engine.py")
+    specs = [match.EngineSpec("a", [sys.executable, engine_path]), match.EngineSpec("b", [sys.executable, engine_path])]
+    pgn_path = str(tmp_path / "games.pgn")
+    # mate in one for White, whoever has White wins
+    opening = "6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1"
+    runner = match.Match(specs, match.TimeControl(0, 5.0, 0.05), [opening], games=4, concurrency=2,
+                         pgn_path=pgn_path, log=lambda msg: None)
+    tally = asyncio.run(runner.run())
+    assert (tally.wins, tally.draws, tally.losses) == (2, 0, 2)
+
+    with open(pgn_path) as f:
+        games = [chess.pgn.read_game(f) for _ in range(4)]
+    assert sorted(game.headers["Round"] for game in games) == ["1", "2", "3", "4"]
+    for game in games:
+        assert game.headers["Result"] == "1-0" and game.headers["Termination"] == "checkmate"
+        assert game.headers["FEN"] == opening
+        move = game.next()
+        assert move.move == chess.Move.from_uci("a1a8")
+        assert move.comment.startswith("+M1/")
+
+
+def test_engine_host_serves_concurrent_games(tmp_path):
+    mate_in_one = "6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1"
+    path = str(tmp_path / "host.sock")
+
+    async def session(commands, until):
+        reader, writer = await asyncio.open_unix_connection(path)
+        for cmd in commands:
+            writer.write((cmd + "\n").encode())
+        lines = []
+        while not lines or not lines[-1].startswith(until):
+            lines.append((await reader.readline()).decode().strip())
+        writer.write(b"quit\n")
+        writer.close()
+        return lines
+
+    async def uci_infinite():
+        # go infinite has to be stopped from here, in another process than the search
+        reader, writer = await asyncio.open_unix_connection(path)
+        for cmd in ["uci", "position startpos moves e2e4", "go infinite"]:
+            writer.write((cmd + "\n").encode())
+        await asyncio.sleep(0.5)
+        writer.write(b"stop\n")
+        lines = []
+        while not lines or not lines[-1].startswith("bestmove"):
+            lines.append((await reader.readline()).decode().strip())
+        writer.close()
+        return lines
+
+    async def run():
+        engine_host = host.EngineHost(workers=2, hash_mb=1)
+        try:
+            await engine_host.start_unix(path)
+            xboard = ["xboard", "protover 2", "new", "force", f"setboard {mate_in_one}", "st 1", "go", "ping 1"]
+            uci = ["uci", f"position fen {mate_in_one}", "go movetime 1000"]
+            return await asyncio.gather(session(xboard, "pong"), session(xboard, "pong"),
+                                        session(uci, "bestmove"), uci_infinite())
+        finally:
+            await engine_host.close()
+
+    first, second, uci, infinite = asyncio.run(run())
+    for lines in (first, second):
+        assert "feature done=1" in lines
+        assert lines[-2:] == ["move a1a8", "pong 1"]
+    assert uci[-1] == "bestmove a1a8"
+    assert infinite[-1].startswith("bestmove ")
+    move = chess.Move.from_uci(infinite[-1].split()[1])
+    board = chess.Board()
+    board.push_uci("e2e4")
+    assert move in forced_legal_moves(board)
+
+
+def test_engine_host_refuses_analyze_and_keeps_playing(tmp_path):
+    path = str(tmp_path / "host.sock")
+
+    async def run():
+        engine_host = host.EngineHost(workers=1, hash_mb=1)
+        try:
+            await engine_host.start_unix(path)
+            reader, writer = await asyncio.open_unix_connection(path)
+            for cmd in ["xboard", "protover 2", "new", "st 1", "analyze", "usermove e2e4", "ping 1"]:
+                writer.write((cmd + "\n").encode())
+            lines = []
+            while not lines or not lines[-1].startswith("pong"):
+                lines.append((await reader.readline()).decode().strip())
+            writer.write(b"quit\n")
+            writer.close()
+            return lines
+        finally:
+            await engine_host.close()
+
+    lines = asyncio.run(run())
+    assert "Error (not supported by the engine host): analyze" in lines
+    assert lines[-2].startswith("move ")
+    board = chess.Board()
+    board.push_uci("e2e4")
+    assert chess.Move.from_uci(lines[-2].split()[1]) in forced_legal_moves(board)
+
+
+def test_analysis_cache_survives_the_process(tmp_path):
+    path = str(tmp_path / "analysis.sqlite")
+    board = chess.Board("r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4")
+
+    searcher = bbsearch.Searcher(tt_size=50000)
+    res = searcher.iterative_deepening(board, max_depth=4)
+    assert res.depth == 4
+    cache = AnalysisCache(path)
+    # the root and the PV positions still deep enough
+    assert cache.record(board, res) == 1 and len(cache) == 1
+    cache.close()
+
+    # a fresh process: the root answer is there before searching
+    cache = AnalysisCache(path)
+    assert cache.lookup(board) == (4, res.score, res.best_move)
+    fresh = bbsearch.Searcher(tt_size=50000)
+    assert cache.seed(fresh.tt, board) is not None
+    again = fresh.iterative_deepening(board, max_depth=4)
+    assert (again.best_move, again.score) == (res.best_move, res.score)
+    assert again.stats.total_nodes <= 4 # one TT hit per iteration
+
+    # new game: the opening goes into the TT
+    fresh.clear()
+    assert cache.warm(fresh.tt) == 1
+    assert fresh.tt.lookup(board).depth == 4
+
+    # mates move with the line, a shallower result never replaces a deeper one
+    mate_board = chess.Board("6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1")
+    mate = bbsearch.SearchResult(best_move=chess.Move.from_uci("a1a8"), score=30000 - 1, depth=5,
+                                 time_taken=0.0, pv=[chess.Move.from_uci("a1a8")])
+    cache.record(mate_board, mate)
+    mate.depth, mate.score = 4, 0
+    cache.record(mate_board, mate)
+    assert cache.lookup(mate_board)[:2] == (5, 30000 - 1)
+    # bounds (a fail-high played after a timeout, PNS's mate placeholder) are never stored
+    bound = bbsearch.SearchResult(best_move=res.best_move, score=res.score + 500, depth=6,
+                                  time_taken=0.0, pv=[res.best_move], exact=False)
+    assert cache.record(board, bound) == 0 and cache.lookup(board)[0] == 4
+    assert mate_from(30000 - 3, 2) == 30000 - 1 and mate_from(-(30000 - 3), 2) == -(30000 - 1)
+    assert mate_from(250, 2) == 250
+    cache.close()
+
+
+def test_mapped_tt_survives_restarts_and_shares_copy_on_write(tmp_path, monkeypatch):
+    path = str(tmp_path / "tt.bin")
+    board = chess.Board("r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4")
+    res = bbsearch.Searcher(tt=Mapped_Transposition_Table(path, size=50000)).iterative_deepening(board, max_depth=4)
+    # same search as with the list-based table
+    listed = bbsearch.Searcher(tt_size=50000).iterative_deepening(board, max_depth=4)
+    assert (res.best_move, res.score, res.stats.total_nodes) == (listed.best_move, listed.score, listed.stats.total_nodes)
+
+    # warm restart: the mapping is still there, size from the file
+    tt = Mapped_Transposition_Table(path)
+    assert tt.size == 50000 and tt.count_used() > 0
+    entry = tt.lookup(board)
+    assert (entry.depth, entry.score, entry.flag, entry.best_move) == (4, res.score, "EXACT", res.best_move)
+    again = bbsearch.Searcher(tt=tt).iterative_deepening(board, max_depth=4)
+    assert again.best_move == res.best_move and again.stats.total_nodes <= 4
+
+    # a reader sees the writer's stores, its own stay private
+    reader = Mapped_Transposition_Table(path, readonly=True)
+    other = chess.Board("6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1")
+    tt.store(other, 5, 29999, "LOWERBOUND", chess.Move.from_uci("a1a8"))
+    assert reader.lookup(other).best_move == chess.Move.from_uci("a1a8")
+    # a reader's new game leaves the file (and what it sees of it) alone
+    reader.new_game()
+    assert reader.generation == 1 and tt.generation == 0
+    tt.store(board, 6, 0, "EXACT", None)
+    assert reader.lookup(board).depth == 6
+    used = tt.count_used()
+    reader.clear()
+    reader.resize(60000)
+    assert reader.count_used() == 0 and tt.count_used() == used
+
+    # snapshot, resize keeps the entries, bad files are rejected
+    tt.save(str(tmp_path / "snapshot.bin"))
+    tt.resize(70000)
+    assert tt.lookup(other).depth == 5
+
+    # a new game keeps the entries, this game's replace the older ones first
+    monkeypatch.setattr(bbsearch.searcher, "tt", tt)
+    engine = WinBoardEngine()
+    engine.send = lambda msg: None
+    engine.handle_command("new")
+    assert tt.generation == 1 and tt.count_used() == used and tt.lookup(other).depth == 5
+    tt.store(other, 1, 0, "UPPERBOUND", None)
+    assert (tt.lookup(other).depth, tt.lookup(other).flag) == (1, "UPPERBOUND")
+    tt.store(other, 0, 0, "EXACT", None)
+    assert tt.lookup(other).depth == 1
+    tt.close()
+    snapshot = Mapped_Transposition_Table(str(tmp_path / "snapshot.bin"), readonly=True)
+    assert snapshot.size == 50000 and snapshot.count_used() == used
+    (tmp_path / "bad.bin").write_bytes(b"not a table" * 10)
+    with pytest.raises(ValueError):
+        Mapped_Transposition_Table(str(tmp_path / "bad.bin"))
+
+
+def test_tuner_features_match_evaluate_and_tuning_lowers_the_loss(tmp_path):
+    np = pytest.importorskip("numpy")
+    import random
+    import chess.pgn
+    import evaluate
+    import tuner
+
+    # random forced-capture games, the side ahead in material at the end wins
+    rng = random.Random(5)
+    pgn_path = str(tmp_path / "games.pgn")
+    positions = []
+    with open(pgn_path, "w") as f:
+        for _ in range(12):
+            board = chess.Board()
+            game = node = chess.pgn.Game()
+            while board.ply() < 80:
+                moves = forced_legal_moves(board)
+                if not moves:
+                    break
+                if board.ply() >= tuner.SKIP_PLIES and tuner.is_quiet(board, moves):
+                    positions.append((board.copy(), moves))
+                node = node.add_variation(rng.choice(moves))
+                board.push(node.move)
+            material = evaluate.material_and_piece_square_fast(board)
+            game.headers["Result"] = "1-0" if material > 0 else "0-1" if material < 0 else "1/2-1/2"
+            print(game, file=f, end="\n\n")
+
+    features_path = str(tmp_path / "features.npz")
+    assert tuner.extract([pgn_path], features_path, workers=1) == (12, len(positions))
+    features = tuner.load_features(features_path)
+    # the linear model with evaluate's weights is evaluate, up to rounding the tapered terms
+    evals = tuner.design_matrix(features, slice(None)) @ tuner.current_params()
+    expected = [evaluate.evaluate(board, 0, moves) for board, moves in positions]
+    assert np.abs(evals - expected).max() <= 8
+
+    theta, k, before, after = tuner.tune(features, epochs=30, k=1.0)
+    assert after < before
+
+    # evaluate's own weights written out and loaded back change nothing
+    params_path = str(tmp_path / "params.py")
+    tuner.write_params(params_path, tuner.theta_to_params(tuner.current_params()))
+    evaluate.load_params(params_path)
+    assert [evaluate.evaluate(board, 0, moves) for board, moves in positions] == expected
+    assert tuner.theta_to_params(theta)["TERM_WEIGHTS"].keys() == evaluate.TERM_WEIGHTS.keys()
+
+
+def test_bench_node_count_is_deterministic():
+    fens = bench.BENCH_FENS[:2] + bench.BENCH_FENS[-2:]
+    first, second = io.StringIO(), io.StringIO()
+    size = TT.size
+    try:
+        nodes, _ = bench.bench(depth=2, hash_mb=1, fens=fens, out=first)
+        # a warm TT or leftover killers would change the count
+        again, _ = bench.bench(depth=2, hash_mb=1, fens=fens, out=second)
+    finally:
+        TT.resize(size)
+    assert nodes == again > 0
+    assert f"Nodes searched  : {nodes}" in first.getvalue()
+    assert first.getvalue().count("Position ") == len(fens)
+
+
+def test_microbench_measures_and_compares():
+    results = microbench.run_benchmarks(["zobrist", "movegen"], min_time=0.001, repeats=3, warmup=0)
+    assert sorted(results) == sorted(f"{name}/{phase}" for name in ("movegen", "zobrist")
+                                     for phase in microbench.POSITIONS)
+    for result in results.values():
+        assert result["median"] > 0 and result["iqr"] >= 0 and result["number"] >= 1
+
+    baseline = {"zobrist/opening": {"median": 1.0}, "movegen/opening": {"median": 1.0}}
+    current = {"zobrist/opening": {"median": 1.05}, "movegen/opening": {"median": 1.5}, "tt/opening": {"median": 1.0}}
+    regressions, ratios = microbench.compare(current, baseline, threshold=0.1)
+    assert regressions == [("movegen/opening", 1.5)]
+    assert set(ratios) == {"zobrist/opening", "movegen/opening"}
+
+
+def test_aspiration_widens_only_the_failing_side(monkeypatch):
+    board = chess.Board("r1bq1rk1/ppp1nppp/4n3/3p3Q/3P4/1BP1B3/PP1N2PP/R4RK1 w - - 1 16")
+    windows = {}
+    search = bbsearch.searcher.minimax
+
+    def recording_minimax(board, depth, alpha, beta, max_player, depth_from_root, pv=None, panic=False):
+        if depth_from_root == 0:
+            windows.setdefault(depth, []).append((alpha, beta))
+        return search(board, depth, alpha, beta, max_player, depth_from_root, pv=pv, panic=panic)
+
+    monkeypatch.setattr(bbsearch.searcher, "minimax", recording_minimax)
+    monkeypatch.setattr(bbsearch, "ASPIRATION_WINDOW", 2)
+    TT.clear()
+    res = iterative_deepening(board, max_depth=3)
+    assert res.best_move is not None
+
+    re_searches = 0
+    for depth, tried in windows.items():
+        for (alpha, beta), (new_alpha, new_beta) in zip(tried, tried[1:]):
+            re_searches += 1
+            # one side opens up, the other stays where it was
+            assert (new_alpha < alpha and new_beta == beta) or (new_beta > beta and new_alpha == alpha)
+    assert re_searches > 0
+
+
+def test_aspiration_fail_high_move_survives_a_timeout(monkeypatch):
+    board = chess.Board("r1bq1rk1/ppp1nppp/4n3/3p3Q/3P4/1BP1B3/PP1N2PP/R4RK1 w - - 1 16")
+    first, better = chess.Move.from_uci("h5h7"), chess.Move.from_uci("b3d5")
+    calls = []
+
+    def fake_minimax(board, depth, alpha, beta, max_player, depth_from_root, pv=None, panic=False):
+        calls.append((depth, alpha, beta))
+        if depth == 1:
+            return 10, first
+        if len(calls) == 2:
+            bbsearch.searcher.pv_table[0] = [better]
+            return beta + 300, better
+        raise bbsearch.SearchAborted()
+
+    monkeypatch.setattr(bbsearch.searcher, "minimax", fake_minimax)
+    res = iterative_deepening(board, max_depth=5)
+    assert res.best_move == better and res.pv == [better]
+    assert res.depth == 1 and not res.exact
+    # the re-search only moved beta
+    assert calls[2][1] == calls[1][1] and calls[2][2] > calls[1][2]
+
+
+def test_searchers_are_independent():
+    fens = ["r1bq1rk1/ppp1nppp/4n3/3p3Q/3P4/1BP1B3/PP1N2PP/R4RK1 w - - 1 16",
+            "8/6pk/1p6/8/PP3p1p/5P2/4KP1q/3Q4 w - - 0 1"]
+
+    def search(fen):
+        searcher = bbsearch.Searcher(tt_size=10000)
+        res = searcher.iterative_deepening(chess.Board(fen), max_depth=3)
+        return res.best_move, res.score, res.stats.total_nodes, searcher
+
+    alone = [search(fen)[:3] for fen in fens]
+
+    # the same searches side by side in threads, plus a stopped one that mustn't stop them
+    results = [None, None]
+    def run(i):
+        results[i] = search(fens[i])[:3]
+    stopped = bbsearch.Searcher(tt_size=10000)
+    stopped.stop_signal.set()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    stopped_res = stopped.iterative_deepening(chess.Board(fens[0]), max_depth=3)
+    for t in threads:
+        t.join()
+    assert results == alone
+    assert stopped_res.depth <= 1
+
+    # and none of it touched the engine's own searcher, not even the mate prover's move ordering
+    assert search(fens[0])[3].tt is not TT
+    probes = TT.probes
+    pns.PROOF_TT.clear()
+    searcher = bbsearch.Searcher(tt_size=10000)
+    res = searcher.iterative_deepening(chess.Board("7k/8/5K2/8/8/8/8/Q7 w - - 0 1"), max_depth=1, pns_nodes=1000)
+    assert res.score >= 29000
+    assert TT.probes == probes
+
+
+
+def test_fast_eval_takes_over_when_short_of_time():
+    board = chess.Board("r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4")
+    searcher = bbsearch.Searcher(tt_size=50000)
+    # no clock: the full eval, and its NPS is remembered
+    res = searcher.iterative_deepening(board, max_depth=3)
+    assert not res.stats.fast_eval and searcher.evaluate is bbsearch.evaluate and searcher.full_eval_nps > 0
+
+    # a short budget, or one the last NPS says buys too few nodes
+    assert searcher.wants_fast_eval(bbsearch.FAST_EVAL_TIME / 2)
+    searcher.full_eval_nps = 10
+    assert searcher.wants_fast_eval(1.0) and not searcher.wants_fast_eval(None)
+    searcher.clear()
+    res = searcher.iterative_deepening(board, max_depth=3, time_limit=1.0)
+    assert res.stats.fast_eval and searcher.evaluate is bbsearch.evaluate_fast
+
+    # panic searches deeper than the old cap with it, unless told to keep the full eval
+    searcher.clear()
+    res = searcher.iterative_deepening(board, max_depth=50, panic=True, max_nodes=100000)
+    assert res.stats.fast_eval and res.depth == bbsearch.PANIC_MAX_DEPTH + bbsearch.FAST_EVAL_EXTRA_DEPTH
+    searcher.clear()
+    res = searcher.iterative_deepening(board, max_depth=50, panic=True, fast_eval=False, max_nodes=100000)
+    assert not res.stats.fast_eval and res.depth == bbsearch.PANIC_MAX_DEPTH
+
+
+def test_startup_does_no_search_work():
+    # importing the engine allocates no TT and leaves the optional modules alone
+    code = ("import sys, engine, bbsearch; "
+            "print(bbsearch.TT.table is None, [m for m in ('tablebase', 'pns', 'chess.pgn', 'json') if m in sys.modules])")
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.split("\n")[0] == "True []"
+
+    tt = Transposition_Table(size=64)
+    assert tt.lookup(chess.Board()) is None and tt.table is None and tt.count_used() == 0
+    tt.resize(128)
+    tt.store(chess.Board(), 1, 0, "EXACT", best_move=None)
+    assert len(tt.table) == 128 and tt.count_used() == 1
+    tt.clear()
+    assert tt.table is None and tt.lookup(chess.Board()) is None
+
+    seconds = startup.time_to_reply(*startup.HANDSHAKES["xboard"])
+    assert 0 < seconds < 30
+
+
 if __name__ == '__main__':
     # Example runs (manual smoke tests)
     run_test(chess.STARTING_FEN, depth=3)
     run_test("8/8/8/8/8/2k5/3p4/3K4 w - - 0 1", depth=5)  # simple endgame
-    run_test("rnbqkbnr/pppppppp/8/8/1P6/8/P1PPPPPP/RNBQKBNR b KQkq - 0 1", depth=5)
\ No newline at end of file
+    run_test("rnbqkbnr/pppppppp/8/8/1P6/8/P1PPPPPP/RNBQKBNR b KQkq - 0 1", depth=5)
@@ -0,0 +1,115 @@
+import time
+
+# Time management, all times in seconds.
+#
+# Every move gets a soft limit (don't start another iteration after it) and a hard limit
+# (the search aborts mid-iteration). Between iterations we predict how long the next one
+# will take from the branching factor, and give ourselves more time while the best move
+# keeps changing and less once it has settled.
+
+MOVE_OVERHEAD = 0.05 # GUI/pipe latency we lose every move
+SUDDEN_DEATH_MOVES = 30 # how many more moves we plan for when there's no time control
+INCREMENT_USAGE = 0.8 # fraction of the increment we spend on the move it's given for
+HARD_FACTOR = 3.0 # hard limit as a multiple of the planned time
+MAX_USAGE = 0.5 # never spend more than this fraction of the clock on one move
+DEFAULT_EBF = 4.0 # branching factor guess before we've measured one
+
+# how the soft limit scales with the best move's stability
+UNSTABLE_SCALE = 1.5
+MAX_SCALE = 2.5
+STABLE_SCALE = 0.7
+STABLE_ITERATIONS = 3
+
+
+class TimeManager:
+    def __init__(self):
+        # time control (xboard level/st)
+        self.moves_per_session = 40 # 0 = sudden death
+        self.base = 60.0
+        self.increment = 0.0
+        self.fixed_time = None
+
+        # per-move limits
+        self.start_time = None
+        self.soft_limit = None
+        self.hard_limit = None
+        self.scale = 1.0
+        self.best_move = None
+        self.stable_iterations = 0
+
+    def set_level(self, moves, base, increment):
+        self.moves_per_session = moves
+        self.base = base
+        self.increment = increment
+        self.fixed_time = None
+
+    def set_fixed_time(self, seconds):
+        self.fixed_time = seconds
+
+    def start(self, time_left, moves_to_go=None, opp_time=None):
+        """Starts the clock for a move, time_left/opp_time are our and the opponent's clocks."""
+        self.start_time = time.time()
+        self.scale = 1.0
+        self.best_move = None
+        self.stable_iterations = 0
+
+        if self.fixed_time is not None:
+            self.soft_limit = self.hard_limit = max(0.01, self.fixed_time - MOVE_OVERHEAD)
+            return
+
+        if not moves_to_go or self.moves_per_session == 0:
+            moves_to_go = SUDDEN_DEATH_MOVES
+
+        usable = max(0.01, time_left - MOVE_OVERHEAD)
+        planned = usable / moves_to_go + self.increment * INCREMENT_USAGE
+
+        # a bit more when we're ahead on the clock, a bit less when we're behind
+        if opp_time:
+            planned *= min(1.25, max(0.75, time_left / opp_time))
+
+        # the last move before the time control can use what's left, otherwise keep a reserve
+        max_usage = 0.9 if moves_to_go == 1 else MAX_USAGE
+        self.hard_limit = min(planned * HARD_FACTOR, usable * max_usage)
+        self.soft_limit = min(planned, self.hard_limit)
+
+    def start_infinite(self):
+        """Starts the clock without limits (pondering, go infinite) until start() sets some."""
+        self.start_time = time.time()
+        self.soft_limit = self.hard_limit = None
+        self.scale = 1.0
+        self.best_move = None
+        self.stable_iterations = 0
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def deadline(self):
+        # absolute time the search has to be aborted at
+        if self.hard_limit is None:
+            return None
+        return self.start_time + self.hard_limit
+
+    def iteration_done(self, best_move):
+        # unstable best move -> think longer, same move several times in a row -> wrap up
+        if self.best_move is not None and best_move != self.best_move:
+            self.scale = min(MAX_SCALE, self.scale * UNSTABLE_SCALE)
+            self.stable_iterations = 0
+        else:
+            self.stable_iterations += 1
+            if self.stable_iterations >= STABLE_ITERATIONS:
+                self.scale = min(self.scale, STABLE_SCALE)
+        self.best_move = best_move
+
+    def should_stop(self, last_iteration_time, ebf=None):
+        """Whether to skip the next iteration: over the soft limit, or it won't finish before the hard one."""
+        if self.hard_limit is None:
+            return False
+        if self.fixed_time is not None:
+            return self.elapsed() >= self.hard_limit
+
+        elapsed = self.elapsed()
+        if elapsed >= min(self.hard_limit, self.soft_limit * self.scale):
+            return True
+
+        predicted = last_iteration_time * (ebf if ebf and ebf > 1 else DEFAULT_EBF)
+        return elapsed + predicted > self.hard_limit
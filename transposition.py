@@ -1,45 +1,343 @@
+import os
+import mmap
+import struct
+
 import chess
 import chess.polyglot
 
+# the Move objects the TT entries point to, at most a few thousand distinct ones
+MOVES = {}
+
+# rough bytes a used slot costs (list pointer + entry object + its ints), for sizing the table in MB
+ENTRY_SIZE = 144
+# biggest table the protocols let you ask for
+MAX_HASH_MB = 4096
+# slots hashfull() looks at
+HASHFULL_SAMPLE = 1000
+
 class Transposition_Table:
     def __init__(self, size=100000):
         self.size = size
-        self.table = [None] * size
+        # the slots are allocated on first use: a 2M-slot list costs ~16MB and a noticeable
+        # part of the engine's startup, and clear()/resize() before a search are free this way
+        self.table = None
+        # probe counters for the search stats
+        self.probes = 0
+        self.hits = 0
 
     def index(self, key):
         return key % self.size
     
-    def store(self, board: chess.Board, depth, score, flag, best_move):
+    def store(self, board: chess.Board, depth, score, flag, best_move, key=None):
         # depth is depth remaining, not how deep it is from the root
-        key = chess.polyglot.zobrist_hash(board)
+        # key can be passed in when the caller already hashed the board
+        if key is None:
+            key = chess.polyglot.zobrist_hash(board)
         idx = self.index(key)
 
+        if self.table is None:
+            self.table = [None] * self.size
         entry = self.table[idx]
 
         if entry is None or depth > entry.depth:
+            if best_move is not None:
+                # share one Move per distinct move, otherwise every entry keeps its own copy alive
+                best_move = MOVES.setdefault(best_move, best_move)
             self.table[idx] = Transposition_Entry(key, depth, score, flag, best_move)
 
-    def lookup(self, board: chess.Board):
-        key = chess.polyglot.zobrist_hash(board)
+    def lookup(self, board: chess.Board, key=None):
+        if key is None:
+            key = chess.polyglot.zobrist_hash(board)
         idx = self.index(key)
 
+        self.probes += 1
+        if self.table is None:
+            return None
         entry = self.table[idx]
         if entry is not None and entry.key == key:
+            self.hits += 1
             return entry
         return None
     
     def count_used(self):
+        if self.table is None:
+            return 0
         count = 0
         for zobrist in self.table:
             if zobrist is not None:
                 count += 1
         return count
     
+    def hashfull(self):
+        # permill of the table in use, from a sample of slots: count_used is O(size)
+        if self.table is None:
+            return 0
+        n = min(HASHFULL_SAMPLE, self.size)
+        return (n - self.table[:n].count(None)) * 1000 // n
+
     def clear(self):
-        self.table = [None] * self.size
+        self.table = None
+
+    def new_game(self):
+        # nothing survives the process anyway, start the game with an empty table
+        self.clear()
+
+    def resize(self, size):
+        # keep what we have, entries that collide in the new table go by depth as usual
+        old_table = self.table
+        self.size = size
+        if old_table is None:
+            return
+        self.table = [None] * size
+        for entry in old_table:
+            if entry is not None:
+                idx = self.index(entry.key)
+                current = self.table[idx]
+                if current is None or entry.depth > current.depth:
+                    self.table[idx] = entry
+
+    def resize_mb(self, mb):
+        self.resize(max(1, mb * 1024 * 1024 // ENTRY_SIZE))
+
+    def size_mb(self):
+        return round(self.size * ENTRY_SIZE / (1024 * 1024))
     
 
+# TT file layout (Mapped_Transposition_Table): a 64 byte header, then 16 byte slots
+TT_FILE_MAGIC = b"FCTT"
+TT_FILE_VERSION = 2
+TT_FILE_HEADER = struct.Struct("<4sIIQQ") # magic, version, slot size, slots, generation
+TT_FILE_HEADER_SIZE = 64
+SLOT_SIZE = 16
+# a slot is the key xor'ed with the data, then the data: score, move, depth, flag (0 = empty).
+# A slot half overwritten by another engine doesn't check out against any key, so sharing the
+# file needs no locking. The flag byte's top 6 bits are the generation (game) that stored it
+SLOT_CHECK = struct.Struct("<Q")
+SLOT_DATA = struct.Struct("<fHBB")
+GENERATION = struct.Struct("<Q")
+GENERATION_OFFSET = TT_FILE_HEADER.size - GENERATION.size # the last header field
+
+FLAG_CODES = {"EXACT": 1, "LOWERBOUND": 2, "UPPERBOUND": 3}
+FLAG_NAMES = [None, "EXACT", "LOWERBOUND", "UPPERBOUND"]
+AGE_BITS = 6
+# 16 bit move code -> Move, so lookups hand out the same objects
+MOVE_CODES = {}
+
+def move_code(move):
+    if move is None:
+        return 0
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def code_move(code):
+    if code == 0:
+        return None
+    move = MOVE_CODES.get(code)
+    if move is None:
+        move = MOVE_CODES[code] = chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+    return move
+
+def write_tt_file(path, size, generation=0, data=None):
+    # written next to it and renamed, so an engine mapping the path never sees half a file
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(TT_FILE_HEADER.pack(TT_FILE_MAGIC, TT_FILE_VERSION, SLOT_SIZE, size, generation)
+                .ljust(TT_FILE_HEADER_SIZE, b"\0"))
+        if data is not None:
+            f.write(data)
+        f.truncate(TT_FILE_HEADER_SIZE + size * SLOT_SIZE) # sparse, the slots start out empty
+    os.replace(tmp, path)
+
+
+class Mapped_Transposition_Table:
+    """Transposition_Table packed into a memory-mapped file, for warm restarts and sharing.
+
+    The file (put it under /dev/shm to keep it in memory) outlives the engine: the next one
+    that opens it starts with everything the last one learned. A new game doesn't empty it,
+    it starts a new generation: older entries are still found, and are the first replaced.
+    With readonly=True the file is mapped copy-on-write: the engine reads what a sibling
+    wrote, and its own stores stay private to it. Files with another version or layout are
+    rejected with ValueError.
+    """
+
+    def __init__(self, path, size=100000, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.probes = 0
+        self.hits = 0
+        if not os.path.exists(path):
+            if readonly:
+                raise FileNotFoundError(path)
+            write_tt_file(path, size)
+        self.map()
+
+    def map(self):
+        with open(self.path, "rb" if self.readonly else "r+b") as f:
+            header = f.read(TT_FILE_HEADER_SIZE)
+            if len(header) < TT_FILE_HEADER_SIZE:
+                raise ValueError(f"{self.path}: not a transposition table file")
+            magic, version, slot_size, size, _ = TT_FILE_HEADER.unpack_from(header)
+            if magic != TT_FILE_MAGIC:
+                raise ValueError(f"{self.path}: not a transposition table file")
+            if version != TT_FILE_VERSION or slot_size != SLOT_SIZE:
+                raise ValueError(f"{self.path}: version {version} with {slot_size} byte slots, "
+                                 f"expected version {TT_FILE_VERSION} with {SLOT_SIZE}")
+            if os.fstat(f.fileno()).st_size != TT_FILE_HEADER_SIZE + size * SLOT_SIZE:
+                raise ValueError(f"{self.path}: {size} slots in the header, not in the file")
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY if self.readonly else mmap.ACCESS_WRITE)
+        self.size = size
+        self.generation = GENERATION.unpack_from(self.mm, GENERATION_OFFSET)[0]
+
+    @property
+    def age(self):
+        # what the flag bytes of this generation's entries carry
+        return self.generation & ((1 << AGE_BITS) - 1)
+
+    def index(self, key):
+        return key % self.size
+
+    def store(self, board: chess.Board, depth, score, flag, best_move, key=None):
+        if key is None:
+            key = chess.polyglot.zobrist_hash(board)
+        offset = TT_FILE_HEADER_SIZE + self.index(key) * SLOT_SIZE
+        mm = self.mm
+
+        # like Transposition_Table: empty or shallower, and anything from an earlier game
+        age = self.age
+        flags = mm[offset + 15]
+        if flags and flags >> 2 == age and depth <= mm[offset + 14]:
+            return
+        data = SLOT_DATA.pack(score, move_code(best_move), depth, FLAG_CODES[flag] | age << 2)
+        SLOT_CHECK.pack_into(mm, offset, key ^ int.from_bytes(data, "little"))
+        mm[offset + 8:offset + 16] = data
+
+    def lookup(self, board: chess.Board, key=None):
+        if key is None:
+            key = chess.polyglot.zobrist_hash(board)
+        offset = TT_FILE_HEADER_SIZE + self.index(key) * SLOT_SIZE
+        mm = self.mm
+
+        self.probes += 1
+        data = mm[offset + 8:offset + 16]
+        if not data[7] or SLOT_CHECK.unpack_from(mm, offset)[0] ^ int.from_bytes(data, "little") != key:
+            return None
+        self.hits += 1
+        score, code, depth, flag = SLOT_DATA.unpack(data)
+        return Transposition_Entry(key, depth, score, FLAG_NAMES[flag & 3], code_move(code))
+
+    def flags(self, n=None):
+        # the flag byte of the first n slots (all of them by default), 0 = empty
+        n = self.size if n is None else n
+        start = TT_FILE_HEADER_SIZE + 15
+        return self.mm[start:start + n * SLOT_SIZE:SLOT_SIZE]
+
+    def count_used(self):
+        return self.size - self.flags().count(0)
+
+    def hashfull(self):
+        n = min(HASHFULL_SAMPLE, self.size)
+        return (n - self.flags(n).count(0)) * 1000 // n
+
+    def entries(self):
+        # (key, slot data) of every used slot
+        mm = self.mm
+        for i in range(self.size):
+            offset = TT_FILE_HEADER_SIZE + i * SLOT_SIZE
+            data = mm[offset + 8:offset + 16]
+            if data[7]:
+                yield SLOT_CHECK.unpack_from(mm, offset)[0] ^ int.from_bytes(data, "little"), data
+
+    def new_game(self):
+        # keep the entries, they're what the file is for, but let this game's replace them
+        if self.readonly:
+            self.generation += 1
+        else:
+            # another engine writing the file may have started games of its own
+            self.generation = max(self.generation, GENERATION.unpack_from(self.mm, GENERATION_OFFSET)[0]) + 1
+            GENERATION.pack_into(self.mm, GENERATION_OFFSET, self.generation)
+
+    def clear(self):
+        chunk = bytes(SLOT_SIZE * 65536)
+        for start in range(TT_FILE_HEADER_SIZE, len(self.mm), len(chunk)):
+            end = min(start + len(chunk), len(self.mm))
+            self.mm[start:end] = chunk[:end - start]
+
+    def resize(self, size):
+        # keep what we have, entries that collide in the new table go by depth as usual
+        if size == self.size:
+            return
+        table = bytearray(size * SLOT_SIZE)
+        for key, data in self.entries():
+            offset = key % size * SLOT_SIZE
+            if not table[offset + 15] or data[6] > table[offset + 14]:
+                table[offset:offset + 8] = SLOT_CHECK.pack(key ^ int.from_bytes(data, "little"))
+                table[offset + 8:offset + 16] = data
+        generation = self.generation
+        self.mm.close()
+
+        if self.readonly:
+            # never write a sibling's file, the bigger table is ours alone
+            self.mm = mmap.mmap(-1, TT_FILE_HEADER_SIZE + size * SLOT_SIZE)
+            self.mm[:TT_FILE_HEADER.size] = TT_FILE_HEADER.pack(TT_FILE_MAGIC, TT_FILE_VERSION, SLOT_SIZE,
+                                                                 size, generation)
+            self.mm[TT_FILE_HEADER_SIZE:] = table
+            self.size = size
+            self.generation = generation
+        else:
+            write_tt_file(self.path, size, generation, table)
+            self.map()
+
+    def resize_mb(self, mb):
+        self.resize(max(1, mb * 1024 * 1024 // SLOT_SIZE))
+
+    def size_mb(self):
+        return round(self.size * SLOT_SIZE / (1024 * 1024))
+
+    def save(self, path):
+        """Writes a snapshot of the table to path, a file Mapped_Transposition_Table can open."""
+        if not self.readonly:
+            self.mm.flush()
+        write_tt_file(path, self.size, self.generation, self.mm[TT_FILE_HEADER_SIZE:])
+
+    def close(self):
+        if not self.readonly:
+            self.mm.flush()
+        self.mm.close()
+
+
+class Pawn_Hash_Table:
+    # pawn structure barely changes during a search, so cache its score by a pawns-only key
+    def __init__(self, size=16384):
+        self.size = size
+        self.table = [None] * size
+
+    def store(self, key, score):
+        # always replace, the entries are cheap to recompute
+        self.table[key % self.size] = (key, score)
+
+    def lookup(self, key):
+        entry = self.table[key % self.size]
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        return None
+
+    def clear(self):
+        self.table = [None] * self.size
+
+
+def pawn_zobrist_hash(board: chess.Board):
+    # Zobrist key over the pawns only (same random numbers polyglot uses for pawns)
+    key = 0
+    for color in (chess.WHITE, chess.BLACK):
+        base = 64 * ((chess.PAWN - 1) * 2 + color)
+        for sq in chess.scan_forward(board.pawns & board.occupied_co[color]):
+            key ^= chess.polyglot.POLYGLOT_RANDOM_ARRAY[base + sq]
+    return key
+
+
 class Transposition_Entry:
+    # no per-entry __dict__, the table holds millions of these
+    __slots__ = ("key", "score", "flag", "depth", "best_move")
+
     def __init__(self, key, depth, score, flag, best_move):
         self.key = key
         self.score = score
@@ -0,0 +1,362 @@
+import os
+import io
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+import chess
+import chess.pgn
+
+import evaluate
+from evaluate import (MAX_PHASE, PIECE_SQUARE_TABLES, compute_phase, king_safety_value, mobility_value,
+                      capture_chain_value, pawn_value, aggressive_play_value, trap_play_value)
+from forced_chess import forced_legal_moves
+from book_builder import split_file, RESULT_INDEX, CHUNK_BYTES
+
+# Texel tuning of evaluate's weights against game results.
+#
+# extract: quiet positions (no capture to make, not in check) are taken from PGN games and
+# turned into features once, so tuning never calls evaluate. Everything evaluate computes
+# with a fixed weight per piece or square is linear in the weights and stored as counts:
+# material (tapered by the phase), piece squares, king squares, 7th rank pawns and bishop
+# pairs. The other terms are stored as their values and get one weight each
+# (evaluate.TERM_WEIGHTS). Features are small integers, kept as int8 in a compressed .npz.
+#
+# tune: the evaluation of every position is then a matrix product, and the weights are fit by
+# gradient descent (Adam) on the logistic loss between sigmoid(K * eval) and the game result.
+# K is fit first with the weights as they are. The result is written as a Python module that
+# evaluate.load_params() reads (python engine.py --params tuned.py).
+#
+#   python tuner.py extract games.pgn -o features.npz
+#   python tuner.py tune features.npz -o tuned.py
+
+FEATURE_VERSION = 1
+
+SKIP_PLIES = 8 # the opening says little about the result (and the book plays it anyway)
+PIECE_TYPES = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]
+TERMS = list(evaluate.TERM_WEIGHTS)
+
+# Parameter vector layout: material (middlegame, endgame), piece squares, king squares
+# (middlegame, endgame), promotion and bishop pair bonuses, term weights
+MATERIAL_MG = slice(0, 5)
+MATERIAL_EG = slice(5, 10)
+PST = slice(10, 10 + 5 * 64)
+KING_MG = slice(330, 394)
+KING_EG = slice(394, 458)
+PROMOTION = 458
+BISHOP_PAIR = 459
+TERM = slice(460, 460 + len(TERMS))
+N_PARAMS = TERM.stop
+
+# term weights are tuned in hundredths (and the term values divided by 100), so a step moves
+# every parameter by about the same number of centipawns
+TERM_SCALE = 100.0
+
+BATCH = 1 << 16 # positions per matrix product
+MATRIX_CACHE_BYTES = 2 << 30 # keep the design matrices in memory up to this size
+EPOCHS = 500
+LEARNING_RATE = 1.0 # centipawns per step, give or take (Adam)
+K_RANGE = (0.1, 3.0)
+
+
+# Features
+
+def is_quiet(board: chess.Board, moves):
+    # with forced captures, a capture to make means all the moves are captures
+    return (moves and not board.is_check() and not board.is_capture(moves[0])
+            and not board.is_insufficient_material())
+
+def position_features(board: chess.Board, moves):
+    """(counts, squares, kings, extras, terms, phase) of a quiet position, White's side."""
+    black, white = board.occupied_co
+    counts = [0] * 5
+    squares = [0] * (5 * 64)
+    kings = [0] * 64
+    for i, piece_type in enumerate(PIECE_TYPES):
+        mask = board.pieces_mask(piece_type, chess.WHITE)
+        counts[i] += chess.popcount(mask)
+        for sq in chess.scan_forward(mask):
+            squares[i * 64 + sq] += 1
+        mask = board.pieces_mask(piece_type, chess.BLACK)
+        counts[i] -= chess.popcount(mask)
+        for sq in chess.scan_forward(mask):
+            squares[i * 64 + (sq ^ 56)] -= 1
+    for sq in chess.scan_forward(board.kings & white):
+        kings[sq] += 1
+    for sq in chess.scan_forward(board.kings & black):
+        kings[sq ^ 56] -= 1
+    extras = [chess.popcount(board.pawns & white & chess.BB_RANK_7) - chess.popcount(board.pawns & black & chess.BB_RANK_2),
+              int(chess.popcount(board.bishops & white) >= 2) - int(chess.popcount(board.bishops & black) >= 2)]
+
+    phase = compute_phase(board)
+    values = {
+        "king_safety": king_safety_value(board, phase),
+        "mobility": mobility_value(board, moves),
+        "capture_chain": capture_chain_value(board),
+        "pawn": pawn_value(board),
+        "aggressive_play": aggressive_play_value(board),
+        "trap_play": trap_play_value(board),
+    }
+    return counts, squares, kings, extras, [values[term] for term in TERMS], phase
+
+def extract_games(task, skip_plies=SKIP_PLIES):
+    """Map step: features of the quiet positions in a slice of a PGN file, and games read."""
+    path, start, end = task
+    rows = []
+    games = 0
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    pgn = io.StringIO(data.decode("utf-8", errors="replace"))
+
+    while True:
+        game = chess.pgn.read_game(pgn)
+        if game is None:
+            break
+        result = RESULT_INDEX.get(game.headers.get("Result"))
+        if result is None:
+            continue
+        games += 1
+        score = 1.0 - result / 2 # White's: 1 win, 0.5 draw, 0 loss
+
+        board = game.board()
+        for move in game.mainline_moves():
+            moves = forced_legal_moves(board)
+            if move not in moves:
+                break
+            if board.ply() >= skip_plies and is_quiet(board, moves):
+                rows.append(position_features(board, moves) + (score,))
+            board.push(move)
+
+    return rows, games
+
+def features_to_arrays(rows):
+    counts, squares, kings, extras, terms, phase, result = zip(*rows) if rows else ([],) * 7
+    return {
+        "version": np.array(FEATURE_VERSION),
+        "counts": np.array(counts, dtype=np.int8).reshape(-1, 5),
+        "squares": np.array(squares, dtype=np.int8).reshape(-1, 5 * 64),
+        "kings": np.array(kings, dtype=np.int8).reshape(-1, 64),
+        "extras": np.array(extras, dtype=np.int8).reshape(-1, 2),
+        "terms": np.array(terms, dtype=np.float32).reshape(-1, len(TERMS)),
+        "phase": np.array(phase, dtype=np.uint8),
+        "result": np.array(result, dtype=np.float32),
+    }
+
+def extract(inputs, output, workers=None, skip_plies=SKIP_PLIES, chunk_bytes=CHUNK_BYTES):
+    """Writes the features of the quiet positions in the PGN files to output, returns (games, positions)."""
+    tasks = [task for path in inputs for task in split_file(path, chunk_bytes)]
+    workers = workers or os.cpu_count() or 1
+
+    rows = []
+    games = 0
+    if workers == 1 or len(tasks) <= 1:
+        results = (extract_games(task, skip_plies) for task in tasks)
+        for task_rows, n in results:
+            rows.extend(task_rows)
+            games += n
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for task_rows, n in pool.starmap(extract_games, [(task, skip_plies) for task in tasks], chunksize=1):
+                rows.extend(task_rows)
+                games += n
+
+    np.savez_compressed(output, **features_to_arrays(rows))
+    return games, len(rows)
+
+def load_features(path):
+    with np.load(path) as data:
+        features = {name: data[name] for name in data.files}
+    version = int(features.get("version", 0))
+    if version != FEATURE_VERSION:
+        raise ValueError(f"{path}: feature version {version}, expected {FEATURE_VERSION} (extract again)")
+    return features
+
+
+# Model
+
+def design_matrix(features, rows):
+    """Feature rows as float32 columns matching the parameter vector."""
+    taper = features["phase"][rows].astype(np.float32)[:, None] / MAX_PHASE
+    counts = features["counts"][rows].astype(np.float32)
+    kings = features["kings"][rows].astype(np.float32)
+    return np.hstack([counts * taper, counts * (1 - taper), features["squares"][rows], kings * taper,
+                      kings * (1 - taper), features["extras"][rows],
+                      features["terms"][rows] / TERM_SCALE]).astype(np.float32)
+
+def batches(features, batch=BATCH):
+    n = len(features["result"])
+    for start in range(0, n, batch):
+        rows = slice(start, min(n, start + batch))
+        yield design_matrix(features, rows), features["result"][rows]
+
+def current_params():
+    """evaluate's weights as a parameter vector."""
+    theta = np.zeros(N_PARAMS, dtype=np.float64)
+    theta[MATERIAL_MG] = [evaluate.CHESS_BASE_VALUES[pt] for pt in PIECE_TYPES]
+    theta[MATERIAL_EG] = [evaluate.CHESS_ENDGAME_VALUES[pt] for pt in PIECE_TYPES]
+    theta[PST] = [v for pt in PIECE_TYPES for v in PIECE_SQUARE_TABLES[pt]]
+    theta[KING_MG] = evaluate.KING_MIDDLE_GAME_TABLE
+    theta[KING_EG] = evaluate.KING_END_GAME_TABLE
+    theta[PROMOTION] = evaluate.PROMOTION_BONUS
+    theta[BISHOP_PAIR] = evaluate.BISHOP_PAIR_BONUS
+    theta[TERM] = [evaluate.TERM_WEIGHTS[term] * TERM_SCALE for term in TERMS]
+    return theta
+
+def sigmoid(evals, k):
+    # expected score of an eval, 400 centipawns being 10 to 1 odds when k = 1
+    return 1.0 / (1.0 + np.exp(-k * np.log(10) / 400 * evals))
+
+def logistic_loss(evals, results, k):
+    p = np.clip(sigmoid(evals, k), 1e-7, 1 - 1e-7)
+    return float(-np.mean(results * np.log(p) + (1 - results) * np.log(1 - p)))
+
+def fit_k(evals, results, lo=K_RANGE[0], hi=K_RANGE[1], iterations=40):
+    """The K minimizing the loss of these evals (golden section search, the loss is convex in K)."""
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = lo, hi
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    fc, fd = logistic_loss(evals, results, c), logistic_loss(evals, results, d)
+    for _ in range(iterations):
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - ratio * (b - a)
+            fc = logistic_loss(evals, results, c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + ratio * (b - a)
+            fd = logistic_loss(evals, results, d)
+    return (a + b) / 2
+
+
+def tune(features, epochs=EPOCHS, learning_rate=LEARNING_RATE, k=None, theta=None, log=None):
+    """Fits the parameters to the results, returns (theta, k, loss before, loss after)."""
+    n = len(features["result"])
+    if n == 0:
+        raise ValueError("no positions to tune on")
+    theta = current_params() if theta is None else theta.copy()
+
+    # small enough: build the matrices once, else every epoch
+    cached = n * N_PARAMS * 4 <= MATRIX_CACHE_BYTES
+    data = list(batches(features)) if cached else None
+    def passes():
+        return data if cached else batches(features)
+
+    results = features["result"]
+    evals = np.concatenate([X @ theta for X, _ in passes()])
+    if k is None:
+        k = fit_k(evals, results)
+    start_loss = logistic_loss(evals, results, k)
+    if log is not None:
+        log(f"{n} positions, K = {k:.3f}, loss {start_loss:.6f}")
+
+    # Adam
+    m = np.zeros_like(theta)
+    v = np.zeros_like(theta)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    scale = k * np.log(10) / 400
+    start = time.time()
+    for epoch in range(1, epochs + 1):
+        grad = np.zeros_like(theta)
+        loss = 0.0
+        for X, r in passes():
+            p = np.clip(sigmoid(X @ theta, k), 1e-7, 1 - 1e-7)
+            loss -= float(np.sum(r * np.log(p) + (1 - r) * np.log(1 - p)))
+            # d loss / d eval of the logistic loss is just (p - r), times the sigmoid's scale
+            grad += X.T @ ((p - r) * scale)
+        grad /= n
+        m = beta1 * m + (1 - beta1) * grad
+        v = beta2 * v + (1 - beta2) * grad * grad
+        theta -= learning_rate * (m / (1 - beta1 ** epoch)) / (np.sqrt(v / (1 - beta2 ** epoch)) + eps)
+        if log is not None and (epoch % 50 == 0 or epoch == epochs):
+            log(f"epoch {epoch:5}  loss {loss / n:.6f}  {time.time() - start:.1f}s")
+
+    evals = np.concatenate([X @ theta for X, _ in passes()])
+    return theta, k, start_loss, logistic_loss(evals, results, k)
+
+
+# Parameter module
+
+def theta_to_params(theta):
+    """{evaluate parameter name: value} for a parameter vector, tables rounded to centipawns."""
+    ints = [int(round(x)) for x in theta]
+    params = {
+        "CHESS_BASE_VALUES": dict(zip(PIECE_TYPES, ints[MATERIAL_MG])),
+        "CHESS_ENDGAME_VALUES": dict(zip(PIECE_TYPES, ints[MATERIAL_EG])),
+        "KING_MIDDLE_GAME_TABLE": ints[KING_MG],
+        "KING_END_GAME_TABLE": ints[KING_EG],
+        "PROMOTION_BONUS": ints[PROMOTION],
+        "BISHOP_PAIR_BONUS": ints[BISHOP_PAIR],
+        "TERM_WEIGHTS": {term: round(float(w) / TERM_SCALE, 3) for term, w in zip(TERMS, theta[TERM])},
+    }
+    for i, name in enumerate(["PAWN_TABLE", "KNIGHT_TABLE", "BISHOP_TABLE", "ROOK_TABLE", "QUEEN_TABLE"]):
+        params[name] = ints[PST][i * 64:(i + 1) * 64]
+    return params
+
+def write_params(path, params, comment=""):
+    """Writes params as a module evaluate.load_params() can read."""
+    names = {pt: f"chess.{chess.piece_name(pt).upper()}" for pt in PIECE_TYPES}
+    lines = ["# evaluate.py weights tuned by tuner.py, load with: python engine.py --params " + os.path.basename(path)]
+    if comment:
+        lines.append(f"# {comment}")
+    lines += ["import chess", ""]
+    for name in evaluate.PARAMS:
+        value = params.get(name)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            lines.append(f"{name} = [")
+            for rank in range(0, len(value), 8):
+                lines.append("    " + ", ".join(f"{v:4}" for v in value[rank:rank + 8]) + ",")
+            lines.append("]")
+        elif isinstance(value, dict):
+            lines.append(f"{name} = {{")
+            for key, v in value.items():
+                lines.append(f"    {names[key] if key in names else repr(key)}: {v!r},")
+            lines.append("}")
+        else:
+            lines.append(f"{name} = {value!r}")
+        lines.append("")
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Texel tuning of the evaluation weights")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("extract", help="features of the quiet positions in PGN games")
+    p.add_argument("inputs", nargs="+", help="PGN files with results")
+    p.add_argument("-o", "--output", default="features.npz")
+    p.add_argument("--workers", type=int, default=None, help="processes to use (default: all cores)")
+    p.add_argument("--skip-plies", type=int, default=SKIP_PLIES, help="opening plies to leave out")
+    p.add_argument("--chunk-mb", type=int, default=CHUNK_BYTES // (1024 * 1024), help="PGN per map task")
+
+    p = commands.add_parser("tune", help="fit the weights to the extracted positions")
+    p.add_argument("features", help=".npz written by extract")
+    p.add_argument("-o", "--output", default="tuned.py", help="parameter module to write")
+    p.add_argument("--params", help="parameter module to start from (default: evaluate.py's weights)")
+    p.add_argument("--epochs", type=int, default=EPOCHS)
+    p.add_argument("--lr", type=float, default=LEARNING_RATE)
+    p.add_argument("-k", type=float, default=None, help="sigmoid scale (default: fit to the data)")
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        games, positions = extract(args.inputs, args.output, workers=args.workers, skip_plies=args.skip_plies,
+                                   chunk_bytes=args.chunk_mb * 1024 * 1024)
+        print(f"{games} games, {positions} positions written to {args.output}")
+        return
+
+    if args.params:
+        evaluate.load_params(args.params)
+    features = load_features(args.features)
+    theta, k, before, after = tune(features, epochs=args.epochs, learning_rate=args.lr, k=args.k, log=print)
+    write_params(args.output, theta_to_params(theta),
+                 f"{len(features['result'])} positions of {os.path.basename(args.features)}, "
+                 f"K={k:.3f}, loss {before:.6f} -> {after:.6f}")
+    print(f"loss {before:.6f} -> {after:.6f}, written to {args.output}")
+
+if __name__ == "__main__":
+    main()
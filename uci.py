@@ -0,0 +1,352 @@
+import os
+import sys
+import threading
+import chess
+
+import bbsearch
+from bbsearch import iterative_deepening
+from forced_chess import forced_legal_moves
+from transposition import MAX_HASH_MB
+from timeman import TimeManager
+
+# UCI front-end over the same search as the xboard loop in engine.py (python engine.py --uci)
+
+ENGINE_NAME = "Chester"
+ENGINE_AUTHOR = "Daynel-Kem"
+
+MAX_THREADS = 1 # the search is single threaded, Threads is accepted so GUIs don't complain
+
+# go arguments: the ones followed by a number, and the ones on their own
+GO_VALUES = {"wtime", "btime", "winc", "binc", "movestogo", "depth", "nodes", "mate", "movetime"}
+GO_FLAGS = {"infinite", "ponder"}
+
+
+def uci_score(score, board: chess.Board, pv=None):
+    # search scores are from White's side, UCI wants the side to move's, mates in moves
+    if board.turn == chess.BLACK:
+        score = -score
+    plies = 30000 - abs(score)
+    if abs(score) == bbsearch.PNS_MATE_SCORE:
+        # proven by PNS, the score has no length in it but the proof line does
+        # (without one, it's still a mate and not a 29500 eval)
+        plies = len(pv) if pv else 1
+    if plies <= bbsearch.MAX_SEARCH_DEPTH:
+        moves = (plies + 1) // 2
+        return f"mate {moves if score > 0 else -moves}"
+    return f"cp {int(score)}"
+
+
+class UciEngine:
+    def __init__(self, cache=None):
+        self.board = chess.Board()
+        self.cache = cache # analysis_cache.AnalysisCache or None
+        # what the last "position" command was built from, so new moves can just be pushed
+        self.base_fen = chess.STARTING_FEN
+        self.moves = []
+
+        self.threads = 1
+        self.time_manager = TimeManager()
+
+        self.search_thread = None
+        # the search thread holds bestmove until this is set (right away unless infinite/ponder)
+        self.release = threading.Event()
+        self.ponder_clock = None
+        self.output_lock = threading.Lock()
+
+    # Helper Functions
+    def send(self, msg):
+        with self.output_lock:
+            sys.stdout.write(msg + '\n')
+            sys.stdout.flush()
+
+    def debug(self, msg):
+        sys.stderr.write(msg + '\n')
+
+    # Position Handling
+    def set_position(self, args):
+        tokens = args.split()
+        if not tokens:
+            return
+
+        if tokens[0] == "startpos":
+            fen = chess.STARTING_FEN
+            rest = tokens[1:]
+        elif tokens[0] == "fen":
+            # EPD style fens leave out the move counters, the fen runs up to "moves"
+            end = tokens.index("moves") if "moves" in tokens else len(tokens)
+            fen = " ".join(tokens[1:end])
+            rest = tokens[end:]
+        else:
+            return
+
+        moves = rest[1:] if rest and rest[0] == "moves" else []
+
+        # GUIs resend the whole game every move, only push what's new
+        if fen == self.base_fen and moves[:len(self.moves)] == self.moves:
+            new_moves = moves[len(self.moves):]
+        else:
+            try:
+                board = chess.Board(fen)
+            except ValueError:
+                self.debug(f"invalid fen: {fen}")
+                return
+            self.board = board
+            self.base_fen = fen
+            self.moves = []
+            new_moves = moves
+
+        for move_str in new_moves:
+            try:
+                move = chess.Move.from_uci(move_str)
+            except ValueError:
+                move = None
+            if move is None or move not in forced_legal_moves(self.board):
+                # keep the position up to the last good move, the next position command rebuilds it
+                self.debug(f"illegal move in position: {move_str}")
+                return
+            self.board.push(move)
+            self.moves.append(move_str)
+
+    # Search Handling
+    def go(self, args):
+        self.stop()
+
+        tokens = args.split()
+        params = {}
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            i += 1
+            if token in GO_FLAGS:
+                params[token] = True
+            elif token in GO_VALUES:
+                if i < len(tokens) and tokens[i].lstrip("-").isdigit():
+                    params[token] = int(tokens[i])
+                    i += 1
+                else:
+                    self.debug(f"go {token} without a number")
+            elif token == "searchmoves":
+                # not supported, skip the moves up to the next keyword
+                while i < len(tokens) and tokens[i] not in GO_VALUES and tokens[i] not in GO_FLAGS:
+                    i += 1
+            else:
+                self.debug(f"unknown go argument: {token}")
+
+        board = self.board.copy()
+        max_depth = min(params.get("depth", bbsearch.MAX_SEARCH_DEPTH), bbsearch.MAX_SEARCH_DEPTH)
+        max_nodes = params.get("nodes")
+        waits = params.get("infinite", False) or params.get("ponder", False)
+
+        # time control, in seconds
+        tm = TimeManager()
+        self.time_manager = tm
+        if board.turn == chess.WHITE:
+            my_time, opp_time, inc = params.get("wtime"), params.get("btime"), params.get("winc", 0)
+        else:
+            my_time, opp_time, inc = params.get("btime"), params.get("wtime"), params.get("binc", 0)
+
+        self.ponder_clock = None
+        if "movetime" in params:
+            tm.set_fixed_time(params["movetime"] / 1000)
+            clock = (0.0, None, None)
+        elif my_time is not None and not params.get("infinite"):
+            tm.set_level(params.get("movestogo", 0), my_time / 1000, inc / 1000)
+            clock = (my_time / 1000, params.get("movestogo"), opp_time / 1000 if opp_time else None)
+        else:
+            clock = None
+
+        if params.get("ponder") or clock is None:
+            # pondering runs without limits, ponderhit starts our clock
+            tm.start_infinite()
+            if params.get("ponder"):
+                self.ponder_clock = clock
+        else:
+            tm.start(*clock)
+
+        self.release.clear()
+        if not waits:
+            self.release.set()
+
+        self.start_search(board, max_depth, max_nodes, tm)
+
+    def start_search(self, board, max_depth, max_nodes, tm):
+        self.search_thread = threading.Thread(
+            target=self.search, args=(board, max_depth, max_nodes, tm), daemon=True)
+        self.search_thread.start()
+
+    def send_info(self, board, depth, score, elapsed, nodes, pv, hashfull=None):
+        nps = int(nodes / elapsed) if elapsed > 0 else 0
+        pv_str = " ".join(move.uci() for move in pv)
+        hashfull_str = f" hashfull {hashfull}" if hashfull is not None else ""
+        self.send(f"info depth {depth} score {uci_score(score, board, pv)} time {int(elapsed * 1000)} "
+                  f"nodes {nodes} nps {nps}{hashfull_str} pv {pv_str}")
+
+    def search(self, board, max_depth, max_nodes, tm):
+        def on_info(depth, score, elapsed, nodes, pv):
+            self.send_info(board, depth, score, elapsed, nodes, pv, bbsearch.stats.hashfull)
+
+        if self.cache is not None:
+            self.cache.seed(bbsearch.searcher.tt, board)
+        res = iterative_deepening(board, max_depth=max_depth, time_manager=tm, on_info=on_info,
+                                  max_nodes=max_nodes)
+        if self.cache is not None:
+            self.cache.record(board, res)
+
+        # in infinite/ponder mode the GUI decides when we're done
+        self.release.wait()
+        self.send_bestmove(board, res)
+
+    def send_bestmove(self, board, res):
+        move = res.best_move
+        if move is None:
+            # stopped before the first iteration finished, anything legal beats losing on time
+            moves = forced_legal_moves(board)
+            move = moves[0] if moves else None
+        if move is None:
+            self.send("bestmove 0000")
+        elif len(res.pv) > 1 and res.pv[0] == move:
+            self.send(f"bestmove {move.uci()} ponder {res.pv[1].uci()}")
+        else:
+            self.send(f"bestmove {move.uci()}")
+
+    def stop(self):
+        if self.search_thread is not None:
+            bbsearch.stop_signal.set()
+            self.release.set()
+            self.search_thread.join()
+            bbsearch.stop_signal.clear()
+            self.search_thread = None
+
+    def ponderhit(self):
+        # the opponent played the move we pondered on, from here on it's our clock
+        tm = self.time_manager
+        if self.ponder_clock is not None:
+            tm.start(*self.ponder_clock)
+            # the running iteration gets the limit too, once there's a finished one to fall back on
+            if bbsearch.stats.iterations:
+                bbsearch.searcher.deadline = tm.deadline()
+        self.ponder_clock = None
+        self.release.set()
+
+    def set_option(self, args):
+        # setoption name <id> [value <x>]
+        tokens = args.split()
+        if "name" not in tokens:
+            return
+        name_start = tokens.index("name") + 1
+        if "value" in tokens:
+            value_idx = tokens.index("value")
+            name = " ".join(tokens[name_start:value_idx]).lower()
+            value = " ".join(tokens[value_idx + 1:])
+        else:
+            name = " ".join(tokens[name_start:]).lower()
+            value = None
+
+        if name == "hash" and value is not None:
+            self.set_hash_size(max(1, min(MAX_HASH_MB, int(value))))
+        elif name == "threads" and value is not None:
+            self.threads = max(1, min(MAX_THREADS, int(value)))
+        elif name == "clear hash":
+            self.clear_hash()
+        elif name == "tablebasepath":
+            self.set_tablebase_path(value)
+
+    def set_hash_size(self, mb):
+        bbsearch.searcher.tt.resize_mb(mb)
+
+    def clear_hash(self):
+        bbsearch.searcher.tt.new_game()
+        if self.cache is not None:
+            self.cache.warm(bbsearch.searcher.tt)
+
+    def set_tablebase_path(self, value):
+        # like SyzygyPath: directories separated by the OS path separator, empty turns probing off
+        searcher = bbsearch.searcher
+        if searcher.tb is not None:
+            searcher.tb.close()
+            searcher.tb = None
+        if not value or value == "<empty>":
+            return
+        from tablebase import Tablebase
+        tb = Tablebase()
+        for directory in value.split(os.pathsep):
+            if os.path.isdir(directory):
+                tb.add_directory(directory)
+            else:
+                self.debug(f"TablebasePath: no directory {directory}")
+        if tb.tables:
+            searcher.tb = tb
+
+    # UCI Protocol Handling
+    def handle_command(self, cmd):
+        self.debug(f"CMD: {cmd}")
+        name, _, args = cmd.partition(" ")
+
+        if name == "uci":
+            self.send(f"id name {ENGINE_NAME}")
+            self.send(f"id author {ENGINE_AUTHOR}")
+            self.send(f"option name Hash type spin default {bbsearch.searcher.tt.size_mb()} min 1 max {MAX_HASH_MB}")
+            self.send(f"option name Threads type spin default 1 min 1 max {MAX_THREADS}")
+            self.send("option name Clear Hash type button")
+            self.send("option name Ponder type check default false")
+            self.send("option name TablebasePath type string default <empty>")
+            self.send("uciok")
+            return
+
+        if name == "isready":
+            self.send("readyok")
+            return
+
+        if name == "ucinewgame":
+            self.stop()
+            self.board = chess.Board()
+            self.base_fen = chess.STARTING_FEN
+            self.moves = []
+            self.clear_hash()
+            return
+
+        if name == "position":
+            self.stop()
+            self.set_position(args)
+            return
+
+        if name == "go":
+            self.go(args)
+            return
+
+        if name == "stop":
+            self.stop()
+            return
+
+        if name == "ponderhit":
+            self.ponderhit()
+            return
+
+        if name == "setoption":
+            self.stop()
+            self.set_option(args)
+            return
+
+        if name == "quit":
+            self.stop()
+            sys.exit(0)
+
+    # Main Function Loop
+    def loop(self):
+        while True:
+            try:
+                line = sys.stdin.readline()
+                if not line:
+                    break
+                self.handle_command(line.strip())
+            except KeyboardInterrupt:
+                self.debug("Keyboard Interrupt caught in main loop")
+                continue
+
+
+def main():
+    engine = UciEngine()
+    engine.loop()
+
+if __name__ == "__main__":
+    main()